@@ -1,17 +1,19 @@
 import os
 import re
-import json
+from dataclasses import asdict
 from pathlib import Path
 
-from fastapi import FastAPI, Request, HTTPException, status, Security
+from fastapi import FastAPI, Query, Request, Response, HTTPException, status, Security
 from fastapi.security import APIKeyHeader
 from pydantic import BaseModel, field_validator
 from slowapi import Limiter, _rate_limit_exceeded_handler
 from slowapi.util import get_remote_address
 from slowapi.errors import RateLimitExceeded
 
+import compressors
 from manager import BackupManager
 from scanner import scan_files
+from utils import resolve_workers, resolve_flag, resolve_codec, MAX_WORKERS
 
 app = FastAPI(title="Smart-Backup API")
 
@@ -27,6 +29,9 @@ limiter = Limiter(key_func=get_remote_address)
 app.state.limiter = limiter
 app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
 
+MAX_PAGE_SIZE = 1000
+MAX_PATH_LENGTH = 4096
+_HASH_RE = re.compile(r"^[0-9a-f]{64}$")
 _PROJECT_NAME_RE = re.compile(r"^[a-zA-Z0-9_\-]{1,64}$")
 ALLOWED_SOURCE_BASE = Path(os.getenv("ALLOWED_SOURCE_PATH", "/data")).resolve()
 
@@ -44,6 +49,11 @@ class BackupRequest(BaseModel):
     project_name: str
     comment: str = ""
     compress: bool = True
+    scan_workers: int | None = None  # None: SMART_BACKUP_SCAN_WORKERS or 1
+    backup_workers: int | None = None  # None: SMART_BACKUP_WORKERS or 1
+    chunking: bool | None = None  # None: SMART_BACKUP_CHUNKING or off
+    pack_objects: bool | None = None  # None: SMART_BACKUP_PACK_OBJECTS or off
+    codec: str | None = None  # "zstd" or "zstd:19"; None: SMART_BACKUP_CODEC or zlib
 
     @field_validator("source_path")
     @classmethod
@@ -64,6 +74,24 @@ class BackupRequest(BaseModel):
             raise ValueError("project_name must be 1-64 chars: letters, digits, - or _")
         return v
 
+    @field_validator("scan_workers", "backup_workers")
+    @classmethod
+    def validate_workers(cls, v: int | None, info) -> int | None:
+        if v is not None and not 1 <= v <= MAX_WORKERS:
+            raise ValueError(f"{info.field_name} must be between 1 and {MAX_WORKERS}")
+        return v
+
+    @field_validator("codec")
+    @classmethod
+    def validate_codec(cls, v: str | None) -> str | None:
+        if v is None:
+            return v
+        try:
+            compressors.parse_codec(v)
+        except compressors.CodecUnavailableError as e:
+            raise ValueError(str(e))
+        return v.strip().lower()
+
     @field_validator("comment")
     @classmethod
     def validate_comment(cls, v: str) -> str:
@@ -90,32 +118,90 @@ def health():
 @limiter.limit("30/minute")
 def list_backups(
     request: Request,
+    response: Response,
+    project: str = None,
+    version: str = None,
+    comment: str = None,
+    encrypted: bool = None,
+    limit: int = Query(default=None, ge=1, le=MAX_PAGE_SIZE),
+    offset: int = Query(default=0, ge=0),
+    _=Security(verify_api_key),
+):
+    """Snapshots from the catalog, oldest first. version and comment match
+    substrings; X-Total-Count holds the number of matches before paging."""
+    if project is not None and not _PROJECT_NAME_RE.match(project):
+        raise HTTPException(status_code=400, detail="Invalid project name")
+
+    if not BACKUP_BASE.exists():
+        response.headers["X-Total-Count"] = "0"
+        return []
+    catalog = BackupManager(BACKUP_BASE).catalog
+    filters = {
+        "project": project,
+        "version_contains": version,
+        "comment_contains": comment,
+        "encrypted": encrypted,
+    }
+    response.headers["X-Total-Count"] = str(catalog.count(**filters))
+    snapshots = catalog.find(**filters, limit=limit, offset=offset)
+    return [asdict(snapshot) for snapshot in snapshots]
+
+
+@app.get(
+    "/files/history",
+    responses={
+        400: {"description": "Invalid project name or path"},
+        403: {"description": "Invalid API key"},
+        429: {"description": "Rate limit exceeded"},
+    },
+)
+@limiter.limit("30/minute")
+def file_history(
+    request: Request,
+    path: str,
     project: str = None,
+    limit: int = Query(default=None, ge=1, le=MAX_PAGE_SIZE),
+    offset: int = Query(default=0, ge=0),
     _=Security(verify_api_key),
 ):
+    """Every snapshot holding path (relative to the backed up folder), oldest
+    first, with the content hash of the file in it."""
     if project is not None and not _PROJECT_NAME_RE.match(project):
         raise HTTPException(status_code=400, detail="Invalid project name")
+    if not path or len(path) > MAX_PATH_LENGTH:
+        raise HTTPException(status_code=400, detail="Invalid path")
 
     manager = BackupManager(BACKUP_BASE)
-    versions = manager._find_target_versions(project)
-    result = []
-    for v in versions:
-        try:
-            with open(v / "manifest.json", "r", encoding="utf-8") as f:
-                manifest = json.load(f)
-        except (OSError, json.JSONDecodeError) as e:
-            continue  # A corrupted manifest does not drop the entire list.
-        result.append(
-            {
-                "project": v.parent.name,
-                "version": v.name,
-                "total_files": manifest["info"]["total_files"],
-                "comment": manifest["info"].get("comment", ""),
-                "encrypted": manifest["info"].get("salt") is not None,
-                "compression": manifest["info"].get("compression_enabled", False),
-            }
-        )
-    return result
+    versions = manager.path_history(path, project, limit=limit, offset=offset)
+    return [asdict(version) for version in versions]
+
+
+@app.get(
+    "/files/by-hash/{file_hash}",
+    responses={
+        400: {"description": "Invalid project name or hash"},
+        403: {"description": "Invalid API key"},
+        429: {"description": "Rate limit exceeded"},
+    },
+)
+@limiter.limit("30/minute")
+def file_hash_locations(
+    request: Request,
+    file_hash: str,
+    project: str = None,
+    limit: int = Query(default=None, ge=1, le=MAX_PAGE_SIZE),
+    offset: int = Query(default=0, ge=0),
+    _=Security(verify_api_key),
+):
+    """Every snapshot and path whose content has file_hash (SHA-256), oldest first."""
+    if project is not None and not _PROJECT_NAME_RE.match(project):
+        raise HTTPException(status_code=400, detail="Invalid project name")
+    if not _HASH_RE.match(file_hash):
+        raise HTTPException(status_code=400, detail="Invalid hash")
+
+    manager = BackupManager(BACKUP_BASE)
+    versions = manager.hash_locations(file_hash, project, limit=limit, offset=offset)
+    return [asdict(version) for version in versions]
 
 
 @app.post(
@@ -146,13 +232,22 @@ def create_backup(
 
     manager = BackupManager(BACKUP_BASE)
     try:
-        scan_result = scan_files(source)
+        scan_result = scan_files(
+            source,
+            previous_manifest=manager.load_latest_manifest(req.project_name),
+            workers=resolve_workers(req.scan_workers, "SMART_BACKUP_SCAN_WORKERS"),
+            defer_hashing=True,
+        )
         result = manager.create_backup(
             scan_result,
             source,
             req.project_name,
             comment=req.comment,
             compress=req.compress,
+            chunking=resolve_flag(req.chunking, "SMART_BACKUP_CHUNKING"),
+            pack_objects=resolve_flag(req.pack_objects, "SMART_BACKUP_PACK_OBJECTS"),
+            workers=resolve_workers(req.backup_workers, "SMART_BACKUP_WORKERS"),
+            codec=resolve_codec(req.codec, "SMART_BACKUP_CODEC"),
         )
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -163,4 +258,14 @@ def create_backup(
         "copied": result.copied,
         "skipped": result.skipped,
         "errors": result.errors,
+        "reused_hashes": scan_result.reused_hashes,
+        "bytes_written": result.bytes_written,
+        "codecs": {
+            label: {
+                "bytes_in": stats.bytes_in,
+                "bytes_out": stats.bytes_out,
+                "mb_per_s": round(stats.throughput, 1),
+            }
+            for label, stats in result.codec_stats.items()
+        },
     }
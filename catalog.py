@@ -0,0 +1,323 @@
+"""Catalog of the snapshots in a storage, for listing and lookups without
+reading manifests.
+
+Each snapshot has one row with the summary shown in version lists. The file
+index maps paths and content hashes to the snapshots holding them as spans:
+one row per (project, path, hash) for a run of consecutive snapshots of the
+project, extended as long as the file is unchanged. A file kept unchanged
+through years of snapshots is one row, and the history of a path or the uses
+of a hash are a few indexed lookups.
+
+A snapshot is recorded in one transaction once its manifest is complete, so
+the catalog never lists a snapshot that cannot be opened. Snapshots copied,
+synced or removed by other means are picked up by a rebuild from the
+manifests on disk (BackupManager.rebuild_catalog).
+"""
+
+import itertools
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Iterable, Optional
+
+from classes import FileVersion, SnapshotSummary
+
+CATALOG_FILE = ".catalog.sqlite"
+SCHEMA_VERSION = 2
+INSERT_BATCH = 10_000
+
+_COLUMNS = "project, version, total_files, comment, encrypted, compression"
+_TABLES = ("snapshots", "paths", "hashes", "file_spans")
+
+
+def _summary(row: tuple) -> SnapshotSummary:
+    project, version, total_files, comment, encrypted, compression = row
+    return SnapshotSummary(
+        project=project,
+        version=version,
+        total_files=total_files,
+        comment=comment,
+        encrypted=bool(encrypted),
+        compression=bool(compression),
+    )
+
+
+def _row(summary: SnapshotSummary) -> tuple:
+    return (
+        summary.project,
+        summary.version,
+        summary.total_files,
+        summary.comment,
+        int(summary.encrypted),
+        int(summary.compression),
+    )
+
+
+def _where(
+    project: Optional[str],
+    version_contains: Optional[str],
+    comment_contains: Optional[str],
+    encrypted: Optional[bool],
+) -> tuple[str, list]:
+    # instr() matches substrings literally, unlike LIKE with % and _ in the text
+    clauses, params = [], []
+    if project is not None:
+        clauses.append("project = ?")
+        params.append(project)
+    if version_contains:
+        clauses.append("instr(version, ?) > 0")
+        params.append(version_contains)
+    if comment_contains:
+        clauses.append("instr(comment, ?) > 0")
+        params.append(comment_contains)
+    if encrypted is not None:
+        clauses.append("encrypted = ?")
+        params.append(int(encrypted))
+    return (f" WHERE {' AND '.join(clauses)}" if clauses else ""), params
+
+
+class SnapshotCatalog:
+    def __init__(self, db_path: Path):
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        version = self._conn.execute("PRAGMA user_version").fetchone()[0]
+        # New, or written by an older version: the owner refills it from disk
+        self.is_stale = version != SCHEMA_VERSION
+        if self.is_stale:
+            for table in _TABLES:
+                self._conn.execute(f"DROP TABLE IF EXISTS {table}")
+        self._create_tables()
+        self._conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        self._conn.commit()
+
+    def _create_tables(self) -> None:
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS snapshots ("
+            "project TEXT NOT NULL, version TEXT NOT NULL, "
+            "total_files INTEGER NOT NULL, comment TEXT NOT NULL, "
+            "encrypted INTEGER NOT NULL, compression INTEGER NOT NULL, "
+            "PRIMARY KEY (project, version)) WITHOUT ROWID"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS snapshots_by_version ON snapshots (version)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS paths (id INTEGER PRIMARY KEY, path TEXT NOT NULL UNIQUE)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS hashes (id INTEGER PRIMARY KEY, hash TEXT NOT NULL UNIQUE)"
+        )
+        # path_id had hash_id in every snapshot of project from first to last version
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS file_spans ("
+            "project TEXT NOT NULL, path_id INTEGER NOT NULL, hash_id INTEGER NOT NULL, "
+            "first_version TEXT NOT NULL, last_version TEXT NOT NULL, "
+            "PRIMARY KEY (path_id, project, first_version)) WITHOUT ROWID"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS file_spans_by_hash ON file_spans (hash_id)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS file_spans_open "
+            "ON file_spans (project, last_version)"
+        )
+
+    def record(
+        self, summary: SnapshotSummary, files: Iterable[tuple[str, str]] = ()
+    ) -> bool:
+        """Adds a snapshot with its (path, hash) pairs. A snapshot already in the
+        catalog only has its summary updated. Returns False if files could not be
+        indexed because the project has newer snapshots: reindex_project then
+        rebuilds the file index of the project."""
+        with self._lock, self._conn:
+            known = self._conn.execute(
+                "SELECT 1 FROM snapshots WHERE project = ? AND version = ?",
+                (summary.project, summary.version),
+            ).fetchone()
+            newer = self._conn.execute(
+                "SELECT 1 FROM snapshots WHERE project = ? AND version > ? LIMIT 1",
+                (summary.project, summary.version),
+            ).fetchone()
+            previous = self._conn.execute(
+                "SELECT MAX(version) FROM snapshots WHERE project = ? AND version < ?",
+                (summary.project, summary.version),
+            ).fetchone()[0]
+            self._conn.execute(
+                f"INSERT OR REPLACE INTO snapshots ({_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?)",
+                _row(summary),
+            )
+            if known:
+                return True
+            if newer:
+                return False
+            self._add_files(summary.project, summary.version, previous, files)
+            return True
+
+    def reindex_project(
+        self, project: str, snapshots: Iterable[tuple[str, Iterable[tuple[str, str]]]]
+    ) -> None:
+        """Replaces the file index of project with the given (version, files),
+        which must cover every snapshot of the project, oldest first."""
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM file_spans WHERE project = ?", (project,))
+            previous = None
+            for version, files in snapshots:
+                self._add_files(project, version, previous, files)
+                previous = version
+
+    def _add_files(
+        self,
+        project: str,
+        version: str,
+        previous: Optional[str],
+        files: Iterable[tuple[str, str]],
+    ) -> None:
+        """Extends the spans of files unchanged since previous, the snapshot
+        of the project just before version, and opens spans for the others."""
+        conn = self._conn
+        conn.execute(
+            "CREATE TEMP TABLE IF NOT EXISTS staged_files (path TEXT PRIMARY KEY, hash TEXT)"
+        )
+        conn.execute(
+            "CREATE TEMP TABLE IF NOT EXISTS staged_ids "
+            "(path_id INTEGER PRIMARY KEY, hash_id INTEGER)"
+        )
+        conn.execute("DELETE FROM staged_files")
+        conn.execute("DELETE FROM staged_ids")
+        files = iter(files)
+        while batch := list(itertools.islice(files, INSERT_BATCH)):
+            conn.executemany(
+                "INSERT OR REPLACE INTO staged_files (path, hash) VALUES (?, ?)", batch
+            )
+        conn.execute("INSERT OR IGNORE INTO paths (path) SELECT path FROM staged_files")
+        conn.execute(
+            "INSERT OR IGNORE INTO hashes (hash) SELECT hash FROM staged_files"
+        )
+        conn.execute(
+            "INSERT INTO staged_ids (path_id, hash_id) "
+            "SELECT p.id, h.id FROM staged_files s "
+            "JOIN paths p ON p.path = s.path JOIN hashes h ON h.hash = s.hash"
+        )
+        if previous is not None:
+            conn.execute(
+                "UPDATE file_spans SET last_version = ? "
+                "WHERE project = ? AND last_version = ? AND hash_id = "
+                "(SELECT hash_id FROM staged_ids WHERE path_id = file_spans.path_id)",
+                (version, project, previous),
+            )
+        conn.execute(
+            "INSERT INTO file_spans "
+            "(project, path_id, hash_id, first_version, last_version) "
+            "SELECT ?, path_id, hash_id, ?, ? FROM staged_ids s WHERE NOT EXISTS ("
+            "SELECT 1 FROM file_spans f WHERE f.path_id = s.path_id "
+            "AND f.project = ? AND f.last_version = ?)",
+            (project, version, version, project, version),
+        )
+
+    def get(self, project: str, version: str) -> Optional[SnapshotSummary]:
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT {_COLUMNS} FROM snapshots WHERE project = ? AND version = ?",
+                (project, version),
+            ).fetchone()
+        return _summary(row) if row else None
+
+    def find(
+        self,
+        project: Optional[str] = None,
+        version_contains: Optional[str] = None,
+        comment_contains: Optional[str] = None,
+        encrypted: Optional[bool] = None,
+        newest_first: bool = False,
+        limit: Optional[int] = None,
+        offset: int = 0,
+    ) -> list[SnapshotSummary]:
+        """Snapshots matching every given filter, ordered by version name
+        (the snapshot timestamp), then project."""
+        where, params = _where(project, version_contains, comment_contains, encrypted)
+        order = "DESC" if newest_first else "ASC"
+        sql = (
+            f"SELECT {_COLUMNS} FROM snapshots{where} "
+            f"ORDER BY version {order}, project {order} LIMIT ? OFFSET ?"
+        )
+        params += [-1 if limit is None else limit, offset]
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        return [_summary(row) for row in rows]
+
+    def count(
+        self,
+        project: Optional[str] = None,
+        version_contains: Optional[str] = None,
+        comment_contains: Optional[str] = None,
+        encrypted: Optional[bool] = None,
+    ) -> int:
+        where, params = _where(project, version_contains, comment_contains, encrypted)
+        with self._lock:
+            return self._conn.execute(
+                f"SELECT COUNT(*) FROM snapshots{where}", params
+            ).fetchone()[0]
+
+    def _file_versions(
+        self,
+        column: str,
+        value: str,
+        project: Optional[str],
+        limit: Optional[int],
+        offset: int,
+    ) -> list[FileVersion]:
+        # every snapshot of the span's project between its first and last version
+        sql = (
+            "SELECT s.project, s.version, p.path, h.hash FROM file_spans f "
+            "JOIN paths p ON p.id = f.path_id JOIN hashes h ON h.id = f.hash_id "
+            "JOIN snapshots s ON s.project = f.project "
+            "AND s.version BETWEEN f.first_version AND f.last_version "
+            f"WHERE {column} = ?"
+        )
+        params: list = [value]
+        if project is not None:
+            sql += " AND f.project = ?"
+            params.append(project)
+        sql += " ORDER BY s.version, s.project, p.path LIMIT ? OFFSET ?"
+        params += [-1 if limit is None else limit, offset]
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        return [FileVersion(*row) for row in rows]
+
+    def path_history(
+        self,
+        path: str,
+        project: Optional[str] = None,
+        limit: Optional[int] = None,
+        offset: int = 0,
+    ) -> list[FileVersion]:
+        """Every snapshot holding path, oldest first, with its hash there."""
+        return self._file_versions("p.path", path, project, limit, offset)
+
+    def hash_locations(
+        self,
+        file_hash: str,
+        project: Optional[str] = None,
+        limit: Optional[int] = None,
+        offset: int = 0,
+    ) -> list[FileVersion]:
+        """Every (snapshot, path) whose content has file_hash, oldest first."""
+        return self._file_versions("h.hash", file_hash, project, limit, offset)
+
+    def replace_all(self, summaries: Iterable[SnapshotSummary]) -> int:
+        """Replaces every snapshot row and clears the file index (refilled by
+        reindex_project). Returns the number of snapshots."""
+        with self._lock, self._conn:
+            for table in _TABLES:
+                self._conn.execute(f"DELETE FROM {table}")
+            self._conn.executemany(
+                f"INSERT OR REPLACE INTO snapshots ({_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?)",
+                (_row(summary) for summary in summaries),
+            )
+            return self._conn.execute("SELECT COUNT(*) FROM snapshots").fetchone()[0]
+
+    def close(self) -> None:
+        self._conn.close()
@@ -1,14 +1,101 @@
+import os
 from dataclasses import dataclass, field
 from typing import List, Optional
 from pathlib import Path
 
 
+@dataclass(frozen=True)
+class FileStat:
+    """Stat fingerprint used to detect unchanged files between snapshots."""
+
+    size: int
+    mtime_ns: int
+    inode: int
+    ctime_ns: int
+
+    @classmethod
+    def from_stat(cls, st: os.stat_result) -> "FileStat":
+        return cls(
+            size=st.st_size,
+            mtime_ns=st.st_mtime_ns,
+            inode=st.st_ino,
+            ctime_ns=st.st_ctime_ns,
+        )
+
+    @classmethod
+    def from_entry(cls, entry: dict) -> Optional["FileStat"]:
+        """Reads the fingerprint stored in a manifest entry, None for old manifests."""
+        try:
+            return cls(
+                size=entry["size"],
+                mtime_ns=entry["mtime_ns"],
+                inode=entry["inode"],
+                ctime_ns=entry["ctime_ns"],
+            )
+        except (KeyError, TypeError):
+            return None
+
+    def to_entry(self) -> dict:
+        return {
+            "size": self.size,
+            "mtime_ns": self.mtime_ns,
+            "inode": self.inode,
+            "ctime_ns": self.ctime_ns,
+        }
+
+
 @dataclass
 class ScanResult:
     files: List[Path]
     total_size: int
     total_files: int
     file_hashes: dict[Path, str] = field(default_factory=dict)
+    file_stats: dict[Path, FileStat] = field(default_factory=dict)
+    reused_hashes: int = 0
+    # Manifest entries of the previous snapshot for files whose hash was reused
+    previous_entries: dict[Path, dict] = field(default_factory=dict)
+    # Snapshot info of the previous manifest
+    previous_info: dict = field(default_factory=dict)
+
+
+@dataclass
+class CodecStats:
+    """Bytes passed through a compressor and the time spent in it."""
+
+    bytes_in: int = 0
+    bytes_out: int = 0
+    seconds: float = 0.0
+
+    def record(self, bytes_in: int, bytes_out: int, seconds: float) -> None:
+        self.bytes_in += bytes_in
+        self.bytes_out += bytes_out
+        self.seconds += seconds
+
+    def merge(self, other: "CodecStats") -> None:
+        self.record(other.bytes_in, other.bytes_out, other.seconds)
+
+    @property
+    def throughput(self) -> float:
+        """Input MB per second of compressor time."""
+        return self.bytes_in / 1e6 / self.seconds if self.seconds else 0.0
+
+    @property
+    def ratio(self) -> float:
+        """Compressed size relative to the input, 1.0 for no gain."""
+        return self.bytes_out / self.bytes_in if self.bytes_in else 1.0
+
+
+@dataclass
+class StoredObject:
+    """Where the content of one file ended up in the object store."""
+
+    file_hash: str
+    object_id: Optional[str]  # None for chunked files
+    format: str  # "framed" or "raw"
+    copied: bool
+    chunks: Optional[list] = None  # [[chunk_hash, size], ...] in file order
+    bytes_written: int = 0
+    codec_stats: Optional[CodecStats] = None  # None if nothing was compressed
 
 
 @dataclass
@@ -17,6 +104,62 @@ class CopyResult:
     skipped: int
     quantity_versions: int
     errors: int
+    bytes_written: int = 0
+    # Codec label ("zstd:3") -> stats of the files compressed in this run
+    codec_stats: dict[str, CodecStats] = field(default_factory=dict, compare=False)
+
+
+@dataclass(frozen=True)
+class SnapshotSummary:
+    """One snapshot as listed by the catalog (catalog.py)."""
+
+    project: str
+    version: str
+    total_files: int
+    comment: str
+    encrypted: bool
+    compression: bool
+
+    @classmethod
+    def from_info(cls, project: str, version: str, info: dict) -> "SnapshotSummary":
+        """Summary of the "info" section of a manifest."""
+        return cls(
+            project=project,
+            version=version,
+            total_files=info.get("total_files", 0),
+            comment=info.get("comment") or "",
+            encrypted=info.get("salt") is not None,
+            compression=bool(info.get("compression_enabled", False)),
+        )
+
+
+@dataclass(frozen=True)
+class FileVersion:
+    """A file as stored in one snapshot, from the catalog's file index."""
+
+    project: str
+    version: str
+    path: str
+    hash: str
+
+
+@dataclass
+class RunOptions:
+    """Performance settings collected from the CLI flags and the environment."""
+
+    scan_workers: int = 1
+    backup_workers: int = 1
+    restore_workers: int = 1
+    fetch_workers: int = 1
+    upload_workers: int = 1
+    part_size_mb: int = 16  # objects larger than a part are transferred in parts
+    transfer_concurrency: int = 8  # parts of one object transferred at once
+    spool_dir: Optional[str] = None  # cloud backup staging, the temp dir if None
+    chunking: bool = False
+    pack_objects: bool = False
+    codec: str = "zlib"  # "name" or "name:level", see compressors.py
+    verify_only: bool = False  # restore only checks hashes, writes nothing
+    hardlink_duplicates: bool = False
 
 
 @dataclass
@@ -1,18 +1,134 @@
-import json
+import hashlib
 import logging
+import random
 import boto3
 import os
+import shutil
 import sys
-from botocore.exceptions import ClientError
+import tempfile
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import BotoCoreError, ClientError, IncompleteReadError
 from botocore.config import Config
 from pathlib import Path
 from io import BytesIO
+from typing import BinaryIO, Callable, Iterable, Optional
+from object_index import ObjectIndex
+from manifests import is_manifest_name, open_manifest
+from upload_journal import PendingUpload, UploadJournal
 
 logger = logging.getLogger(__name__)
 
+# Content-addressed keys never change once uploaded, so they can be indexed
+INDEXED_PREFIXES = ("backups/objects/", "backups/packs/")
+OBJECTS_PREFIX = "backups/objects/"
+# Objects are spread over 256 prefixes objects/00/ .. objects/ff/, listed in parallel
+OBJECT_PREFIXES = tuple(f"{OBJECTS_PREFIX}{n:02x}/" for n in range(256))
+LISTING_WORKERS = 16
+# botocore's default; raised to the number of threads sharing the client
+DEFAULT_MAX_CONNECTIONS = 10
+# Uploads queued per upload worker; bounds the object bytes held in memory
+QUEUE_DEPTH_PER_WORKER = 2
+# Objects up to one part move in a single request, larger ones in parts
+DEFAULT_PART_SIZE = 16 * 1024 * 1024
+# Parts of one object transferred at once
+DEFAULT_TRANSFER_CONCURRENCY = 8
+# Bytes of a downloaded part held in memory before they are written out
+DOWNLOAD_BLOCK = 1024 * 1024
+# Attempts per request. botocore waits between them with exponential backoff
+# and jitter; the adaptive mode also slows the client down while throttled
+RETRY_ATTEMPTS = 8
+READ_TIMEOUT = 60
+# Backoff of the retries around reading a response body, which botocore leaves
+# to the caller: a connection dropped mid-body fails after the request succeeded
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 20.0
+# Upload workers send each small object over a single connection of the shared pool
+_ONE_CONNECTION = TransferConfig(use_threads=False)
+
+
+_seek_lock = threading.Lock()
+
+
+def _retry(call: Callable, what: str):
+    """call(), attempted up to RETRY_ATTEMPTS times on transport errors.
+    Waits are random up to an exponentially growing cap ("full jitter")."""
+    for attempt in range(1, RETRY_ATTEMPTS + 1):
+        try:
+            return call()
+        except BotoCoreError as e:
+            if attempt == RETRY_ATTEMPTS:
+                raise
+            cap = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2**attempt)
+            delay = random.uniform(0, cap)
+            logger.warning(f"{what} failed ({e}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+
+def _write_at(f: BinaryIO, data: bytes, offset: int) -> None:
+    """Writes data at offset of f; safe from several threads."""
+    if not hasattr(os, "pwrite"):  # Windows
+        with _seek_lock:
+            f.seek(offset)
+            f.write(data)
+        return
+    view = memoryview(data)
+    while view:
+        written = os.pwrite(f.fileno(), view, offset)
+        view = view[written:]
+        offset += written
+
+
+def _object_digest(s3_key: str) -> Optional[bytes]:
+    # object ids are sha256 hex: kept as 32 bytes, a million fit in ~70 MB
+    if not s3_key.startswith(OBJECTS_PREFIX):
+        return None
+    try:
+        return bytes.fromhex(s3_key.rsplit("/", 1)[1])
+    except ValueError:
+        return None
+
+
+def _object_key(digest: bytes) -> str:
+    object_id = digest.hex()
+    return f"{OBJECTS_PREFIX}{object_id[:2]}/{object_id}"
+
+
+def _object_size(response: dict, received: int) -> int:
+    # "bytes 0-99/1234"; a server that ignored the range sent the whole object
+    content_range = response.get("ContentRange")
+    if not content_range:
+        return received
+    return int(content_range.rsplit("/", 1)[1])
+
+
+class UploadError(RuntimeError):
+    pass
+
 
 class CloudManager:
-    def __init__(self, endpoint, access_key, secret_key, bucket_name):
+    def __init__(
+        self,
+        endpoint,
+        access_key,
+        secret_key,
+        bucket_name,
+        index_path=None,
+        max_connections=DEFAULT_MAX_CONNECTIONS,
+        part_size=DEFAULT_PART_SIZE,
+        transfer_concurrency=DEFAULT_TRANSFER_CONCURRENCY,
+        journal_path=None,
+    ):
+        """max_connections sizes the HTTP connection pool: at least the number
+        of threads using the client at once (upload or fetch workers, times
+        transfer_concurrency for large objects). Objects larger than part_size
+        are uploaded and downloaded in parts, transfer_concurrency at a time.
+        journal_path keeps multipart upload ids, so that an interrupted
+        upload is continued by the next run (upload_journal.py); the bytes
+        of those uploads are kept in the directory next to it, named like
+        the journal without its suffix."""
         self.s3 = boto3.client(
             "s3",
             endpoint_url=endpoint,
@@ -20,12 +136,21 @@ class CloudManager:
             aws_secret_access_key=secret_key,
             config=Config(
                 connect_timeout=5,
-                read_timeout=10,
-                retries={"max_attempts": 1},
+                read_timeout=READ_TIMEOUT,
+                retries={"max_attempts": RETRY_ATTEMPTS, "mode": "adaptive"},
+                max_pool_connections=max(max_connections, DEFAULT_MAX_CONNECTIONS),
             ),
         )
 
         self.bucket = bucket_name
+        self.part_size = part_size
+        self.transfer_concurrency = transfer_concurrency
+        self.journal = UploadJournal(journal_path) if journal_path else None
+        self.resume_dir = Path(journal_path).with_suffix("") if journal_path else None
+        # Ids of the objects in the bucket, once load_object_listing has run
+        self._listed: Optional[set[bytes]] = None
+        # Local record of uploaded objects, saves a HEAD request per object
+        self.index = ObjectIndex(index_path) if index_path else None
         self._ensure_bucket()
 
     def _ensure_bucket(self):
@@ -37,45 +162,344 @@ class CloudManager:
             except (ClientError, OSError) as e:
                 print(f"[!] Connection error to MinIO: {e}")
 
-    def get_last_manifest(self, project_name):
-        """Downloads the most recent manifest to check the parameters"""
+    def get_last_manifest(self, project_name, local_base: Path):
+        """Downloads the most recent manifest to check the parameters.
+        It is streamed to its version directory under local_base (mirroring
+        backups/), where it stays as the local copy of that snapshot."""
         manifests = self.list_manifests(project_name)
         if not manifests:
             return None
 
         last_key = manifests[-1]
+        local_path = local_base / last_key.replace("backups/", "", 1)
         try:
-            data = self.download_data(last_key)
-            return json.loads(data), last_key
-        except (ClientError, json.JSONDecodeError) as e:
+            local_path.parent.mkdir(parents=True, exist_ok=True)
+            self.download_file(last_key, local_path)
+            return open_manifest(local_path.parent), last_key
+        except (ClientError, OSError, ValueError) as e:
             logger.warning(f"Failed to load manifest {last_key}: {e}")
             return None
 
-    def upload_data(self, rel_path: str, data: bytes):
+    def load_object_listing(self, workers: int = LISTING_WORKERS) -> int:
+        """Lists the objects of the bucket, one paginated listing per objects/xx/
+        prefix, workers prefixes at a time. Until this CloudManager is dropped,
+        existence checks of objects are answered from the listing, without a
+        HEAD request per object. The listing is authoritative: the index is
+        brought in line with it, dropping objects removed from the bucket.
+        Returns the number of objects."""
+
+        def list_prefix(prefix: str) -> set[bytes]:
+            paginator = self.s3.get_paginator("list_objects_v2")
+            return {
+                digest
+                for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix)
+                for obj in page.get("Contents", [])
+                if (digest := _object_digest(obj["Key"])) is not None
+            }
+
+        listed: set[bytes] = set()
+        with ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="listing"
+        ) as pool:
+            for digests in pool.map(list_prefix, OBJECT_PREFIXES):
+                listed |= digests
+        self._listed = listed
+        if self.index is not None:
+            self.index.replace_prefix(OBJECTS_PREFIX, map(_object_key, listed))
+        return len(listed)
+
+    def _in_listing(self, s3_key: str) -> Optional[bool]:
+        """Whether the listing holds s3_key; None without a listing or for
+        keys it does not cover."""
+        if self._listed is None:
+            return None
+        digest = _object_digest(s3_key)
+        return None if digest is None else digest in self._listed
+
+    def _head(self, s3_key: str) -> bool:
+        try:
+            self.s3.head_object(Bucket=self.bucket, Key=s3_key)
+            return True
+        except ClientError:
+            return False
+
+    def has_object(self, rel_path: Path) -> bool:
+        """Whether an object is in the bucket, from the listing or the index.
+        Without a listing, a key the index misses is checked again by
+        upload_data before anything is sent; without an index either, by HEAD."""
+        s3_key = f"backups/{str(rel_path).replace(os.sep, '/')}"
+        listed = self._in_listing(s3_key)
+        if listed is not None:
+            return listed
+        indexed = self.index is not None and s3_key.startswith(INDEXED_PREFIXES)
+        if indexed and s3_key in self.index:
+            return True
+        return False if indexed else self._head(s3_key)
+
+    def object_size(self, rel_path: Path) -> Optional[int]:
+        """Size of an object in the bucket (HEAD), None if it is not there."""
+        s3_key = f"backups/{str(rel_path).replace(os.sep, '/')}"
+        try:
+            return self.s3.head_object(Bucket=self.bucket, Key=s3_key)["ContentLength"]
+        except ClientError:
+            return None
+
+    def upload_data(
+        self,
+        rel_path: str,
+        data: bytes | Path,
+        quiet: bool = False,
+        discard: bool = False,
+    ) -> bool:
+        """Uploads bytes, or streams a local file if data is a Path. Returns
+        False if the object was already in the bucket. quiet is used by upload
+        workers: no progress output, one connection per upload.
+        Objects larger than part_size are sent as multipart uploads. With
+        discard, data is a temporary file the caller deletes afterwards; a
+        multipart upload may move it to resume_dir first, to keep it until
+        the upload is completed."""
         s3_key = f"backups/{str(rel_path).replace(os.sep, '/')}"
 
         extra_args = (
             {"ContentType": "application/json"} if s3_key.endswith(".json") else {}
         )
-        try:
-            # Checking if there is already such an object
-            self.s3.head_object(Bucket=self.bucket, Key=s3_key)
-        except ClientError:
-            data_size = len(data)
-            file_obj = BytesIO(data)
+        indexed = self.index is not None and s3_key.startswith(INDEXED_PREFIXES)
+        # Checking if there is already such an object: the listing, when
+        # loaded, is trusted over the index
+        exists = self._in_listing(s3_key)
+        if exists is None:
+            if indexed and s3_key in self.index:
+                return False
+            exists = self._head(s3_key)
+        if exists:
+            if indexed:
+                self.index.add(s3_key)
+            return False
+        data_size = data.stat().st_size if isinstance(data, Path) else len(data)
 
+        if not quiet:
             print(f"\n[CLOUD] Uploading {rel_path.name}...")
-
-            self.s3.upload_fileobj(
-                file_obj,
-                self.bucket,
+        if data_size > self.part_size:
+            self._upload_multipart(
                 s3_key,
-                ExtraArgs=extra_args,
-                Callback=lambda bytes_transferred: self._show_upload_progress(
-                    bytes_transferred, data_size
-                ),
+                data,
+                data_size,
+                extra_args,
+                on_part=None if quiet else self._part_progress(data_size),
+                discard=discard,
             )
+        else:
+            file_obj = open(data, "rb") if isinstance(data, Path) else BytesIO(data)
+            with file_obj:
+                if quiet:
+                    self.s3.upload_fileobj(
+                        file_obj,
+                        self.bucket,
+                        s3_key,
+                        ExtraArgs=extra_args,
+                        Config=_ONE_CONNECTION,
+                    )
+                else:
+                    self.s3.upload_fileobj(
+                        file_obj,
+                        self.bucket,
+                        s3_key,
+                        ExtraArgs=extra_args,
+                        Callback=lambda bytes_transferred: self._show_upload_progress(
+                            bytes_transferred, data_size
+                        ),
+                    )
+        if not quiet:
             print("\n   [OK] Uploaded.")
+        if indexed:
+            self.index.add(s3_key)
+        digest = _object_digest(s3_key)
+        if self._listed is not None and digest is not None:
+            self._listed.add(digest)
+        return True
+
+    def _upload_multipart(
+        self,
+        s3_key: str,
+        data: bytes | Path,
+        size: int,
+        extra_args: dict,
+        on_part: Optional[Callable[[int], None]] = None,
+        discard: bool = False,
+    ) -> None:
+        """Uploads data in parts of part_size, transfer_concurrency at a time.
+        With a journal, the bytes are first kept in resume_dir (a file with
+        discard is moved there, bytes are written there) and journaled with
+        the upload id. An upload of s3_key left by an interrupted run is
+        continued from its kept file, whatever data holds now: parts the
+        bucket holds with the same content (MD5 ETag) are not sent again."""
+        part_size = self.part_size
+        pending = self.journal.get(s3_key) if self.journal is not None else None
+        if pending is not None and not self._can_resume(pending, data):
+            self._abort_upload(pending)
+            pending = None
+        upload_id, uploaded = None, {}
+        if pending is not None:
+            # the object encoded anew may differ (nonces, padding): the parts
+            # sent so far only match the bytes they were read from
+            source = Path(pending.source) if pending.source else data
+            size, part_size = pending.size, pending.part_size
+            upload_id, uploaded = self._resumable_upload(pending)
+        elif self.journal is not None:
+            source = self._keep(s3_key, data, discard)
+        else:
+            source = data
+        if upload_id is None:
+            upload_id = self.s3.create_multipart_upload(
+                Bucket=self.bucket, Key=s3_key, **extra_args
+            )["UploadId"]
+            if self.journal is not None:
+                self.journal.start(
+                    PendingUpload(
+                        s3_key,
+                        upload_id,
+                        part_size,
+                        size,
+                        str(source) if isinstance(source, Path) else None,
+                    )
+                )
+        read_lock = threading.Lock()
+
+        def send(number: int) -> dict:
+            offset = (number - 1) * part_size
+            with read_lock:
+                f.seek(offset)
+                body = f.read(min(part_size, size - offset))
+            etag = uploaded.get(number)
+            md5 = hashlib.md5(body, usedforsecurity=False).hexdigest()
+            if etag is None or etag.strip('"') != md5:
+                etag = self.s3.upload_part(
+                    Bucket=self.bucket,
+                    Key=s3_key,
+                    UploadId=upload_id,
+                    PartNumber=number,
+                    Body=body,
+                )["ETag"]
+            if on_part:
+                on_part(len(body))
+            return {"PartNumber": number, "ETag": etag}
+
+        with open(source, "rb") if isinstance(source, Path) else BytesIO(source) as f:
+            parts = self._for_each_part(send, range(1, -(-size // part_size) + 1))
+        self.s3.complete_multipart_upload(
+            Bucket=self.bucket,
+            Key=s3_key,
+            UploadId=upload_id,
+            MultipartUpload={"Parts": parts},
+        )
+        if self.journal is not None:
+            self.journal.finish(s3_key)
+            self._drop_kept(source)
+
+    def _can_resume(self, pending: PendingUpload, data: bytes | Path) -> bool:
+        """Whether the bytes a journaled upload was started with are still at
+        hand: its kept file, or data itself if nothing was kept (a file of the
+        caller, which stays in place)."""
+        if pending.source is None:
+            size = data.stat().st_size if isinstance(data, Path) else len(data)
+            return pending.part_size == self.part_size and pending.size == size
+        try:
+            return Path(pending.source).stat().st_size == pending.size
+        except FileNotFoundError:
+            return False
+
+    def _keep(self, s3_key: str, data: bytes | Path, discard: bool) -> bytes | Path:
+        """Moves a temporary file, or writes bytes, to resume_dir. A file of
+        the caller (no discard) stays where it is."""
+        if isinstance(data, Path) and not discard:
+            return data
+        self.resume_dir.mkdir(parents=True, exist_ok=True)
+        kept = self.resume_dir / s3_key.removeprefix("backups/").replace("/", "-")
+        if isinstance(data, Path):
+            # a rename, unless the temporary directory is on another filesystem
+            shutil.move(data, kept)
+        else:
+            kept.write_bytes(data)
+        return kept
+
+    def _drop_kept(self, source: bytes | Path) -> None:
+        if isinstance(source, Path) and source.parent == self.resume_dir:
+            source.unlink(missing_ok=True)
+
+    def _resumable_upload(self, pending: PendingUpload) -> tuple[Optional[str], dict]:
+        """Upload id and {part number: ETag} of a journaled upload,
+        (None, {}) if it can no longer be continued."""
+        try:
+            paginator = self.s3.get_paginator("list_parts")
+            parts = {
+                part["PartNumber"]: part["ETag"]
+                for page in paginator.paginate(
+                    Bucket=self.bucket, Key=pending.key, UploadId=pending.upload_id
+                )
+                for part in page.get("Parts", [])
+            }
+        except ClientError as e:
+            # aborted meanwhile, or expired by a bucket lifecycle rule
+            logger.info(f"Upload of {pending.key} cannot be continued: {e}")
+            return None, {}
+        logger.info(
+            f"Continuing upload of {pending.key}: {len(parts)} parts already sent"
+        )
+        return pending.upload_id, parts
+
+    def _abort_upload(self, pending: PendingUpload) -> None:
+        try:
+            self.s3.abort_multipart_upload(
+                Bucket=self.bucket, Key=pending.key, UploadId=pending.upload_id
+            )
+        except ClientError as e:
+            logger.info(f"Upload of {pending.key} was already gone: {e}")
+        self.journal.finish(pending.key)
+        if pending.source:
+            self._drop_kept(Path(pending.source))
+
+    def abort_pending_uploads(self) -> int:
+        """Aborts the journaled uploads no run continued, e.g. of packs (their
+        ids are new in every run) or of files deleted since. Call it after a
+        successful backup. Returns the number of aborted uploads."""
+        if self.journal is None:
+            return 0
+        pending = self.journal.pending()
+        for upload in pending:
+            self._abort_upload(upload)
+        if self.resume_dir.is_dir():
+            # kept by uploads that ended just before a crash
+            for orphan in self.resume_dir.iterdir():
+                orphan.unlink(missing_ok=True)
+        return len(pending)
+
+    def _for_each_part(self, fn: Callable, items: Iterable) -> list:
+        """[fn(item) for item in items], transfer_concurrency at a time.
+        Raises the first failure."""
+        items = list(items)
+        if self.transfer_concurrency == 1 or len(items) < 2:
+            return [fn(item) for item in items]
+        with ThreadPoolExecutor(
+            max_workers=self.transfer_concurrency, thread_name_prefix="transfer"
+        ) as pool:
+            return list(pool.map(fn, items))
+
+    def uploader(self, workers: int) -> "UploadQueue":
+        """Upload stage for create_backup's after_obj_created hook."""
+        return UploadQueue(self, workers)
+
+    def _part_progress(self, total: int) -> Callable[[int], None]:
+        """Progress bar callback for the parts of one upload, sent in any order."""
+        lock = threading.Lock()
+        sent = 0
+
+        def on_part(size: int) -> None:
+            nonlocal sent
+            with lock:
+                sent += size
+                self._show_upload_progress(sent, total)
+
+        return on_part
 
     def _show_upload_progress(self, transmitted, total):
         scale_width = 30
@@ -92,10 +516,119 @@ class CloudManager:
         response = self.s3.get_object(Bucket=self.bucket, Key=s3_path)
         return response["Body"].read()
 
-    def download_objects(self, rel_path: Path) -> bytes:
-        """Accepts a relative Path and downloads it from a folder backups/"""
+    def download_objects(
+        self, rel_path: Path, byte_range: tuple[int, int] | None = None
+    ) -> bytes | BinaryIO:
+        """Accepts a relative Path and downloads it from a folder backups/.
+        byte_range (offset, length) fetches only that part, used for packed objects.
+        An object larger than part_size is returned as a temporary file open
+        at its start, filled by parallel ranged GETs; anything smaller as bytes."""
         s3_key = f"backups/{str(rel_path).replace(os.sep, '/')}"
-        return self.download_data(s3_key)
+        if byte_range is not None:
+            offset, length = byte_range
+
+            def get_range() -> bytes:
+                response = self.s3.get_object(
+                    Bucket=self.bucket,
+                    Key=s3_key,
+                    Range=f"bytes={offset}-{offset + length - 1}",
+                )
+                return response["Body"].read()
+
+            return _retry(get_range, f"Download of {s3_key}")
+        first, size = self._first_part(s3_key)
+        if size <= len(first):
+            return first
+        f = tempfile.TemporaryFile(prefix=".download-")
+        try:
+            self._download_rest(s3_key, f, first, size)
+        except BaseException:
+            f.close()
+            raise
+        return f
+
+    def download_file(self, s3_key: str, dest: Path) -> int:
+        """Downloads s3_key to dest with parallel ranged GETs written straight
+        to the file. dest is replaced only once complete. Returns the size."""
+        part = dest.with_name(f".{dest.name}.part")
+        try:
+            with open(part, "wb") as f:
+                first, size = self._first_part(s3_key)
+                self._download_rest(s3_key, f, first, size)
+            os.replace(part, dest)
+        finally:
+            part.unlink(missing_ok=True)
+        return size
+
+    def _first_part(self, s3_key: str) -> tuple[bytes, int]:
+        """The first part of an object and the size of the whole object."""
+
+        def get_first() -> tuple[bytes, int]:
+            try:
+                response = self.s3.get_object(
+                    Bucket=self.bucket,
+                    Key=s3_key,
+                    Range=f"bytes=0-{self.part_size - 1}",
+                )
+            except ClientError as e:
+                if e.response.get("Error", {}).get("Code") != "InvalidRange":
+                    raise
+                # an empty object has no byte 0
+                return b"", 0
+            data = response["Body"].read()
+            return data, _object_size(response, len(data))
+
+        return _retry(get_first, f"Download of {s3_key}")
+
+    def _download_rest(self, s3_key: str, f: BinaryIO, first: bytes, size: int) -> None:
+        """Writes first at the start of f, then the remaining parts, fetched by
+        transfer_concurrency threads. Each thread holds one DOWNLOAD_BLOCK."""
+        f.flush()
+        _write_at(f, first, 0)
+
+        def fetch(start: int) -> None:
+            end = min(start + self.part_size, size)
+            response = self.s3.get_object(
+                Bucket=self.bucket, Key=s3_key, Range=f"bytes={start}-{end - 1}"
+            )
+            offset = start
+            for block in response["Body"].iter_chunks(DOWNLOAD_BLOCK):
+                _write_at(f, block, offset)
+                offset += len(block)
+            if offset != end:
+                raise IncompleteReadError(
+                    actual_bytes=offset - start, expected_bytes=end - start
+                )
+
+        self._for_each_part(
+            lambda start: _retry(lambda: fetch(start), f"Download of {s3_key}"),
+            range(len(first), size, self.part_size),
+        )
+        f.seek(0)
+
+    def rebuild_index(self) -> int:
+        """Re-creates the local object index from a bucket listing.
+        Returns the number of indexed keys."""
+        if self.index is None:
+            raise ValueError("CloudManager was created without an index_path")
+        paginator = self.s3.get_paginator("list_objects_v2")
+        keys = (
+            obj["Key"]
+            for prefix in INDEXED_PREFIXES
+            for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix)
+            for obj in page.get("Contents", [])
+        )
+        return self.index.replace_all(keys)
+
+    def list_pack_indexes(self) -> list[str]:
+        """Keys of all pack indexes (backups/packs/*.idx)."""
+        paginator = self.s3.get_paginator("list_objects_v2")
+        keys = []
+        for page in paginator.paginate(Bucket=self.bucket, Prefix="backups/packs/"):
+            for obj in page.get("Contents", []):
+                if obj["Key"].endswith(".idx"):
+                    keys.append(obj["Key"])
+        return sorted(keys)
 
     def list_manifests(self, project_name=None):
         if project_name:
@@ -108,6 +641,115 @@ class CloudManager:
         manifests = []
         for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
             for obj in page.get("Contents", []):
-                if obj["Key"].endswith("manifest.json"):
+                if is_manifest_name(obj["Key"]):
                     manifests.append(obj["Key"])
         return sorted(manifests)
+
+
+class UploadQueue:
+    """Uploads objects with a pool of workers sharing the client's connections.
+
+    Called as after_obj_created(rel_path, data, discard=False); with discard,
+    data is a temporary file deleted once uploaded or dropped, or kept for the
+    next run if its multipart upload is interrupted. A call blocks
+    while workers * QUEUE_DEPTH_PER_WORKER uploads are queued, so a fast backup
+    never holds more than that many objects in memory. Ordering the bucket
+    layout relies on is kept: a pack index is uploaded after its pack, and a
+    manifest only once every object submitted before it is uploaded.
+    Leaving the with block waits for the uploads in flight.
+    """
+
+    def __init__(self, cloud: CloudManager, workers: int):
+        self._cloud = cloud
+        self._pool = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="upload"
+        )
+        self._slots = threading.BoundedSemaphore(workers * QUEUE_DEPTH_PER_WORKER)
+        self._lock = threading.Lock()
+        self._pending: set[Future] = set()
+        self._packs: dict[Path, Future] = {}
+        self._errors: list[str] = []
+        self.uploaded = 0
+        self.bytes_uploaded = 0
+
+    def __call__(
+        self, rel_path: Path, data: bytes | Path, discard: bool = False
+    ) -> None:
+        if is_manifest_name(str(rel_path)):
+            # the manifest makes the snapshot visible: everything it refers to goes first
+            self.wait()
+            self._upload(rel_path, data, quiet=False, discard=discard)
+            return
+        pack = None
+        if rel_path.suffix == ".idx":
+            # an index waits for its pack, queued first and so already running
+            pack = self._packs.pop(rel_path.with_suffix(".pack"), None)
+        self._slots.acquire()
+        try:
+            future = self._pool.submit(
+                self._upload_after, pack, rel_path, data, discard
+            )
+        except BaseException:
+            self._slots.release()
+            if discard:
+                data.unlink(missing_ok=True)
+            raise
+        with self._lock:
+            self._pending.add(future)
+        future.add_done_callback(
+            lambda f: self._finished(f, rel_path, data if discard else None)
+        )
+        if rel_path.suffix == ".pack":
+            self._packs[rel_path] = future
+
+    def _upload_after(
+        self, pack: Optional[Future], rel_path: Path, data: bytes | Path, discard: bool
+    ) -> None:
+        if pack is not None and pack.exception() is not None:
+            raise UploadError("its pack was not uploaded")
+        self._upload(rel_path, data, quiet=True, discard=discard)
+
+    def _upload(
+        self, rel_path: Path, data: bytes | Path, quiet: bool, discard: bool = False
+    ) -> None:
+        size = data.stat().st_size if isinstance(data, Path) else len(data)
+        if self._cloud.upload_data(rel_path, data, quiet=quiet, discard=discard):
+            with self._lock:
+                self.uploaded += 1
+                self.bytes_uploaded += size
+
+    def _finished(
+        self, future: Future, rel_path: Path, temp_file: Optional[Path] = None
+    ) -> None:
+        if temp_file is not None:
+            temp_file.unlink(missing_ok=True)
+        with self._lock:
+            self._pending.discard(future)
+            if not future.cancelled() and future.exception() is not None:
+                self._errors.append(f"{rel_path}: {future.exception()}")
+                logger.error(f"Upload of {rel_path} failed: {future.exception()}")
+        self._slots.release()
+
+    def wait(self) -> None:
+        """Blocks until every queued upload is finished. Raises UploadError if
+        any of them failed."""
+        with self._lock:
+            pending = list(self._pending)
+        wait(pending)
+        with self._lock:
+            errors, self._errors = self._errors, []
+        if errors:
+            raise UploadError(f"{len(errors)} uploads failed, first: {errors[0]}")
+
+    def __enter__(self) -> "UploadQueue":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if exc_type is not None:
+            # the backup failed: queued uploads are dropped, running ones finish
+            self._pool.shutdown(wait=True, cancel_futures=True)
+            return
+        try:
+            self.wait()
+        finally:
+            self._pool.shutdown(wait=True)
@@ -0,0 +1,89 @@
+"""Content-based decision whether compressing a file pays off.
+
+A few blocks spread over the file are trial-compressed with fast zlib; if they
+shrink by less than MIN_SAVING, the file is stored uncompressed. Already
+compressed data (media, archives, encrypted blobs) is detected whatever its
+extension, and well compressible archives such as .tar are compressed.
+Once CONFIRM_SAMPLES files of an extension agree, the rest of the run reuses
+the decision for that extension without sampling.
+"""
+
+import logging
+import os
+import zlib
+from pathlib import Path
+
+SAMPLE_BLOCK = 16 * 1024
+SAMPLE_BLOCKS = 3  # start, middle and end of the file
+# Smaller files are compressed without sampling: the trial would cost as much
+MIN_SAMPLED_SIZE = 4 * 1024
+MIN_SAVING = 0.1
+CONFIRM_SAMPLES = 3
+
+logger = logging.getLogger(__name__)
+
+
+def read_sample(path: Path) -> bytes:
+    """Up to SAMPLE_BLOCKS blocks of SAMPLE_BLOCK bytes, evenly spread."""
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size <= SAMPLE_BLOCK * SAMPLE_BLOCKS:
+            return f.read()
+        step = (size - SAMPLE_BLOCK) // (SAMPLE_BLOCKS - 1)
+        blocks = []
+        for n in range(SAMPLE_BLOCKS):
+            f.seek(n * step)
+            blocks.append(f.read(SAMPLE_BLOCK))
+        return b"".join(blocks)
+
+
+def estimated_saving(sample: bytes) -> float:
+    """Share of the sample removed by fast zlib, 0.0 (or less) for no gain."""
+    if not sample:
+        return 0.0
+    return 1 - len(zlib.compress(sample, 1)) / len(sample)
+
+
+class CompressibilityDetector:
+    """Decides per file whether to compress it. One detector is used per run."""
+
+    def __init__(self, min_saving: float = MIN_SAVING):
+        self.min_saving = min_saving
+        self.sampled = 0
+        self._votes: dict[str, list[bool]] = {}
+        self._decided: dict[str, bool] = {}
+        self._mixed: set[str] = set()
+
+    def is_compressible(self, path: Path, size: int | None = None) -> bool:
+        ext = path.suffix.lower()
+        if ext in self._decided:
+            return self._decided[ext]
+        if size is not None and size < MIN_SAMPLED_SIZE:
+            return True
+        try:
+            sample = read_sample(path)
+        except OSError:
+            return True  # the real read reports the error
+        if len(sample) < MIN_SAMPLED_SIZE:
+            return True
+        self.sampled += 1
+        decision = estimated_saving(sample) >= self.min_saving
+        if ext:
+            self._vote(ext, decision)
+        return decision
+
+    def _vote(self, ext: str, decision: bool) -> None:
+        if ext in self._mixed:
+            return
+        votes = self._votes.setdefault(ext, [])
+        votes.append(decision)
+        if any(v != decision for v in votes):
+            # mixed content under one extension: every file is sampled
+            self._mixed.add(ext)
+            del self._votes[ext]
+        elif len(votes) >= CONFIRM_SAMPLES:
+            self._decided[ext] = decision
+            del self._votes[ext]
+            logger.debug(
+                f"{ext} files are {'' if decision else 'not '}compressed for the rest of the run"
+            )
@@ -0,0 +1,243 @@
+"""Compression codecs for framed objects.
+
+A codec turns the plaintext stream of a file into the payload of its frames
+(frames.py). The codec name is part of the object id and, with the level,
+recorded in the manifest entry, so every object is decoded with the codec it
+was written with. zlib needs no extra package; zstd and lz4 are used when the
+zstandard / lz4 packages are installed (pip install smart-backup[codecs]).
+"""
+
+import zlib
+from abc import ABC, abstractmethod
+from typing import Iterable, Iterator, Optional
+
+try:
+    import zstandard
+except ImportError:  # optional dependency
+    zstandard = None
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:  # optional dependency
+    lz4_frame = None
+
+DEFAULT_CODEC = "zlib"
+# Limits the output of one decompress call, protects against zip bombs
+DECOMPRESS_CHUNK = 4 * 1024 * 1024
+
+
+class CorruptStreamError(ValueError):
+    pass
+
+
+class CodecUnavailableError(RuntimeError):
+    pass
+
+
+class Codec(ABC):
+    name = ""
+    default_level: Optional[int] = None
+    min_level = 0
+    max_level = 0
+
+    def __init__(self, level: Optional[int] = None):
+        if level is None:
+            level = self.default_level
+        if level is not None and not self.min_level <= level <= self.max_level:
+            raise ValueError(
+                f"{self.name} level must be between {self.min_level} and {self.max_level}"
+            )
+        self.level = level
+
+    @property
+    def label(self) -> str:
+        """Name and level as shown in the run summary and accepted by --codec."""
+        return self.name if self.level is None else f"{self.name}:{self.level}"
+
+    @abstractmethod
+    def compressor(self):
+        """Streaming compressor with compress(data) and flush()."""
+
+    @abstractmethod
+    def iter_decompress(self, chunks: Iterable[bytes]) -> Iterator[bytes]:
+        """Decompresses a stream given in chunks, yielding at most DECOMPRESS_CHUNK
+        bytes at a time."""
+
+    def __repr__(self) -> str:
+        return f"<Codec {self.label}>"
+
+
+class ZlibCodec(Codec):
+    name = "zlib"
+    default_level = 6
+    min_level = 1
+    max_level = 9
+
+    def compressor(self):
+        return zlib.compressobj(self.level)
+
+    def iter_decompress(self, chunks: Iterable[bytes]) -> Iterator[bytes]:
+        decompressor = zlib.decompressobj()
+        for payload in chunks:
+            while payload:
+                try:
+                    chunk = decompressor.decompress(payload, DECOMPRESS_CHUNK)
+                except zlib.error as e:
+                    raise CorruptStreamError(
+                        f"Compressed stream is damaged: {e}"
+                    ) from e
+                payload = decompressor.unconsumed_tail
+                if chunk:
+                    yield chunk
+        tail = decompressor.flush()
+        if not decompressor.eof:
+            raise CorruptStreamError("Compressed stream is incomplete")
+        if tail:
+            yield tail
+
+
+class _ChunkReader:
+    """File-like view of an iterable of chunks, for stream decompressors."""
+
+    def __init__(self, chunks: Iterable[bytes]):
+        self._chunks = iter(chunks)
+        self._buffer = b""
+
+    def read(self, size: int = -1) -> bytes:
+        while size < 0 or len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+class ZstdCodec(Codec):
+    name = "zstd"
+    default_level = 3
+    min_level = 1
+    max_level = 22
+
+    def compressor(self):
+        _require(zstandard, self.name, "zstandard")
+        return zstandard.ZstdCompressor(
+            level=self.level, write_checksum=True
+        ).compressobj()
+
+    def iter_decompress(self, chunks: Iterable[bytes]) -> Iterator[bytes]:
+        _require(zstandard, self.name, "zstandard")
+        # read_to_iter bounds every output chunk; a cut-off stream is caught
+        # by the final frame flag and the content hash checked on restore
+        reader = zstandard.ZstdDecompressor().read_to_iter(
+            _ChunkReader(chunks), write_size=DECOMPRESS_CHUNK
+        )
+        try:
+            for chunk in reader:
+                if chunk:
+                    yield chunk
+        except zstandard.ZstdError as e:
+            raise CorruptStreamError(f"Compressed stream is damaged: {e}") from e
+
+
+class Lz4Codec(Codec):
+    name = "lz4"
+    default_level = 0
+    min_level = 0
+    max_level = 16
+
+    def compressor(self):
+        _require(lz4_frame, self.name, "lz4")
+        return _Lz4Compressor(self.level)
+
+    def iter_decompress(self, chunks: Iterable[bytes]) -> Iterator[bytes]:
+        _require(lz4_frame, self.name, "lz4")
+        decompressor = lz4_frame.LZ4FrameDecompressor()
+        for payload in chunks:
+            if not payload or decompressor.eof:
+                continue
+            yield from self._drain(decompressor, payload)
+        if not decompressor.eof:
+            raise CorruptStreamError("Compressed stream is incomplete")
+
+    @staticmethod
+    def _drain(decompressor, payload: bytes) -> Iterator[bytes]:
+        try:
+            chunk = decompressor.decompress(payload, max_length=DECOMPRESS_CHUNK)
+            if chunk:
+                yield chunk
+            # output was capped: the rest of the input is buffered inside
+            while not decompressor.needs_input and not decompressor.eof:
+                chunk = decompressor.decompress(b"", max_length=DECOMPRESS_CHUNK)
+                if chunk:
+                    yield chunk
+        except RuntimeError as e:
+            raise CorruptStreamError(f"Compressed stream is damaged: {e}") from e
+
+
+class _Lz4Compressor:
+    def __init__(self, level: int):
+        self._compressor = lz4_frame.LZ4FrameCompressor(compression_level=level)
+        self._header = self._compressor.begin()
+
+    def compress(self, data: bytes) -> bytes:
+        out = self._header + self._compressor.compress(data)
+        self._header = b""
+        return out
+
+    def flush(self) -> bytes:
+        return self._header + self._compressor.flush()
+
+
+CODECS: dict[str, type[Codec]] = {
+    codec.name: codec for codec in (ZlibCodec, ZstdCodec, Lz4Codec)
+}
+
+
+def _require(module, codec_name: str, package: str) -> None:
+    if module is None:
+        raise CodecUnavailableError(
+            f"Codec {codec_name} needs the {package} package (pip install {package})"
+        )
+
+
+def is_available(name: str) -> bool:
+    return {"zstd": zstandard, "lz4": lz4_frame}.get(name, zlib) is not None
+
+
+def get_codec(name: str, level: Optional[int] = None) -> Optional[Codec]:
+    """Codec by name; None for "none". Raises ValueError for an unknown name or
+    level, CodecUnavailableError if its package is not installed."""
+    name = name.strip().lower()
+    if name == "none":
+        return None
+    if name not in CODECS:
+        raise ValueError(
+            f"Unknown codec {name!r}, expected one of: none, {', '.join(CODECS)}"
+        )
+    if not is_available(name):
+        _require(None, name, "zstandard" if name == "zstd" else name)
+    return CODECS[name](level)
+
+
+def parse_codec(spec: str) -> Optional[Codec]:
+    """Parses "name" or "name:level", e.g. "zstd:19"."""
+    name, _, level = spec.partition(":")
+    if level and not level.isdigit():
+        raise ValueError(f"Invalid codec level {level!r}")
+    return get_codec(name, int(level) if level else None)
+
+
+def for_entry(entry: dict) -> Optional[Codec]:
+    """Codec a manifest entry was written with. Entries written before codecs
+    were recorded are zlib."""
+    if not entry.get("compressed"):
+        return None
+    name = entry.get("codec", DEFAULT_CODEC)
+    # The level is informational: no codec needs it to decompress
+    codec = CODECS.get(name)
+    if codec is None:
+        raise ValueError(f"Unknown codec {name!r} in manifest")
+    return codec()
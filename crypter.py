@@ -1,7 +1,14 @@
+import atexit
+import hashlib
+import hmac
 import os
+import threading
+import time
 from cryptography.hazmat.primitives.ciphers.aead import ChaCha20Poly1305
 from argon2.low_level import hash_secret_raw, Type
 
+KEY_CHECK_LABEL = b"smart-backup/key-check/v1"
+
 
 class FileCrypter:
     _TIME_COST = 3
@@ -19,23 +26,167 @@ class FileCrypter:
         parallelism: int = None,
     ):
         self.salt = salt or os.urandom(self._SALT_LEN)
-        self.key = hash_secret_raw(
+        self.key = self.derive_key(
+            password, self.salt, *self.kdf_params(time_cost, memory_cost, parallelism)
+        )
+        self.aead = ChaCha20Poly1305(self.key)
+
+    @classmethod
+    def kdf_params(
+        cls, time_cost: int = None, memory_cost: int = None, parallelism: int = None
+    ) -> tuple[int, int, int]:
+        """Argon2id parameters with the defaults filled in."""
+        return (
+            time_cost or cls._TIME_COST,
+            memory_cost or cls._MEMORY_COST,
+            parallelism or cls._PARALLELISM,
+        )
+
+    @classmethod
+    def derive_key(
+        cls,
+        password: str,
+        salt: bytes,
+        time_cost: int,
+        memory_cost: int,
+        parallelism: int,
+    ) -> bytes:
+        return hash_secret_raw(
             secret=password.encode("utf-8"),
-            salt=self.salt,
-            time_cost=time_cost or self._TIME_COST,
-            memory_cost=memory_cost or self._MEMORY_COST,
-            parallelism=parallelism or self._PARALLELISM,
-            hash_len=self._HASH_LEN,
+            salt=salt,
+            time_cost=time_cost,
+            memory_cost=memory_cost,
+            parallelism=parallelism,
+            hash_len=cls._HASH_LEN,
             type=Type.ID,
         )
-        self.aead = ChaCha20Poly1305(self.key)
 
-    def encrypt(self, data: bytes) -> bytes:
+    @classmethod
+    def from_key(cls, key: bytes, salt: bytes) -> "FileCrypter":
+        """Crypter for an already derived key, e.g. in a worker process:
+        Argon2id runs once per backup, not once per process."""
+        crypter = cls.__new__(cls)
+        crypter.salt = salt
+        crypter.key = key
+        crypter.aead = ChaCha20Poly1305(key)
+        return crypter
+
+    def key_check(self) -> str:
+        """Commitment to the key stored in the manifest: checking a password
+        costs one HMAC instead of decrypting an object. Reveals nothing about
+        the key without the key itself."""
+        return hmac.new(bytes(self.key), KEY_CHECK_LABEL, hashlib.sha256).hexdigest()
+
+    def matches_key_check(self, token: str) -> bool:
+        return hmac.compare_digest(self.key_check(), token)
+
+    def encrypt(self, data: bytes, associated_data: bytes = None) -> bytes:
         nonce = os.urandom(12)
-        ciphertext = self.aead.encrypt(nonce, data, None)
+        ciphertext = self.aead.encrypt(nonce, data, associated_data)
         return nonce + ciphertext
 
-    def decrypt(self, encrypted_data: bytes) -> bytes:
+    def decrypt(self, encrypted_data: bytes, associated_data: bytes = None) -> bytes:
         nonce = encrypted_data[:12]
         ciphertext = encrypted_data[12:]
-        return self.aead.decrypt(nonce, ciphertext, None)
+        return self.aead.decrypt(nonce, ciphertext, associated_data)
+
+
+DEFAULT_KEY_TTL = 15 * 60
+
+
+class KeyCache:
+    """Derived keys kept in memory, keyed by (salt, KDF parameters, password digest),
+    so Argon2id runs once per unique salt and password instead of once per crypter.
+
+    Entries live for ttl seconds after their last use. Expired entries and
+    clear() overwrite the cached keys with zeros. Each crypter gets its own
+    copy of the key, so one still in use keeps working (and its key_check
+    stays right) after its entry is dropped. Password digests are HMACs
+    under a random per-cache secret: they are useless outside this process."""
+
+    def __init__(self, ttl: float = DEFAULT_KEY_TTL):
+        self.ttl = ttl
+        self._secret = os.urandom(32)
+        self._entries: dict[tuple, list] = {}  # cache key -> [key, expires_at]
+        self._lock = threading.Lock()
+
+    def crypter(
+        self,
+        password: str,
+        salt: bytes,
+        time_cost: int = None,
+        memory_cost: int = None,
+        parallelism: int = None,
+    ) -> FileCrypter:
+        params = FileCrypter.kdf_params(time_cost, memory_cost, parallelism)
+        digest = hmac.new(self._secret, password.encode("utf-8"), hashlib.sha256)
+        cache_key = (bytes(salt), params, digest.digest())
+        # Derivation runs under the lock: concurrent callers wait for one result
+        with self._lock:
+            self._evict_expired()
+            entry = self._entries.get(cache_key)
+            if entry is None:
+                key = bytearray(FileCrypter.derive_key(password, salt, *params))
+                entry = self._entries[cache_key] = [key, 0.0]
+            entry[1] = time.monotonic() + self.ttl
+            return FileCrypter.from_key(bytes(entry[0]), bytes(salt))
+
+    def clear(self) -> None:
+        """Forgets all keys and zeroizes them."""
+        with self._lock:
+            for key, _ in self._entries.values():
+                _zeroize(key)
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        with self._lock:
+            self._evict_expired()
+            return len(self._entries)
+
+    def _evict_expired(self) -> None:
+        now = time.monotonic()
+        for cache_key, (key, expires_at) in list(self._entries.items()):
+            if expires_at <= now:
+                _zeroize(key)
+                del self._entries[cache_key]
+
+
+class UnlockSession:
+    """Password and key cache for a series of operations on encrypted backups.
+
+        with UnlockSession(password) as session:
+            manager.verify_password(project, version, session=session)
+            manager.restore_version(project, version, target, session=session)
+
+    Each salt is derived once for the whole session. Leaving the block
+    (or close()) zeroizes the keys and the stored password."""
+
+    def __init__(self, password: str, ttl: float = DEFAULT_KEY_TTL):
+        self._password = bytearray(password.encode("utf-8"))
+        self.cache = KeyCache(ttl)
+        self.closed = False
+
+    def crypter(self, salt: bytes, **kdf) -> FileCrypter:
+        if self.closed:
+            raise ValueError("Unlock session is closed")
+        return self.cache.crypter(self._password.decode("utf-8"), salt, **kdf)
+
+    def close(self) -> None:
+        self.cache.clear()
+        _zeroize(self._password)
+        self.closed = True
+
+    def __enter__(self) -> "UnlockSession":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def _zeroize(buf: bytearray) -> None:
+    buf[:] = bytes(len(buf))
+
+
+# Process-wide cache used when no session is given
+DEFAULT_KEY_CACHE = KeyCache()
+atexit.register(DEFAULT_KEY_CACHE.clear)
@@ -0,0 +1,157 @@
+"""Copies files inside the kernel when the platform allows it.
+
+clone_file tries a reflink clone first (FICLONE: btrfs, XFS, bcachefs...),
+which shares the data blocks and copies nothing, then os.copy_file_range,
+which copies without passing the data through Python, then a regular copy.
+Support is detected at runtime: a method refused for a pair of filesystems
+is not tried again for that pair.
+"""
+
+import errno
+import os
+import shutil
+from pathlib import Path
+from typing import BinaryIO, Callable, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+FICLONE = 0x40049409  # _IOW(0x94, 9, int), Linux
+COPY_BLOCK = 1024 * 1024
+
+# errno values meaning "not possible here", as opposed to a real I/O error
+_NOT_SUPPORTED = {
+    errno.EOPNOTSUPP,
+    errno.ENOTTY,
+    errno.EXDEV,
+    errno.EINVAL,
+    errno.ENOSYS,
+    errno.EPERM,
+    errno.EBADF,
+}
+_refused: set[tuple[str, int, int]] = set()
+
+
+def _devices(f_src: BinaryIO, f_dst: BinaryIO) -> tuple[int, int]:
+    return os.fstat(f_src.fileno()).st_dev, os.fstat(f_dst.fileno()).st_dev
+
+
+def _try(method: str, devices: tuple[int, int], call) -> bool:
+    if (method, *devices) in _refused:
+        return False
+    try:
+        call()
+        return True
+    except OSError as e:
+        if e.errno not in _NOT_SUPPORTED:
+            raise
+        _refused.add((method, *devices))
+        return False
+
+
+def _reflink(f_src: BinaryIO, f_dst: BinaryIO) -> None:
+    if fcntl is None:
+        raise OSError(errno.ENOSYS, "reflinks need fcntl")
+    fcntl.ioctl(f_dst.fileno(), FICLONE, f_src.fileno())
+
+
+def _copy_file_range(
+    f_src: BinaryIO, f_dst: BinaryIO, offset: int = 0, length: Optional[int] = None
+) -> None:
+    if not hasattr(os, "copy_file_range"):
+        raise OSError(errno.ENOSYS, "copy_file_range is not available")
+    if length is None:
+        length = os.fstat(f_src.fileno()).st_size - offset
+    end = offset + length
+    while offset < end:
+        copied = os.copy_file_range(
+            f_src.fileno(), f_dst.fileno(), end - offset, offset_src=offset
+        )
+        if copied == 0:
+            raise OSError(errno.EIO, "Source file is shorter than expected")
+        offset += copied
+
+
+def _copy_with_python(
+    f_src: BinaryIO, f_dst: BinaryIO, offset: int = 0, length: Optional[int] = None
+) -> None:
+    # a kernel method may have failed half way: start over
+    f_src.seek(offset)
+    f_dst.seek(0)
+    f_dst.truncate()
+    if length is None:
+        shutil.copyfileobj(f_src, f_dst, COPY_BLOCK)
+        return
+    while length > 0:
+        block = f_src.read(min(length, COPY_BLOCK))
+        if not block:
+            raise OSError(errno.EIO, "Source file is shorter than expected")
+        f_dst.write(block)
+        length -= len(block)
+
+
+def copy_open_file(f_src: BinaryIO, f_dst: BinaryIO) -> str:
+    """Copies f_src into the empty f_dst; returns the method that was used."""
+    devices = _devices(f_src, f_dst)
+    if _try("reflink", devices, lambda: _reflink(f_src, f_dst)):
+        return "reflink"
+    if _try("copy_file_range", devices, lambda: _copy_file_range(f_src, f_dst)):
+        return "copy_file_range"
+    _copy_with_python(f_src, f_dst)
+    return "copy"
+
+
+def _write_then_replace(dst: Path, write: Callable[[Path], str]) -> str:
+    """Runs write(part) on a sibling of dst and moves it over dst once complete."""
+    part = dst.with_name(f".{dst.name}.part")
+    try:
+        part.unlink(missing_ok=True)
+        method = write(part)
+        os.replace(part, dst)
+        # renaming a hardlink onto another name of the same file does nothing
+        part.unlink(missing_ok=True)
+    except BaseException:
+        part.unlink(missing_ok=True)
+        raise
+    return method
+
+
+def clone_file(src: Path, dst: Path, hardlink: bool = False) -> str:
+    """Makes dst a copy of src (or, with hardlink, another name for it) and
+    returns the method used: "hardlink", "reflink", "copy_file_range" or "copy".
+    dst is replaced only once complete."""
+
+    def write(part: Path) -> str:
+        if hardlink:
+            try:
+                os.link(src, part)
+                return "hardlink"
+            except OSError as e:
+                if e.errno not in _NOT_SUPPORTED:
+                    raise
+        with open(src, "rb") as f_src, open(part, "wb") as f_dst:
+            return copy_open_file(f_src, f_dst)
+
+    return _write_then_replace(dst, write)
+
+
+def copy_range(src: Path, offset: int, length: int, dst: Path) -> str:
+    """Makes dst a copy of length bytes of src at offset, e.g. an object in a
+    pack file. Reflinks need block-aligned ranges, so the kernel copy is
+    copy_file_range. Returns "copy_file_range" or "copy"."""
+
+    def write(part: Path) -> str:
+        with open(src, "rb") as f_src, open(part, "wb") as f_dst:
+            devices = _devices(f_src, f_dst)
+            if _try(
+                "copy_file_range",
+                devices,
+                lambda: _copy_file_range(f_src, f_dst, offset, length),
+            ):
+                return "copy_file_range"
+            _copy_with_python(f_src, f_dst, offset, length)
+            return "copy"
+
+    return _write_then_replace(dst, write)
@@ -0,0 +1,170 @@
+"""Framed object format for bounded-memory compression and encryption.
+
+An object is written as MAGIC and a random object nonce, followed by frames.
+Each frame is a header (record length, flags) and a record: up to FRAME_SIZE
+bytes of the compressed stream (compressors.py), padded and, if a crypter is
+given, encrypted with ChaCha20-Poly1305. The object nonce, frame index and
+flags are authenticated, so reordered, dropped or truncated frames, and frames
+taken from another object encrypted with the same key, fail to decrypt.
+Objects written before the object nonce (MAGIC_V1) are still read.
+Peak memory is about two frames, regardless of the object size.
+"""
+
+import os
+import struct
+import time
+from typing import BinaryIO, Iterator
+
+import compressors
+
+MAGIC = b"SBF2"
+MAGIC_V1 = b"SBF1"
+OBJECT_NONCE_LEN = 16
+FRAME_SIZE = 1024 * 1024
+PAD_BLOCK = 256
+FLAG_FINAL = 0x01
+
+_HEADER = struct.Struct(">IB")
+# Record never exceeds frame + length prefix + padding + nonce + tag
+_MAX_RECORD = FRAME_SIZE + 4 + PAD_BLOCK + 12 + 16
+
+
+class CorruptObjectError(ValueError):
+    pass
+
+
+def _resolve_codec(compress):
+    """compress is a Codec, or a bool from manifests predating codecs (zlib)."""
+    if compress is True:
+        return compressors.ZlibCodec()
+    return compress or None
+
+
+def add_padding(data: bytes, block_size: int = PAD_BLOCK) -> bytes:
+    data_len = len(data).to_bytes(4, byteorder="big")
+    pad_len = block_size - (len(data) + 4) % block_size
+    padding = os.urandom(pad_len)
+    return data_len + data + padding
+
+
+def remove_padding(padded_data: bytes) -> bytes:
+    if len(padded_data) < 4:
+        return padded_data
+    data_len = int.from_bytes(padded_data[:4], byteorder="big")
+    return padded_data[4 : 4 + data_len]
+
+
+def _frame_aad(object_header: bytes, index: int, flags: int) -> bytes:
+    # object_header is everything before the first frame: MAGIC and object nonce
+    return object_header + struct.pack(">QB", index, flags)
+
+
+class FrameWriter:
+    """Compresses, pads and encrypts a plaintext stream frame by frame into out.
+    compress is a Codec, True for zlib or False. Time spent compressing is
+    recorded in stats (classes.CodecStats) if given."""
+
+    def __init__(
+        self,
+        out: BinaryIO,
+        compress,
+        crypter=None,
+        frame_size: int = FRAME_SIZE,
+        stats=None,
+    ):
+        self._out = out
+        self._crypter = crypter
+        self._frame_size = frame_size
+        codec = _resolve_codec(compress)
+        self._compressor = codec.compressor() if codec else None
+        self._stats = stats
+        self._buffer = bytearray()
+        self._index = 0
+        self._object_header = MAGIC + os.urandom(OBJECT_NONCE_LEN)
+        out.write(self._object_header)
+
+    def write(self, data: bytes) -> None:
+        if self._compressor:
+            data = self._compress(self._compressor.compress, data)
+        self._buffer += data
+        self._emit_full_frames()
+
+    def close(self) -> None:
+        if self._compressor:
+            self._buffer += self._compress(lambda _: self._compressor.flush(), b"")
+        self._emit_full_frames()
+        self._emit(bytes(self._buffer), FLAG_FINAL)
+        self._buffer.clear()
+
+    def _compress(self, step, data: bytes) -> bytes:
+        started = time.perf_counter()
+        out = step(data)
+        if self._stats is not None:
+            self._stats.record(len(data), len(out), time.perf_counter() - started)
+        return out
+
+    def _emit_full_frames(self) -> None:
+        while len(self._buffer) > self._frame_size:
+            self._emit(bytes(self._buffer[: self._frame_size]), 0)
+            del self._buffer[: self._frame_size]
+
+    def _emit(self, payload: bytes, flags: int) -> None:
+        record = add_padding(payload)
+        if self._crypter:
+            record = self._crypter.encrypt(
+                record, _frame_aad(self._object_header, self._index, flags)
+            )
+        self._out.write(_HEADER.pack(len(record), flags))
+        self._out.write(record)
+        self._index += 1
+
+
+def _read_exact(f_in: BinaryIO, size: int) -> bytes:
+    data = f_in.read(size)
+    if len(data) != size:
+        raise CorruptObjectError("Object is truncated")
+    return data
+
+
+def iter_frames(f_in: BinaryIO, crypter=None) -> Iterator[bytes]:
+    """Yields the payload of every frame. Raises on a wrong key (InvalidTag)
+    or CorruptObjectError on a damaged or truncated object."""
+    object_header = f_in.read(len(MAGIC))
+    if object_header == MAGIC:
+        object_header += _read_exact(f_in, OBJECT_NONCE_LEN)
+    elif object_header != MAGIC_V1:
+        raise CorruptObjectError("Not a framed object")
+    index = 0
+    while True:
+        record_len, flags = _HEADER.unpack(_read_exact(f_in, _HEADER.size))
+        if record_len > _MAX_RECORD:
+            raise CorruptObjectError("Frame is too large")
+        record = _read_exact(f_in, record_len)
+        if crypter:
+            record = crypter.decrypt(record, _frame_aad(object_header, index, flags))
+        yield remove_padding(record)
+        index += 1
+        if flags & FLAG_FINAL:
+            break
+    if f_in.read(1):
+        raise CorruptObjectError("Unexpected data after the final frame")
+
+
+def iter_decoded(f_in: BinaryIO, compressed, crypter=None) -> Iterator[bytes]:
+    """Yields the original plaintext of a framed object in bounded chunks.
+    compressed is the Codec the object was written with, True for zlib or False."""
+    codec = _resolve_codec(compressed)
+    if not codec:
+        for payload in iter_frames(f_in, crypter):
+            if payload:
+                yield payload
+        return
+    try:
+        yield from codec.iter_decompress(iter_frames(f_in, crypter))
+    except compressors.CorruptStreamError as e:
+        raise CorruptObjectError(str(e)) from e
+
+
+def check_first_frame(f_in: BinaryIO, crypter) -> None:
+    """Decrypts only the first frame: enough to validate the key."""
+    next(iter_frames(f_in, crypter))
@@ -1,5 +1,6 @@
 import hashlib
 from pathlib import Path
+from typing import BinaryIO
 
 
 def get_file_hash(path: Path, block_size: int = 65536) -> str | None:
@@ -12,3 +13,22 @@ def get_file_hash(path: Path, block_size: int = 65536) -> str | None:
         return None
 
     return sha256.hexdigest()
+
+
+class HashingReader:
+    """Wraps a binary file and hashes every block read through it,
+    so the data can be processed and hashed in a single pass."""
+
+    def __init__(self, f: BinaryIO):
+        self._f = f
+        self._sha256 = hashlib.sha256()
+        self.bytes_read = 0
+
+    def read(self, size: int = -1) -> bytes:
+        block = self._f.read(size)
+        self._sha256.update(block)
+        self.bytes_read += len(block)
+        return block
+
+    def hexdigest(self) -> str:
+        return self._sha256.hexdigest()
@@ -1,15 +1,27 @@
+import argparse
+import contextlib
 import logging
 import getpass
-import json
+import hashlib
 import shutil
 import os
 import tempfile
 from dotenv import load_dotenv
-from cloud_manager import CloudManager
+from cloud_manager import CloudManager, UploadError
 from pathlib import Path
 from scanner import scan_files
 from manager import BackupManager
-from utils import show_progress
+from classes import RunOptions
+from crypter import UnlockSession
+import compressors
+import manifests
+from utils import (
+    show_progress,
+    resolve_workers,
+    resolve_flag,
+    resolve_codec,
+    resolve_part_size,
+)
 
 logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
 
@@ -19,8 +31,126 @@ logging.getLogger("urllib3").setLevel(logging.WARNING)
 
 IS_DOCKER = os.getenv("DOCKER_MODE") == "true"
 DOCKER_DATA_PATH = "/data"
-MANIFEST_FILE = "manifest.json"
 PRESS_ENTER = "\nPress Enter to continue..."
+CACHE_DIR = Path(
+    os.getenv("SMART_BACKUP_CACHE_DIR", Path.home() / ".cache" / "smart_backup")
+)
+
+
+def parse_options(argv: list[str] | None = None) -> RunOptions:
+    """Reads performance flags; each flag falls back to its environment variable."""
+    parser = argparse.ArgumentParser(description="Smart-Backup control panel")
+    parser.add_argument(
+        "--scan-workers",
+        type=int,
+        default=None,
+        help="Threads hashing files during the scan (env SMART_BACKUP_SCAN_WORKERS)",
+    )
+    parser.add_argument(
+        "--backup-workers",
+        type=int,
+        default=None,
+        help="Processes compressing and encrypting files (env SMART_BACKUP_WORKERS)",
+    )
+    parser.add_argument(
+        "--restore-workers",
+        type=int,
+        default=None,
+        help="Threads decoding and writing files on restore (env SMART_BACKUP_RESTORE_WORKERS)",
+    )
+    parser.add_argument(
+        "--fetch-workers",
+        type=int,
+        default=None,
+        help="Threads downloading objects ahead of a cloud restore (env SMART_BACKUP_FETCH_WORKERS)",
+    )
+    parser.add_argument(
+        "--upload-workers",
+        type=int,
+        default=None,
+        help="Threads uploading objects during a cloud backup (env SMART_BACKUP_UPLOAD_WORKERS)",
+    )
+    parser.add_argument(
+        "--part-size",
+        type=int,
+        default=None,
+        help="Part size in MB for cloud transfers of large objects "
+        "(env SMART_BACKUP_PART_SIZE_MB, default 16)",
+    )
+    parser.add_argument(
+        "--transfer-concurrency",
+        type=int,
+        default=None,
+        help="Parts of one large object transferred at once "
+        "(env SMART_BACKUP_TRANSFER_CONCURRENCY, default 8)",
+    )
+    parser.add_argument(
+        "--spool-dir",
+        default=None,
+        help="Directory a cloud backup stages large objects and packs in before "
+        "they are uploaded (env SMART_BACKUP_SPOOL_DIR, default the temp dir)",
+    )
+    parser.add_argument(
+        "--pack-objects",
+        action="store_true",
+        default=None,
+        help="Append small objects to 64 MB pack files (env SMART_BACKUP_PACK_OBJECTS)",
+    )
+    parser.add_argument(
+        "--chunking",
+        action="store_true",
+        default=None,
+        help="Store large files as content-defined chunks (env SMART_BACKUP_CHUNKING)",
+    )
+    parser.add_argument(
+        "--verify-only",
+        action="store_true",
+        default=None,
+        help="Restore checks every file against its hash without writing anything "
+        "(env SMART_BACKUP_VERIFY_ONLY)",
+    )
+    parser.add_argument(
+        "--hardlink-duplicates",
+        action="store_true",
+        default=None,
+        help="Restore files with identical content as hardlinks instead of copies "
+        "(env SMART_BACKUP_HARDLINK_DUPLICATES)",
+    )
+    parser.add_argument(
+        "--codec",
+        default=None,
+        help="Compression codec none, zlib, zstd or lz4, optionally with a level "
+        "as in zstd:19 (env SMART_BACKUP_CODEC, default zlib)",
+    )
+    # Unknown arguments are ignored: the control panel itself is interactive
+    args, _ = parser.parse_known_args(argv)
+    try:
+        codec = resolve_codec(args.codec, "SMART_BACKUP_CODEC")
+    except (ValueError, compressors.CodecUnavailableError) as e:
+        parser.error(f"--codec: {e}")
+    return RunOptions(
+        scan_workers=resolve_workers(args.scan_workers, "SMART_BACKUP_SCAN_WORKERS"),
+        backup_workers=resolve_workers(args.backup_workers, "SMART_BACKUP_WORKERS"),
+        restore_workers=resolve_workers(
+            args.restore_workers, "SMART_BACKUP_RESTORE_WORKERS"
+        ),
+        fetch_workers=resolve_workers(args.fetch_workers, "SMART_BACKUP_FETCH_WORKERS"),
+        upload_workers=resolve_workers(
+            args.upload_workers, "SMART_BACKUP_UPLOAD_WORKERS"
+        ),
+        part_size_mb=resolve_part_size(args.part_size, "SMART_BACKUP_PART_SIZE_MB"),
+        transfer_concurrency=resolve_workers(
+            args.transfer_concurrency, "SMART_BACKUP_TRANSFER_CONCURRENCY", default=8
+        ),
+        spool_dir=args.spool_dir or os.getenv("SMART_BACKUP_SPOOL_DIR") or None,
+        chunking=resolve_flag(args.chunking, "SMART_BACKUP_CHUNKING"),
+        pack_objects=resolve_flag(args.pack_objects, "SMART_BACKUP_PACK_OBJECTS"),
+        codec=codec,
+        verify_only=resolve_flag(args.verify_only, "SMART_BACKUP_VERIFY_ONLY"),
+        hardlink_duplicates=resolve_flag(
+            args.hardlink_duplicates, "SMART_BACKUP_HARDLINK_DUPLICATES"
+        ),
+    )
 
 
 def get_safe_path(prompt):
@@ -49,8 +179,9 @@ def get_safe_path(prompt):
     return Path(user_input).resolve()
 
 
-def _setup_storage(is_cloud: bool):
+def _setup_storage(is_cloud: bool, options: RunOptions | None = None):
     """Initialises cloud or local storage. Returns (cloud, backup_base) or None on failure."""
+    options = options or RunOptions()
     load_dotenv()
 
     endpoint = os.getenv("S3_ENDPOINT", "http://minio:9000")
@@ -59,15 +190,28 @@ def _setup_storage(is_cloud: bool):
         endpoint = endpoint.replace("minio", "localhost")
 
     if is_cloud:
+        bucket = os.getenv("S3_BUCKET", "backup")
+        # One index per endpoint and bucket; it outlives the temporary backup_base
+        index_id = hashlib.sha256(f"{endpoint}/{bucket}".encode()).hexdigest()[:16]
         cloud = CloudManager(
             endpoint=endpoint,
             access_key=os.getenv("S3_ACCESS_KEY"),
             secret_key=os.getenv("S3_SECRET_KEY"),
-            bucket_name=os.getenv("S3_BUCKET", "backup"),
+            bucket_name=bucket,
+            index_path=CACHE_DIR / f"cloud-{index_id}.sqlite",
+            # multipart uploads an interrupted backup can continue
+            journal_path=CACHE_DIR / f"cloud-{index_id}-uploads.sqlite",
+            # one connection per upload or fetch thread, per part of a large object
+            max_connections=max(options.upload_workers, options.fetch_workers)
+            * options.transfer_concurrency,
+            part_size=options.part_size_mb * 1024 * 1024,
+            transfer_concurrency=options.transfer_concurrency,
         )
 
-        backup_base = Path(tempfile.gettempdir()) / "smart_backup_cloud_temp"
-        backup_base.mkdir(exist_ok=True)
+        # manifests, and objects too large to hold in memory until they are uploaded
+        spool_dir = Path(options.spool_dir or tempfile.gettempdir())
+        backup_base = spool_dir / "smart_backup_cloud_temp"
+        backup_base.mkdir(parents=True, exist_ok=True)
         return cloud, backup_base
 
     cloud = None
@@ -86,22 +230,24 @@ def _load_last_manifest(
     """Loads the last manifest for the project, returns manifest dict or None."""
     if is_cloud:
         print(f"[INFO] Checking cloud for '{project_name}'...")
-        cloud_res = cloud.get_last_manifest(project_name)
+        cloud_res = cloud.get_last_manifest(project_name, backup_base)
         if cloud_res:
             last_m, _ = cloud_res
-            ts = last_m["info"]["timestamp"]
-            local_old_path = backup_base / project_name / ts
-            local_old_path.mkdir(parents=True, exist_ok=True)
-            with open(local_old_path / MANIFEST_FILE, "w", encoding="utf-8") as f:
-                json.dump(last_m, f, indent=4, ensure_ascii=False)
             return last_m
         return None
 
-    last_versions = manager._find_target_versions(project_name)
-    if last_versions:
-        with open(last_versions[-1] / MANIFEST_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    return None
+    return manager.load_latest_manifest(project_name)
+
+
+def _sync_pack_indexes(manager: BackupManager, cloud, backup_base: Path) -> None:
+    """Downloads pack indexes missing locally: packed objects are found through them."""
+    for key in cloud.list_pack_indexes():
+        local_path = backup_base / key.replace("backups/", "", 1)
+        if local_path.exists():
+            continue
+        local_path.parent.mkdir(parents=True, exist_ok=True)
+        cloud.download_file(key, local_path)
+    manager.pack_index.load()
 
 
 def _check_param_changes(
@@ -122,7 +268,8 @@ def _check_param_changes(
     return forced_salt, False
 
 
-def handle_backup(manager, cloud, backup_base, is_cloud) -> None:
+def handle_backup(manager, cloud, backup_base, is_cloud, options=None) -> None:
+    options = options or parse_options([])
     source_path = get_safe_path("Enter path to source [/data]: ") or Path(
         DOCKER_DATA_PATH
     )
@@ -149,9 +296,7 @@ def handle_backup(manager, cloud, backup_base, is_cloud) -> None:
 
     comment = input("Comment: ").strip()
     comp_default = "y" if last_comp else "n"
-    compress_yn = (
-        input(f"Compress non-archive files? (y/n) [{comp_default}]: ").lower() != "n"
-    )
+    compress_yn = input(f"Compress files? (y/n) [{comp_default}]: ").lower() != "n"
     pass_input = getpass.getpass("Password (Enter for none): ").strip()
     password = pass_input if pass_input else None
     current_enc = password is not None
@@ -162,48 +307,97 @@ def handle_backup(manager, cloud, backup_base, is_cloud) -> None:
     if aborted:
         return
 
+    if is_cloud:
+        _sync_pack_indexes(manager, cloud, backup_base)
+        # one listing per objects/xx/ prefix instead of a HEAD per object
+        print("[INFO] Listing objects in the bucket...")
+        print(f"[INFO] Objects in the bucket: {cloud.load_object_listing()}")
+
     print("\n[1/2] Scanning...")
-    scan_result = scan_files(source_path, progress_callback=show_progress)
+    # Unchanged files (same size/mtime/inode/ctime) reuse hashes from the last manifest
+    scan_result = scan_files(
+        source_path,
+        progress_callback=show_progress,
+        previous_manifest=last_m,
+        workers=options.scan_workers,
+        defer_hashing=True,  # changed files are hashed while they are stored
+    )
 
     print("\n[2/2] Creating snapshot...")
 
-    def upload_hook(rel_path, data, _cloud=cloud):
-        _cloud.upload_data(rel_path, data)
-
-    res = manager.create_backup(
-        scan_result,
-        source_path,
-        project_name,
-        comment,
-        compress=compress_yn,
-        password=password,
-        forced_salt=forced_salt,
-        after_obj_created=upload_hook if is_cloud else None,
-    )
+    # Objects are uploaded by a pool while the backup goes on; the manifest goes last
+    uploader = cloud.uploader(options.upload_workers) if is_cloud else None
+    try:
+        with uploader or contextlib.nullcontext():
+            res = manager.create_backup(
+                scan_result,
+                source_path,
+                project_name,
+                comment,
+                compress=compress_yn,
+                password=password,
+                forced_salt=forced_salt,
+                after_obj_created=uploader,
+                chunking=options.chunking,
+                pack_objects=options.pack_objects,
+                workers=options.backup_workers,
+                codec=options.codec,
+            )
+    except UploadError as e:
+        print(f"\n[!] Upload failed, the snapshot was not published: {e}")
+        print("    Run the backup again to continue where it stopped.")
+        input(PRESS_ENTER)
+        return
+    finally:
+        if is_cloud and cloud.index is not None:
+            # uploads done so far are skipped by the next run, even after Ctrl+C
+            cloud.index.flush()
+        if is_cloud and backup_base.name == "smart_backup_cloud_temp":
+            shutil.rmtree(backup_base, ignore_errors=True)
 
-    if is_cloud and backup_base.name == "smart_backup_cloud_temp":
-        shutil.rmtree(backup_base)
+    if is_cloud:
+        aborted = cloud.abort_pending_uploads()
+        if aborted:
+            logging.info(f"Aborted {aborted} unfinished uploads of earlier runs")
 
     print("\n" + "—" * 30)
     print(" The snapshot was created successfully!")
     print(f"   • New objects:  {res.copied}")
     print(f"   • Used existing ones: {res.skipped}")
+    print(f"   • Hashes reused from last snapshot: {scan_result.reused_hashes}")
+    print(f"   • Bytes written: {res.bytes_written}")
+    if uploader is not None:
+        print(
+            f"   • Uploaded: {uploader.uploaded} objects, {uploader.bytes_uploaded} bytes"
+        )
+    for label, stats in sorted(res.codec_stats.items()):
+        print(
+            f"   • {label}: {stats.throughput:.1f} MB/s, "
+            f"{stats.bytes_in} -> {stats.bytes_out} bytes ({stats.ratio:.0%})"
+        )
     print("—" * 30)
 
     input(PRESS_ENTER)
 
 
-def handle_restore(manager, cloud, backup_base, is_cloud) -> None:
+def handle_restore(manager, cloud, backup_base, is_cloud, options=None) -> None:
+    options = options or parse_options([])
     if is_cloud:
         print("[INFO] Syncing manifests from cloud...")
         manifest_keys = cloud.list_manifests()
         for key in manifest_keys:
             rel_s3_path = Path(key.replace("backups/", "", 1))
             local_manifest_path = backup_base / rel_s3_path
-            local_manifest_path.parent.mkdir(parents=True, exist_ok=True)
-            m_data = cloud.download_data(key)
-            with open(local_manifest_path, "wb") as f:
-                f.write(m_data)
+            v_dir = local_manifest_path.parent
+            # manifests never change once written: known snapshots are not fetched
+            if local_manifest_path.exists() and manager.has_snapshot(
+                v_dir.parent.name, v_dir.name
+            ):
+                continue
+            v_dir.mkdir(parents=True, exist_ok=True)
+            cloud.download_file(key, local_manifest_path)
+            manager.record_snapshot(v_dir)
+        _sync_pack_indexes(manager, cloud, backup_base)
 
     proj_query = input("Directory name (Enter to search everywhere): ").strip() or None
     date_query = (
@@ -211,50 +405,75 @@ def handle_restore(manager, cloud, backup_base, is_cloud) -> None:
         or None
     )
 
-    found = manager._find_target_versions(proj_query, date_query)
+    found = manager.list_snapshots(proj_query, date_query)
     if not found:
         print("Versions not found.")
         return
 
-    target_v = found[-1]
-    print(f"\nVersion selected: {target_v.parent.name} / {target_v.name}")
+    selected = found[-1]
+    target_v = backup_base / selected.project / selected.version
+    print(f"\nVersion selected: {selected.project} / {selected.version}")
+    if not manifests.manifest_path(target_v).exists():
+        print("[!] This version is no longer on disk: rebuild the indexes (menu 3).")
+        return
 
-    with open(target_v / MANIFEST_FILE, "r", encoding="utf-8") as f:
-        m_data = json.load(f)
+    m_data = manifests.open_manifest(target_v)
 
-    password = None
+    session = None
     if m_data["info"].get("salt"):
         password = getpass.getpass(
             "This backup is encrypted. Enter the password: "
         ).strip()
+        # The key is derived once for verification and restore, then zeroized
+        session = UnlockSession(password)
         print("[INFO] Verifying access...")
 
         if not manager.verify_password(
             target_v.parent.name,
             target_v.name,
-            password,
             fetch_proxy=cloud.download_objects if is_cloud else None,
+            session=session,
         ):
+            session.close()
             print("\n[!!!] Access Denied: Invalid password.")
             input(PRESS_ENTER)
             return
 
+    try:
+        _restore_selected(manager, cloud, is_cloud, options, target_v, m_data, session)
+    finally:
+        if session:
+            session.close()
+
+
+def _restore_selected(manager, cloud, is_cloud, options, target_v, m_data, session):
+    """Asks for the target and mode, restores target_v and prints the summary."""
+    if options.verify_only:
+        _verify_selected(manager, cloud, is_cloud, options, target_v, m_data, session)
+        return
+
     target_path = get_safe_path("Where to restore?: ")
 
     print("\nRecovery mode:")
     print("1. Full (original files)")
     print("2. Technical (as in storage: compression/cipher)")
-    mode = input("Choose (1/2) [1]: ").strip() or "1"
-    full_clean = mode == "1"
+    print("3. Sync (into the folder itself, only files that differ)")
+    mode = input("Choose (1/2/3) [1]: ").strip() or "1"
+    full_clean = mode in ("1", "3")
+    sync = mode == "3"
 
     results = manager.restore_version(
         target_v.parent.name,
         target_v.name,
         target_path,
-        password=password,
         decrypt_data=full_clean,
         decompress_data=full_clean,
         fetch_proxy=cloud.download_objects if is_cloud else None,
+        workers=options.restore_workers,
+        fetch_workers=options.fetch_workers,
+        session=session,
+        sync=sync,
+        hardlink_duplicates=options.hardlink_duplicates,
     )
 
     success_count = sum(1 for status in results.values() if status is True)
@@ -267,46 +486,89 @@ def handle_restore(manager, cloud, backup_base, is_cloud) -> None:
     print("—" * 30)
 
     version_dir = target_path / f"{target_v.parent.name}_{target_v.name}"
-    if version_dir.exists() and not any(version_dir.iterdir()):
+    if not sync and version_dir.exists() and not any(version_dir.iterdir()):
         version_dir.rmdir()
         print("[INFO] Empty recovery directory removed.")
 
     input(PRESS_ENTER)
 
 
-def main():
+def _verify_selected(manager, cloud, is_cloud, options, target_v, m_data, session):
+    """Decodes target_v and checks every file against its hash, writing nothing."""
+    results = manager.restore_version(
+        target_v.parent.name,
+        target_v.name,
+        None,
+        fetch_proxy=cloud.download_objects if is_cloud else None,
+        workers=options.restore_workers,
+        fetch_workers=options.fetch_workers,
+        session=session,
+        verify_only=True,
+    )
+
+    intact_count = sum(1 for status in results.values() if status is True)
+    total_count = len(m_data.get("files", []))
+
+    print("\n" + "—" * 30)
+    print(" Verification results ")
+    print(f"   • Intact: {intact_count} / {total_count}")
+    print("—" * 30)
+
+    input(PRESS_ENTER)
+
+
+def handle_rebuild_index(manager, cloud, is_cloud) -> None:
+    """Re-creates the object index and the snapshot catalog, e.g. after objects
+    or snapshots were removed by hand."""
+    print("\n[INFO] Rebuilding the object index...")
+    if is_cloud:
+        count = cloud.rebuild_index()
+    else:
+        count = manager.rebuild_object_index()
+    print(f"[OK] Objects indexed: {count}")
+    if not is_cloud:
+        print(f"[OK] Snapshots cataloged: {manager.rebuild_catalog()}")
+    input(PRESS_ENTER)
+
+
+def main(argv: list[str] | None = None):
+    options = parse_options(argv)
     while True:
         print("\n" + "-" * 40)
         print("   SMART-BACKUP CONTROL PANEL")
         print("-" * 40)
         print("1. Create backup")
         print("2. Restore version")
+        print("3. Rebuild object index and catalog")
         print("0. Exit")
 
-        choice = input("\nChoose an action (0/1/2): ").strip()
+        choice = input("\nChoose an action (0/1/2/3): ").strip()
 
         if choice == "0":
             print("Goodbye!")
             break
 
-        if choice not in ["1", "2"]:
+        if choice not in ["1", "2", "3"]:
             print("Invalid choice, try again.\n")
             continue
 
         storage_mode = input("Storage mode: 1. Local 2. Cloud (MinIO) [1]: ") or "1"
         is_cloud = storage_mode == "2"
 
-        result = _setup_storage(is_cloud)
+        result = _setup_storage(is_cloud, options)
         if result is None:
             continue
         cloud, backup_base = result
 
-        manager = BackupManager(backup_base)
+        # cloud mode: objects live in the bucket only, backup_base keeps the manifests
+        manager = BackupManager(backup_base, remote=cloud)
 
         if choice == "1":
-            handle_backup(manager, cloud, backup_base, is_cloud)
+            handle_backup(manager, cloud, backup_base, is_cloud, options)
         elif choice == "2":
-            handle_restore(manager, cloud, backup_base, is_cloud)
+            handle_restore(manager, cloud, backup_base, is_cloud, options)
+        elif choice == "3":
+            handle_rebuild_index(manager, cloud, is_cloud)
 
 
 if __name__ == "__main__":
@@ -1,47 +1,513 @@
-import json
+import io
+import itertools
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 import logging
-import zlib
+import tempfile
 import hashlib
 import os
-from crypter import FileCrypter
+import threading
+import chunker
+import compressors
+import fileclone
+import frames
+import manifests
+from compressibility import CompressibilityDetector
+import packs
+from catalog import CATALOG_FILE, SnapshotCatalog
+from object_index import ObjectIndex
+from crypter import DEFAULT_KEY_CACHE, FileCrypter, UnlockSession
 from datetime import datetime
 from pathlib import Path
-from classes import ScanResult, ProgressEvent, CopyResult
+from classes import (
+    ScanResult,
+    ProgressEvent,
+    CopyResult,
+    StoredObject,
+    CodecStats,
+    FileVersion,
+    SnapshotSummary,
+)
 from utils import show_progress
-from hasher import get_file_hash
-from typing import Callable, Optional
+from hasher import HashingReader, get_file_hash
+from collections.abc import Mapping
+from typing import BinaryIO, Callable, Iterator, Optional
 
-MANIFEST_FILE = "manifest.json"
+OBJECT_INDEX_FILE = ".index.sqlite"
+READ_BLOCK_SIZE = 1024 * 1024
+# Encoded objects up to this size are staged in memory, larger ones in a temp file
+STAGE_IN_MEMORY_LIMIT = 16 * 1024 * 1024
+# Files in flight per backup worker; bounds memory held by finished results
+QUEUE_DEPTH_PER_WORKER = 2
+# Remote objects whose size is asked for when picking one to verify a password
+SIZE_PROBES = 64
 
 logger = logging.getLogger(__name__)
 
-NON_COMPRESSIBLE = {
-    ".zip",
-    ".7z",
-    ".rar",
-    ".gz",
-    ".tar",  # Archives
-    ".mp4",
-    ".mkv",
-    ".avi",
-    ".mov",  # Movie
-    ".mp3",
-    ".wav",
-    ".flac",  # Audio
-    ".jpg",
-    ".jpeg",
-    ".png",  # Photo
-    ".docx",
-    ".xlsx",
-    ".pptx",  # Docs MS Office
-    ".pdf",
-}
+
+class _StagedObject:
+    """Encoded bytes of an object whose id is not known yet.
+    Kept in memory up to limit, spilled to a temporary file in spill_dir beyond it."""
+
+    def __init__(self, spill_dir: Path, limit: int):
+        self._spill_dir = spill_dir
+        self._limit = limit
+        self._buffer = bytearray()
+        self._file = None
+        self._spill_path: Optional[Path] = None
+
+    @classmethod
+    def adopt(
+        cls, spill_dir: Path, limit: int, payload: bytes | str
+    ) -> "_StagedObject":
+        """Takes over an object staged in a worker process (see export)."""
+        stage = cls(spill_dir, limit)
+        if isinstance(payload, bytes):
+            stage._buffer = bytearray(payload)
+        else:
+            stage._spill_path = Path(payload)
+        return stage
+
+    def write(self, data: bytes) -> None:
+        if self._spill_path is not None:
+            self._file.write(data)
+            return
+        self._buffer += data
+        if len(self._buffer) > self._limit:
+            self._spill_dir.mkdir(parents=True, exist_ok=True)
+            self._file = tempfile.NamedTemporaryFile(
+                dir=self._spill_dir, prefix=".stage-", delete=False
+            )
+            self._spill_path = Path(self._file.name)
+            self._file.write(self._buffer)
+            self._buffer = bytearray()
+
+    def getvalue(self) -> Optional[bytes]:
+        """The staged bytes, None once they were spilled to disk."""
+        return bytes(self._buffer) if self._spill_path is None else None
+
+    @property
+    def size(self) -> int:
+        if self._spill_path is None:
+            return len(self._buffer)
+        if self._file is not None:
+            return self._file.tell()
+        return self._spill_path.stat().st_size
+
+    def export(self) -> bytes | str:
+        """Hands the staged bytes to another process: the bytes themselves,
+        or the path of the spill file, which the caller then owns."""
+        if self._spill_path is None:
+            return bytes(self._buffer)
+        self._close()
+        path, self._spill_path = str(self._spill_path), None
+        return path
+
+    def reader(self) -> BinaryIO:
+        """A file reading the staged bytes from the start."""
+        if self._spill_path is None:
+            return io.BytesIO(self._buffer)
+        self._close()
+        return open(self._spill_path, "rb")
+
+    def commit(self, obj_path: Path) -> bytes | Path:
+        """Moves the staged bytes to obj_path.
+        Returns the bytes if they were kept in memory, otherwise obj_path."""
+        obj_path.parent.mkdir(parents=True, exist_ok=True)
+        if self._spill_path is None:
+            data = bytes(self._buffer)
+            self._buffer = bytearray()
+            with open(obj_path, "wb") as f_out:
+                f_out.write(data)
+            return data
+        self._close()
+        os.replace(self._spill_path, obj_path)
+        self._spill_path = None
+        return obj_path
+
+    def discard(self) -> None:
+        self._buffer = bytearray()
+        if self._spill_path is not None:
+            self._close()
+            self._spill_path.unlink(missing_ok=True)
+            self._spill_path = None
+
+    def _close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def _file_codec(
+    path: Path,
+    codec: Optional[compressors.Codec],
+    detector: CompressibilityDetector,
+    scan_result: ScanResult,
+) -> Optional[compressors.Codec]:
+    """Codec a file is compressed with, None if it is stored uncompressed."""
+    if codec is None:
+        return None
+    previous = scan_result.previous_entries.get(path)
+    if previous is not None and "compressed" in previous:
+        # unchanged file: the earlier decision keeps its object id, if it was
+        # taken with the same codec (not forced by compression being off)
+        if previous["compressed"]:
+            if previous.get("codec", compressors.DEFAULT_CODEC) == codec.name:
+                return codec
+        elif _snapshot_codec(scan_result.previous_info) == codec.name:
+            return None
+    file_stat = scan_result.file_stats.get(path)
+    size = file_stat.size if file_stat else None
+    return codec if detector.is_compressible(path, size) else None
+
+
+def _snapshot_codec(info: dict) -> Optional[str]:
+    """Codec name a snapshot compressed with, None if compression was off.
+    Snapshots from before the codec was recorded used the default codec."""
+    if not info.get("compression_enabled"):
+        return None
+    return info.get("codec", compressors.DEFAULT_CODEC)
+
+
+def _hash_chunks(chunks: Iterator[bytes]) -> str:
+    sha256 = hashlib.sha256()
+    for chunk in chunks:
+        sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def _target_matches(final_path: Path, info: dict) -> Optional[bool]:
+    """Compares an existing restore target with its manifest entry by stat:
+    True if size and mtime match, False if it is missing or has another size,
+    None if only its hash can tell."""
+    try:
+        st = final_path.stat()
+    except FileNotFoundError:
+        return False
+    if not final_path.is_file():
+        return False
+    size = info.get("size")
+    if size is not None and st.st_size != size:
+        return False
+    if size is not None and st.st_mtime_ns == info.get("mtime_ns"):
+        return True
+    return None
+
+
+def _restore_mtime(final_path: Path, info: dict) -> None:
+    # Lets a later sync restore recognise the file by size and mtime
+    mtime_ns = info.get("mtime_ns")
+    if mtime_ns is not None:
+        os.utime(final_path, ns=(mtime_ns, mtime_ns))
+
+
+def _as_file(data: bytes | BinaryIO) -> BinaryIO:
+    # fetch_proxy returns bytes, or a file for objects too large to hold in memory
+    return io.BytesIO(data) if isinstance(data, bytes) else data
+
+
+def _codec_name(codec: Optional[compressors.Codec]) -> Optional[str]:
+    return codec.name if codec else None
+
+
+def _written_level(
+    stored: StoredObject, file_codec: compressors.Codec, previous_entry
+) -> Optional[int]:
+    """Level the stored content was compressed with. Content that was already
+    stored keeps the level of the previous entry pointing at it; None if that
+    level is not known."""
+    if stored.copied:
+        return file_codec.level
+    previous_entry = previous_entry or {}
+    if previous_entry.get("codec", compressors.DEFAULT_CODEC) != file_codec.name:
+        return None
+    if stored.chunks is not None:
+        same_content = previous_entry.get("chunks") == stored.chunks
+    else:
+        same_content = previous_entry.get("object") == stored.object_id
+    return previous_entry.get("level") if same_content else None
+
+
+def _encode_file(
+    path: Path,
+    file_codec: Optional[compressors.Codec],
+    crypter,
+    stage,
+    stats: Optional[CodecStats] = None,
+) -> str:
+    """Reads path once into stage, framed if compressed or encrypted, raw otherwise.
+    Returns the SHA-256 of the plaintext."""
+    with open(path, "rb") as f_in:
+        reader = HashingReader(f_in)
+        framed = bool(file_codec or crypter)
+        sink = (
+            frames.FrameWriter(stage, file_codec or False, crypter, stats=stats)
+            if framed
+            else stage
+        )
+        for block in iter(lambda: reader.read(READ_BLOCK_SIZE), b""):
+            sink.write(block)
+        if framed:
+            sink.close()
+    return reader.hexdigest()
+
+
+def _encode_blob(data: bytes, file_codec, crypter, stats=None) -> bytes:
+    out = io.BytesIO()
+    writer = frames.FrameWriter(out, file_codec or False, crypter, stats=stats)
+    writer.write(data)
+    writer.close()
+    return out.getvalue()
+
+
+def _encode_chunks(
+    path: Path,
+    file_codec: Optional[compressors.Codec],
+    crypter,
+    is_stored: Callable[[str], bool],
+    write: Callable[[str, bytes], None],
+    stats: Optional[CodecStats] = None,
+) -> tuple[str, list, list]:
+    """Splits path into content-defined chunks and calls write(chunk_hash, data)
+    for every chunk is_stored is false for, framed if compressed or encrypted.
+    Returns the SHA-256 of the plaintext, the [hash, size] of every chunk and
+    the encoded size of every chunk, None for the chunks not written."""
+    framed = bool(file_codec or crypter)
+    chunks, encoded_sizes = [], []
+    written = set()
+    with open(path, "rb") as f_in:
+        reader = HashingReader(f_in)
+        for chunk in chunker.iter_chunks(
+            reader, chunker.MIN_SIZE, chunker.AVG_SIZE, chunker.MAX_SIZE
+        ):
+            chunk_hash = hashlib.sha256(chunk).hexdigest()
+            chunks.append([chunk_hash, len(chunk)])
+            # a chunk repeated within the file is written once
+            if chunk_hash in written or is_stored(chunk_hash):
+                encoded_sizes.append(None)
+                continue
+            written.add(chunk_hash)
+            data = _encode_blob(chunk, file_codec, crypter, stats) if framed else chunk
+            write(chunk_hash, data)
+            encoded_sizes.append(len(data))
+    return reader.hexdigest(), chunks, encoded_sizes
+
+
+# Crypter of a backup worker process, built from the key derived by the parent
+_worker_crypter = None
+
+
+def _init_worker(key: bytes | None, salt: bytes | None) -> None:
+    global _worker_crypter
+    _worker_crypter = FileCrypter.from_key(key, salt) if key else None
+
+
+def _encode_in_worker(
+    path: Path, file_codec: Optional[compressors.Codec], spill_dir: Path, limit: int
+) -> tuple[str, bytes | str, CodecStats]:
+    """Compresses and encrypts one file in a worker process. Returns the
+    plaintext hash, the exported stage (bytes or spill file path) and the
+    compression stats."""
+    stage = _StagedObject(spill_dir, limit)
+    stats = CodecStats()
+    try:
+        read_hash = _encode_file(path, file_codec, _worker_crypter, stage, stats)
+        return read_hash, stage.export(), stats
+    finally:
+        stage.discard()
+
+
+def _chunk_in_worker(
+    path: Path,
+    file_codec: Optional[compressors.Codec],
+    known: set[str],
+    spill_dir: Path,
+    limit: int,
+) -> tuple[str, list, list, bytes | str, CodecStats]:
+    """Chunks, compresses and encrypts one file in a worker process, skipping
+    the chunks in known. Returns what _encode_chunks returns, then the exported
+    stage holding the encoded chunks and the compression stats."""
+    stage = _StagedObject(spill_dir, limit)
+    stats = CodecStats()
+    try:
+        read_hash, chunks, encoded_sizes = _encode_chunks(
+            path,
+            file_codec,
+            _worker_crypter,
+            known.__contains__,
+            lambda _, data: stage.write(data),
+            stats,
+        )
+        return read_hash, chunks, encoded_sizes, stage.export(), stats
+    finally:
+        stage.discard()
 
 
 class BackupManager:
-    def __init__(self, backup_base_path: Path):
+    def __init__(self, backup_base_path: Path, remote=None):
+        """remote is an object store (CloudManager) that holds the objects
+        instead of backup_base: create_backup checks for objects with
+        remote.has_object and hands new ones to after_obj_created without
+        keeping a local copy. Manifests and indexes are still written here."""
         self.backup_base = backup_base_path
+        self.remote = remote
         self.objects_path = self.backup_base / "objects"
+        self.packs_path = self.backup_base / "packs"
+        self._pack_index = None
+        self._object_index = None
+        self._catalog = None
+
+    @property
+    def pack_index(self) -> packs.PackIndex:
+        """Locations of packed objects, read from packs/*.idx on first use."""
+        if self._pack_index is None:
+            self._pack_index = packs.PackIndex(self.packs_path)
+        return self._pack_index
+
+    @property
+    def object_index(self) -> ObjectIndex:
+        """Ids of standalone objects. Kept inside objects/ so that removing the
+        objects also removes the index."""
+        if self._object_index is None:
+            self._object_index = ObjectIndex(self.objects_path / OBJECT_INDEX_FILE)
+        return self._object_index
+
+    @property
+    def catalog(self) -> SnapshotCatalog:
+        """Summaries and file index of the snapshots in this storage. A new
+        catalog, or one written by an older version, is filled from the
+        manifests on disk."""
+        if self._catalog is None:
+            self._catalog = SnapshotCatalog(self.backup_base / CATALOG_FILE)
+            if self._catalog.is_stale:
+                self.rebuild_catalog()
+        return self._catalog
+
+    def rebuild_catalog(self) -> int:
+        """Re-creates the catalog from the manifests on disk.
+        Returns the number of snapshots found."""
+        summaries = []
+        for v_dir in self._find_target_versions():
+            try:
+                info = manifests.read_info(v_dir)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Skip snapshot {v_dir}: {e}")
+                continue
+            summaries.append(
+                SnapshotSummary.from_info(v_dir.parent.name, v_dir.name, info)
+            )
+        count = self.catalog.replace_all(summaries)
+        for project in sorted({summary.project for summary in summaries}):
+            self._reindex_project(project)
+        return count
+
+    def record_snapshot(self, v_dir: Path) -> SnapshotSummary:
+        """Adds the snapshot in v_dir and its files to the catalog: called when
+        a manifest is written, or synced from the cloud."""
+        summary = SnapshotSummary.from_info(
+            v_dir.parent.name, v_dir.name, manifests.read_info(v_dir)
+        )
+        if not self.catalog.record(summary, self._manifest_hashes(v_dir)):
+            # older than a snapshot already indexed: spans are rebuilt in order
+            self._reindex_project(summary.project)
+        return summary
+
+    def has_snapshot(self, project_name: str, version: str) -> bool:
+        """Whether the catalog already holds the snapshot."""
+        return self.catalog.get(project_name, version) is not None
+
+    def _reindex_project(self, project_name: str) -> None:
+        project_dir = self.backup_base / project_name
+        self.catalog.reindex_project(
+            project_name,
+            (
+                (summary.version, self._manifest_hashes(project_dir / summary.version))
+                for summary in self.catalog.find(project=project_name)
+            ),
+        )
+
+    def _manifest_hashes(self, v_dir: Path) -> Iterator[tuple[str, str]]:
+        """(path, hash) of every file of a snapshot, streamed from its manifest."""
+        try:
+            for rel_path_str, info in manifests.open_manifest(v_dir)["files"].items():
+                yield rel_path_str, info.get("hash")
+        except (OSError, ValueError) as e:
+            logger.warning(f"File index of {v_dir} is incomplete: {e}")
+
+    def path_history(
+        self,
+        rel_path: str,
+        project_name: Optional[str] = None,
+        limit: Optional[int] = None,
+        offset: int = 0,
+    ) -> list[FileVersion]:
+        """Every snapshot holding rel_path, oldest first, with its hash there."""
+        if not self.backup_base.exists():
+            return []
+        return self.catalog.path_history(rel_path, project_name, limit, offset)
+
+    def hash_locations(
+        self,
+        file_hash: str,
+        project_name: Optional[str] = None,
+        limit: Optional[int] = None,
+        offset: int = 0,
+    ) -> list[FileVersion]:
+        """Every (snapshot, path) storing content with file_hash, oldest first:
+        where else the same object is used."""
+        if not self.backup_base.exists():
+            return []
+        return self.catalog.hash_locations(file_hash, project_name, limit, offset)
+
+    def list_snapshots(
+        self,
+        project_name: Optional[str] = None,
+        date_hint: Optional[str] = None,
+        comment: Optional[str] = None,
+        encrypted: Optional[bool] = None,
+        limit: Optional[int] = None,
+        offset: int = 0,
+    ) -> list[SnapshotSummary]:
+        """Snapshots from the catalog, oldest first, like _find_target_versions
+        but without reading any manifest."""
+        if not self.backup_base.exists():
+            return []
+        return self.catalog.find(
+            project=project_name,
+            version_contains=date_hint,
+            comment_contains=comment,
+            encrypted=encrypted,
+            limit=limit,
+            offset=offset,
+        )
+
+    def _object_exists(self, obj_path: Path) -> bool:
+        object_id = obj_path.name
+        if object_id in self.pack_index or object_id in self.object_index:
+            return True
+        # Not indexed: stored before the index existed or not committed before a crash
+        if self.remote is not None:
+            stored = self.remote.has_object(obj_path.relative_to(self.backup_base))
+        else:
+            stored = obj_path.exists()
+        if stored:
+            self.object_index.add(object_id)
+            return True
+        return False
+
+    def rebuild_object_index(self) -> int:
+        """Re-creates the object index from objects/ and reloads the pack indexes.
+        Returns the number of standalone objects found."""
+        self.pack_index.load()
+        if not self.objects_path.exists():
+            return self.object_index.replace_all([])
+        return self.object_index.replace_all(
+            obj.name
+            for sub in self.objects_path.iterdir()
+            if sub.is_dir() and len(sub.name) == 2
+            for obj in sub.iterdir()
+            if not obj.name.startswith(".")
+        )
 
     def _get_object_path(
         self,
@@ -49,53 +515,260 @@ class BackupManager:
         encrypted: bool = False,
         compressed: bool = False,
         salt: str = "",
+        framed: bool = False,
+        codec: str = compressors.DEFAULT_CODEC,
     ) -> Path:
         meta = (
             f"{'enc' if encrypted else 'raw'}_{'zip' if compressed else 'nozip'}_{salt}"
         )
+        if framed:
+            # Framed objects never share a path with objects of the old format
+            meta += "_sbf1"
+        if compressed and codec != compressors.DEFAULT_CODEC:
+            # zlib ids are unchanged, so existing objects keep deduplicating
+            meta += f"_{codec}"
         store_hash = hashlib.sha256((file_hash + meta).encode()).hexdigest()
         return self.objects_path / store_hash[:2] / store_hash
 
     def _add_padding(self, data: bytes, block_size: int = 256) -> bytes:
-        data_len = len(data).to_bytes(4, byteorder="big")
-        pad_len = block_size - (len(data) + 4) % block_size
-        padding = os.urandom(pad_len)
-        return data_len + data + padding
+        return frames.add_padding(data, block_size)
 
     def _remove_padding(self, padded_data: bytes) -> bytes:
-        if len(padded_data) < 4:
-            return padded_data
-        data_len = int.from_bytes(padded_data[:4], byteorder="big")
-        return padded_data[4 : 4 + data_len]
+        return frames.remove_padding(padded_data)
 
     def _process_object(
-        self, path, f_hash, compress, should_compress, crypter, after_obj_created
-    ):
-        """Processes a single file: compress, pad, encrypt, save. Returns (copied, skipped)."""
-        current_salt = crypter.salt.hex() if crypter else ""
-        obj_path = self._get_object_path(
-            f_hash,
+        self,
+        path,
+        f_hash,
+        compress,
+        file_codec,
+        crypter,
+        after_obj_created,
+        packer: Optional[packs.PackWriter] = None,
+    ) -> StoredObject:
+        """Processes a single file in one read: hash, compress, pad, encrypt, save.
+        Compressed or encrypted files are written in the framed format (frames.py)
+        with constant memory; other files are stored byte for byte.
+        f_hash may be None (hashing deferred by the scan), the object is located
+        once the hash of the read data is final.
+        With a packer, objects up to packs.PACK_THRESHOLD go into a pack file."""
+        known = self._find_known(f_hash, compress, file_codec, crypter)
+        if known:
+            return known
+
+        stage = _StagedObject(self.objects_path, STAGE_IN_MEMORY_LIMIT)
+        stats = CodecStats()
+        try:
+            read_hash = _encode_file(path, file_codec, crypter, stage, stats)
+            stored = self._store_staged(
+                path,
+                f_hash,
+                read_hash,
+                stage,
+                compress,
+                file_codec,
+                crypter,
+                after_obj_created,
+                packer,
+            )
+            stored.codec_stats = stats
+            return stored
+        finally:
+            stage.discard()
+
+    def _find_known(self, f_hash, compress, file_codec, crypter):
+        """StoredObject for content already in the store, so the file is not read."""
+        if not f_hash:
+            return None
+        known_path = self._store_path(f_hash, compress, file_codec, crypter)
+        if not self._object_exists(known_path):
+            return None
+        fmt = "framed" if file_codec or crypter else "raw"
+        return StoredObject(f_hash, known_path.name, fmt, copied=False)
+
+    def _store_staged(
+        self,
+        path,
+        f_hash,
+        read_hash,
+        stage,
+        compress,
+        file_codec,
+        crypter,
+        after_obj_created,
+        packer=None,
+    ) -> StoredObject:
+        """Moves an encoded object into the store unless its id already exists."""
+        fmt = "framed" if file_codec or crypter else "raw"
+        if f_hash and read_hash != f_hash:
+            logger.warning(f"{path} changed since the scan, storing current content")
+
+        obj_path = self._store_path(read_hash, compress, file_codec, crypter)
+        if self._object_exists(obj_path):
+            # dropped before anything is written
+            return StoredObject(read_hash, obj_path.name, fmt, copied=False)
+        written = stage.size
+        data = stage.getvalue() if packer else None
+        if data is not None and written <= packs.PACK_THRESHOLD:
+            packer.add(obj_path.name, data)
+            return StoredObject(
+                read_hash, obj_path.name, fmt, copied=True, bytes_written=written
+            )
+        rel_path = obj_path.relative_to(self.backup_base)
+        if self.remote is not None:
+            # direct mode: a spilled object is handed over as its temp file
+            payload = stage.export()
+            self.object_index.add(obj_path.name)
+            if isinstance(payload, bytes):
+                after_obj_created(rel_path, payload)
+            else:
+                after_obj_created(rel_path, Path(payload), discard=True)
+            return StoredObject(
+                read_hash, obj_path.name, fmt, copied=True, bytes_written=written
+            )
+        committed = stage.commit(obj_path)
+        self.object_index.add(obj_path.name)
+
+        if after_obj_created:
+            # bytes for objects staged in memory, the object path for spilled ones
+            after_obj_created(rel_path, committed)
+        return StoredObject(
+            read_hash, obj_path.name, fmt, copied=True, bytes_written=written
+        )
+
+    def _store_path(self, content_hash, compress, file_codec, crypter) -> Path:
+        """Object path for content stored with the given settings."""
+        framed = bool(file_codec or crypter)
+        return self._get_object_path(
+            content_hash,
             encrypted=bool(crypter),
-            compressed=compress,
-            salt=current_salt,
+            compressed=bool(file_codec) if framed else compress,
+            salt=crypter.salt.hex() if crypter else "",
+            framed=framed,
+            codec=file_codec.name if file_codec else compressors.DEFAULT_CODEC,
         )
-        if obj_path.exists():
-            return 0, 1  # skipped
 
-        obj_path.parent.mkdir(parents=True, exist_ok=True)
-        with open(path, "rb") as f_in:
-            data = f_in.read()
-        if should_compress:
-            data = zlib.compress(data, level=6)
-        if should_compress or crypter:
-            data = self._add_padding(data)
-        if crypter:
-            data = crypter.encrypt(data)
-        with open(obj_path, "wb") as f_out:
-            f_out.write(data)
+    def _process_chunked(
+        self,
+        path,
+        f_hash,
+        compress,
+        file_codec,
+        crypter,
+        after_obj_created,
+        previous_entry=None,
+        packer: Optional[packs.PackWriter] = None,
+        encoded=None,
+    ) -> StoredObject:
+        """Splits a file into content-defined chunks, each stored as its own object.
+        Only chunks missing from the store are encoded and written.
+        An unchanged file whose previous chunks are all present is not read.
+        encoded is the result of _chunk_in_worker when a worker split the file."""
+        framed = bool(file_codec or crypter)
+        fmt = "framed" if framed else "raw"
+
+        def chunk_path(chunk_hash):
+            return self._store_path(chunk_hash, compress, file_codec, crypter)
+
+        if encoded is None:
+            known = self._find_known_chunks(
+                f_hash, previous_entry, compress, file_codec, crypter
+            )
+            if known:
+                return known
+
+        new_chunks, written = 0, 0
+        if encoded is not None:
+            read_hash, chunks, encoded_sizes, payload, stats = encoded
+            stage = _StagedObject.adopt(
+                self.objects_path, STAGE_IN_MEMORY_LIMIT, payload
+            )
+            try:
+                with stage.reader() as f_encoded:
+                    for (chunk_hash, _), size in zip(chunks, encoded_sizes):
+                        if size is None:
+                            continue  # already stored, or earlier in this file
+                        data = f_encoded.read(size)
+                        obj_path = chunk_path(chunk_hash)
+                        if self._object_exists(obj_path):
+                            continue
+                        self._store_chunk(obj_path, data, after_obj_created, packer)
+                        new_chunks += 1
+                        written += len(data)
+            finally:
+                stage.discard()
+        else:
+            # chunks are stored as they are encoded: only one is held at a time
+            stats = CodecStats()
+            read_hash, chunks, encoded_sizes = _encode_chunks(
+                path,
+                file_codec,
+                crypter,
+                lambda chunk_hash: self._object_exists(chunk_path(chunk_hash)),
+                lambda chunk_hash, data: self._store_chunk(
+                    chunk_path(chunk_hash), data, after_obj_created, packer
+                ),
+                stats,
+            )
+            stored = [size for size in encoded_sizes if size is not None]
+            new_chunks, written = len(stored), sum(stored)
+        if f_hash and read_hash != f_hash:
+            logger.warning(f"{path} changed since the scan, storing current content")
+        return StoredObject(
+            read_hash,
+            None,
+            fmt,
+            copied=new_chunks > 0,
+            chunks=chunks,
+            bytes_written=written,
+            codec_stats=stats,
+        )
+
+    def _find_known_chunks(
+        self, f_hash, previous_entry, compress, file_codec, crypter
+    ) -> Optional[StoredObject]:
+        """StoredObject for an unchanged file whose previous chunks are all
+        stored in the same format, so the file is not read; None otherwise."""
+        previous_chunks = (previous_entry or {}).get("chunks")
+        fmt = "framed" if file_codec or crypter else "raw"
+        if (
+            f_hash
+            and previous_chunks
+            and previous_entry.get("format") == fmt
+            and _codec_name(compressors.for_entry(previous_entry))
+            == _codec_name(file_codec)
+            and all(
+                self._object_exists(self._store_path(h, compress, file_codec, crypter))
+                for h, _ in previous_chunks
+            )
+        ):
+            return StoredObject(f_hash, None, fmt, copied=False, chunks=previous_chunks)
+        return None
+
+    def _stored_chunks(self, previous_entry, compress, file_codec, crypter) -> set[str]:
+        """Hashes of the previous chunks of a file that are already stored,
+        which a worker then does not encode again."""
+        return {
+            chunk_hash
+            for chunk_hash, _ in (previous_entry or {}).get("chunks") or []
+            if self._object_exists(
+                self._store_path(chunk_hash, compress, file_codec, crypter)
+            )
+        }
+
+    def _store_chunk(
+        self, obj_path: Path, data: bytes, after_obj_created, packer
+    ) -> None:
+        if packer and len(data) <= packs.PACK_THRESHOLD:
+            packer.add(obj_path.name, data)
+            return
+        if self.remote is None:
+            obj_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(obj_path, "wb") as f_out:
+                f_out.write(data)
+        self.object_index.add(obj_path.name)
         if after_obj_created:
             after_obj_created(obj_path.relative_to(self.backup_base), data)
-        return 1, 0  # copied
 
     def _decode_object(
         self,
@@ -118,9 +791,14 @@ class BackupManager:
                     pass
 
         if decompress_data and file_specific_compression:
+            codec = (
+                file_specific_compression
+                if isinstance(file_specific_compression, compressors.Codec)
+                else compressors.ZlibCodec()
+            )
             try:
-                data = zlib.decompress(data)
-            except Exception:
+                data = b"".join(codec.iter_decompress([data]))
+            except compressors.CorruptStreamError:
                 logger.error("Decompression error")
         return data
 
@@ -133,36 +811,170 @@ class BackupManager:
         compress: bool = True,
         password=None,
         forced_salt=None,
-        after_obj_created: Optional[Callable[[Path, bytes], None]] = None,
+        after_obj_created: Optional[Callable[..., None]] = None,
+        chunking: bool = False,
+        pack_objects: bool = False,
+        workers: int = 1,
+        session: Optional[UnlockSession] = None,
+        codec: str = compressors.DEFAULT_CODEC,
     ) -> CopyResult:
+        """Stores every scanned file and writes the snapshot manifest.
+        With chunking, files larger than chunker.MIN_SIZE are split into
+        content-defined chunks so a small change stores only the changed chunks.
+        With pack_objects, small objects are appended to pack files (packs.py)
+        instead of one file per object.
+        With workers > 1, files are compressed and encrypted in a process pool;
+        the manifest, counts and errors are the same as with one worker.
+        A session replaces password: its key cache derives each salt once.
+        codec selects the compressor as "name" or "name:level" (compressors.py);
+        the codec of every file is recorded in its manifest entry.
+        With a remote store, objects and packs exist only as uploads:
+        after_obj_created is required and is called with discard=True for
+        temporary files it must delete once they are uploaded."""
+        if self.remote is not None and after_obj_created is None:
+            raise ValueError("Backing up to a remote store needs an upload hook")
+        codec = compressors.parse_codec(codec) if compress else None
+        compress = codec is not None
         timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
         snapshot_dir = self.backup_base / project_name / timestamp
         snapshot_dir.mkdir(parents=True, exist_ok=True)
-        salt_bytes = bytes.fromhex(forced_salt) if forced_salt else None
-        crypter = FileCrypter(password, salt=salt_bytes) if password else None
+        crypter = None
+        if password or session:
+            salt = (
+                bytes.fromhex(forced_salt)
+                if forced_salt
+                else os.urandom(FileCrypter._SALT_LEN)
+            )
+            crypter = (
+                session.crypter(salt)
+                if session
+                else DEFAULT_KEY_CACHE.crypter(password, salt)
+            )
 
-        copied_count, skipped_count, errors = 0, 0, 0
-        manifest_files = {}
+        copied_count, skipped_count, errors, bytes_written = 0, 0, 0, 0
+        codec_stats: dict[str, CodecStats] = {}
+        manifest = manifests.ManifestWriter(snapshot_dir / manifests.MANIFEST_V2)
+        detector = CompressibilityDetector()
+        file_codecs: dict[Path, Optional[compressors.Codec]] = {}
 
-        for path, f_hash in scan_result.file_hashes.items():
-            should_compress = compress and (path.suffix.lower() not in NON_COMPRESSIBLE)
-            try:
-                c, s = self._process_object(
-                    path, f_hash, compress, should_compress, crypter, after_obj_created
+        def codec_for(path) -> Optional[compressors.Codec]:
+            # decided once per file: the object id and the manifest entry depend on it
+            if path not in file_codecs:
+                file_codecs[path] = _file_codec(path, codec, detector, scan_result)
+            return file_codecs[path]
+
+        def upload_pack(pack_path: Path, idx_path: Path):
+            # the pack goes first: an index never points to a missing pack
+            if self.remote is not None:
+                after_obj_created(
+                    pack_path.relative_to(self.backup_base), pack_path, discard=True
                 )
-                copied_count += c
-                skipped_count += s
-            except Exception as e:
-                logger.error(f"Failed to process {path}: {e}")
+            else:
+                after_obj_created(pack_path.relative_to(self.backup_base), pack_path)
+            after_obj_created(
+                idx_path.relative_to(self.backup_base), idx_path.read_bytes()
+            )
+
+        packer = (
+            packs.PackWriter(
+                self.packs_path,
+                self.pack_index,
+                on_sealed=upload_pack if after_obj_created else None,
+            )
+            if pack_objects
+            else None
+        )
+
+        def store(path, f_hash, pending=None) -> StoredObject:
+            file_codec = codec_for(path)
+            if self._is_chunked(scan_result, path, chunking):
+                return self._process_chunked(
+                    path,
+                    f_hash,
+                    compress,
+                    file_codec,
+                    crypter,
+                    after_obj_created,
+                    scan_result.previous_entries.get(path),
+                    packer,
+                    pending.result() if pending is not None else None,
+                )
+            if pending is not None:
+                # encoded by a worker: only the store step runs here
+                read_hash, payload, stats = pending.result()
+                stage = _StagedObject.adopt(
+                    self.objects_path, STAGE_IN_MEMORY_LIMIT, payload
+                )
+                try:
+                    stored = self._store_staged(
+                        path,
+                        f_hash,
+                        read_hash,
+                        stage,
+                        compress,
+                        file_codec,
+                        crypter,
+                        after_obj_created,
+                        packer,
+                    )
+                    stored.codec_stats = stats
+                    return stored
+                finally:
+                    stage.discard()
+            return self._process_object(
+                path,
+                f_hash,
+                compress,
+                file_codec,
+                crypter,
+                after_obj_created,
+                packer,
+            )
+
+        if workers > 1:
+            results = self._store_parallel(
+                scan_result, store, compress, codec_for, crypter, chunking, workers
+            )
+        else:
+            results = self._store_serial(scan_result, store)
+
+        for path, stored in results:
+            file_codec = file_codecs.get(path)
+            file_stat = scan_result.file_stats.get(path)
+            if isinstance(stored, Exception):
+                logger.error(f"Failed to process {path}: {stored}")
                 errors += 1
                 continue
+            copied_count += stored.copied
+            skipped_count += not stored.copied
+            bytes_written += stored.bytes_written
+            if file_codec and stored.codec_stats and stored.codec_stats.bytes_in:
+                codec_stats.setdefault(file_codec.label, CodecStats()).merge(
+                    stored.codec_stats
+                )
 
             rel_path = path.relative_to(source_path)
             # Important: write flag "compressed" in the manifest for each file
-            manifest_files[str(rel_path)] = {
-                "hash": f_hash,
-                "compressed": should_compress,
+            entry = {
+                "hash": stored.file_hash,
+                "compressed": bool(file_codec),
+                "format": stored.format,
             }
+            if file_codec:
+                entry["codec"] = file_codec.name
+                level = _written_level(
+                    stored, file_codec, scan_result.previous_entries.get(path)
+                )
+                if level is not None:
+                    entry["level"] = level
+            if stored.chunks:
+                entry["chunks"] = stored.chunks
+            else:
+                entry["object"] = stored.object_id
+            # Stat fingerprint lets the next scan reuse this hash without reading the file
+            if file_stat:
+                entry.update(file_stat.to_entry())
+            manifest.add(str(rel_path), entry)
 
             show_progress(
                 ProgressEvent(
@@ -172,38 +984,46 @@ class BackupManager:
                 )
             )
 
-        manifest = {
-            "info": {
-                "timestamp": timestamp,
-                "salt": crypter.salt.hex() if crypter else None,
-                "encryption": "ChaCha20-Poly1305" if crypter else None,
-                "kdf_params": (
-                    {
-                        "algorithm": "argon2id",
-                        "time_cost": FileCrypter._TIME_COST,
-                        "memory_cost": FileCrypter._MEMORY_COST,
-                        "parallelism": FileCrypter._PARALLELISM,
-                    }
-                    if crypter
-                    else None
-                ),
-                "comment": comment,
-                "total_files": scan_result.total_files,
-                "compression_enabled": compress,
-            },
-            "files": manifest_files,
-        }
+        if packer:
+            packer.close()  # objects must be sealed before the manifest refers to them
+        self.object_index.flush()
 
-        manifest_path = snapshot_dir / MANIFEST_FILE
-        with open(manifest_path, "w", encoding="utf-8") as f:
-            json.dump(manifest, f, indent=4, ensure_ascii=False)
+        info = {
+            "timestamp": timestamp,
+            "salt": crypter.salt.hex() if crypter else None,
+            "encryption": "ChaCha20-Poly1305" if crypter else None,
+            "key_check": crypter.key_check() if crypter else None,
+            "kdf_params": (
+                {
+                    "algorithm": "argon2id",
+                    "time_cost": FileCrypter._TIME_COST,
+                    "memory_cost": FileCrypter._MEMORY_COST,
+                    "parallelism": FileCrypter._PARALLELISM,
+                }
+                if crypter
+                else None
+            ),
+            "comment": comment,
+            "total_files": scan_result.total_files,
+            "compression_enabled": compress,
+            "codec": codec.name if codec else None,
+            "chunking": (
+                {
+                    "algorithm": "fastcdc",
+                    "min_size": chunker.MIN_SIZE,
+                    "avg_size": chunker.AVG_SIZE,
+                    "max_size": chunker.MAX_SIZE,
+                }
+                if chunking
+                else None
+            ),
+        }
+        manifest.close(info)
+        self.record_snapshot(snapshot_dir)
 
         if after_obj_created:
-            manifest_data = json.dumps(manifest, indent=4, ensure_ascii=False).encode(
-                "utf-8"
-            )
             after_obj_created(
-                manifest_path.relative_to(self.backup_base), manifest_data
+                manifest.path.relative_to(self.backup_base), manifest.path
             )
 
         print()
@@ -212,102 +1032,307 @@ class BackupManager:
             skipped=skipped_count,
             errors=errors,
             quantity_versions=0,
+            bytes_written=bytes_written,
+            codec_stats=codec_stats,
         )
 
+    def _is_chunked(self, scan_result: ScanResult, path: Path, chunking: bool) -> bool:
+        file_stat = scan_result.file_stats.get(path)
+        return chunking and (file_stat is None or file_stat.size > chunker.MIN_SIZE)
+
+    def _store_serial(self, scan_result: ScanResult, store):
+        """Yields (path, StoredObject or the exception) in scan order."""
+        for path, f_hash in scan_result.file_hashes.items():
+            try:
+                yield path, store(path, f_hash)
+            except Exception as e:
+                yield path, e
+
+    def _store_parallel(
+        self, scan_result, store, compress, codec_for, crypter, chunking, workers
+    ):
+        """Like _store_serial, but files are encoded, and chunked files split, in
+        a process pool.
+        The key is derived once here and handed to the workers; objects are
+        moved into the store here, in scan order, so the results are the same
+        as in the serial path."""
+        key = crypter.key if crypter else None
+        salt = crypter.salt if crypter else None
+        with ProcessPoolExecutor(
+            max_workers=workers, initializer=_init_worker, initargs=(key, salt)
+        ) as pool:
+            in_flight = deque()
+            for path, f_hash in scan_result.file_hashes.items():
+                file_codec = codec_for(path)
+                future = None
+                # Already stored files are settled here, without a worker
+                if self._is_chunked(scan_result, path, chunking):
+                    previous_entry = scan_result.previous_entries.get(path)
+                    known = self._find_known_chunks(
+                        f_hash, previous_entry, compress, file_codec, crypter
+                    )
+                    if not known:
+                        future = pool.submit(
+                            _chunk_in_worker,
+                            path,
+                            file_codec,
+                            self._stored_chunks(
+                                previous_entry, compress, file_codec, crypter
+                            ),
+                            self.objects_path,
+                            STAGE_IN_MEMORY_LIMIT,
+                        )
+                else:
+                    known = self._find_known(f_hash, compress, file_codec, crypter)
+                    if not known:
+                        future = pool.submit(
+                            _encode_in_worker,
+                            path,
+                            file_codec,
+                            self.objects_path,
+                            STAGE_IN_MEMORY_LIMIT,
+                        )
+                in_flight.append((path, f_hash, future, known))
+                if len(in_flight) >= workers * QUEUE_DEPTH_PER_WORKER:
+                    yield self._finish_parallel(store, *in_flight.popleft())
+            while in_flight:
+                yield self._finish_parallel(store, *in_flight.popleft())
+
+    def _finish_parallel(self, store, path, f_hash, future, known):
+        if known:
+            return path, known  # probed when the file was queued, not again
+        try:
+            return path, store(path, f_hash, future)
+        except Exception as e:
+            return path, e
+
     def restore_version(
         self,
         project_name: str,
         version_name: str,
-        target_path: Path,
+        target_path: Optional[Path],
         password=None,
         decrypt_data=True,
         decompress_data=True,
-        fetch_proxy: Optional[Callable[[Path], bytes]] = None,
+        fetch_proxy: Optional[Callable[..., bytes | BinaryIO]] = None,
+        workers: int = 1,
+        fetch_workers: int = 1,
+        session: Optional[UnlockSession] = None,
+        verify_only: bool = False,
+        sync: bool = False,
+        hardlink_duplicates: bool = False,
     ):
+        """Restores a snapshot into target_path/<project>_<version>.
+        With workers > 1, files are decoded and written by a thread pool; with
+        fetch_proxy and fetch_workers > 1, objects are downloaded ahead of the
+        decoders by a pool of fetchers. Results, progress and errors are
+        reported in manifest order either way.
+        Every file is hashed as it is written; a file whose hash differs from
+        the manifest is reported as failed. With verify_only, files are decoded
+        and checked the same way but nothing is written (target_path is unused).
+        With sync, files are restored into target_path itself and only files
+        that differ from the snapshot are fetched and written: a file with the
+        size and mtime of its manifest entry is kept as is, one with the same
+        size but another mtime is hashed first.
+        Entries stored in the same objects are fetched and decoded once; the
+        other paths are copied from the first one (reflink or in-kernel copy
+        where supported) or, with hardlink_duplicates, hardlinked to it."""
+        clean = decrypt_data and decompress_data
+        if (verify_only or sync) and not clean:
+            raise ValueError(
+                "verify_only and sync compare decoded files: decrypt and decompress"
+            )
         # 1. Path for safe restore
-        safe_restore_path = target_path / f"{project_name}_{version_name}"
-        safe_restore_path.mkdir(parents=True, exist_ok=True)
+        safe_restore_path = None
+        if sync:
+            safe_restore_path = target_path
+            safe_restore_path.mkdir(parents=True, exist_ok=True)
+        elif not verify_only:
+            safe_restore_path = target_path / f"{project_name}_{version_name}"
+            safe_restore_path.mkdir(parents=True, exist_ok=True)
 
-        manifest_path = self.backup_base / project_name / version_name / MANIFEST_FILE
-        with open(manifest_path, "r", encoding="utf-8") as f:
-            manifest = json.load(f)
+        manifest = manifests.open_manifest(
+            self.backup_base / project_name / version_name
+        )
 
         salt_hex = manifest["info"].get("salt")
-        crypter = self._crypter_from_manifest(manifest, password) if password else None
+        crypter = (
+            self._crypter_from_manifest(manifest, password, session)
+            if password or session
+            else None
+        )
 
         total_files = manifest["info"]["total_files"]
         success_count = 0
         error_list = []
+        damaged_count = 0
+        current = []  # sync: targets already matching the snapshot
+        copy_methods: dict[str, int] = {}
+        copy_methods_lock = threading.Lock()  # restore_entry runs in the pool
         results = {}
-        print(f"\n[RESTORE] Restoring {total_files} files to: {safe_restore_path}")
+        if verify_only:
+            print(
+                f"\n[VERIFY] Checking {total_files} files of {project_name}/{version_name}"
+            )
+        else:
+            print(f"\n[RESTORE] Restoring {total_files} files to: {safe_restore_path}")
 
         global_compression = manifest["info"].get("compression_enabled", False)
 
-        for i, (rel_path_str, info) in enumerate(manifest["files"].items(), 1):
-            file_hash = info["hash"]
-            is_encrypted = bool(salt_hex)
-            obj_path = self._get_object_path(
-                file_hash,
-                encrypted=is_encrypted,
-                compressed=global_compression,
-                salt=salt_hex or "",
-            )
+        def count_copy(method: str) -> None:
+            with copy_methods_lock:
+                copy_methods[method] = copy_methods.get(method, 0) + 1
 
-            file_specific_compression = info.get("compressed", False)
+        def is_current(info, final_path) -> bool:
+            matches = _target_matches(final_path, info)
+            if matches is None and get_file_hash(final_path) == info["hash"]:
+                _restore_mtime(final_path, info)
+                matches = True
+            if matches:
+                current.append(final_path)
+            return bool(matches)
 
-            dest_path = safe_restore_path / rel_path_str
-            results[rel_path_str] = False
+        def restore_entry(info, final_path, prefetched=None) -> str:
+            if sync and is_current(info, final_path):
+                return info["hash"]
+            if (
+                not verify_only
+                and not fetch_proxy
+                and self._stored_as_restored(
+                    info, salt_hex, decrypt_data, decompress_data
+                )
+            ):
+                final_path.parent.mkdir(parents=True, exist_ok=True)
+                method = self._copy_stored_object(
+                    self._entry_object_paths(info, salt_hex, global_compression)[0],
+                    final_path,
+                )
+                count_copy(method)
+                if not clean:
+                    # technical mode: settle has no plaintext hash to compare with
+                    return info["hash"]
+                _restore_mtime(final_path, info)
+                # the copied bytes never passed through here: checking costs one read
+                with open(final_path, "rb") as f_written:
+                    return hashlib.file_digest(f_written, "sha256").hexdigest()
+            # Read data from "objects" and decode it as a stream
+            chunks = self._iter_entry(
+                info,
+                crypter,
+                salt_hex,
+                global_compression,
+                decrypt_data,
+                decompress_data,
+                fetch_proxy,
+                prefetched,
+            )
+            if verify_only:
+                return _hash_chunks(chunks)
+            final_path.parent.mkdir(parents=True, exist_ok=True)
+            written_hash = self._write_chunks(chunks, final_path)
+            if clean:
+                _restore_mtime(final_path, info)
+            return written_hash
 
-            try:
-                dest_path.parent.mkdir(parents=True, exist_ok=True)
+        def fetch_paths(info, final_path) -> list[Path]:
+            # sync: no download for a target that may already be current
+            if sync and _target_matches(final_path, info) is not False:
+                return []
+            return self._entry_object_paths(info, salt_hex, global_compression)
 
-                # Read data from "objects"
-                if fetch_proxy:
-                    data = fetch_proxy(obj_path.relative_to(self.backup_base))
-                else:
-                    with open(obj_path, "rb") as f_in:
-                        data = f_in.read()
+        def copy_duplicate(primary_rel, rel_path_str, info) -> str:
+            if verify_only:
+                return info["hash"]  # same objects as the verified primary
+            final_path = self._final_path(safe_restore_path, rel_path_str, clean)
+            if sync and is_current(info, final_path):
+                return info["hash"]
+            final_path.parent.mkdir(parents=True, exist_ok=True)
+            method = fileclone.clone_file(
+                self._final_path(safe_restore_path, primary_rel, clean),
+                final_path,
+                hardlink=hardlink_duplicates,
+            )
+            count_copy(method)
+            if clean and method != "hardlink":
+                _restore_mtime(final_path, info)
+            return info["hash"]
 
-                data = self._decode_object(
-                    data,
-                    crypter,
-                    salt_hex,
-                    file_specific_compression,
-                    decrypt_data,
-                    decompress_data,
-                )
+        # Entries stored in the same objects are fetched and decoded once
+        unique_files, duplicates = self._group_duplicates(
+            manifest["files"], salt_hex, global_compression
+        )
 
-                # Write clean data
-                final_path = (
-                    dest_path
-                    if (decrypt_data and decompress_data)
-                    else dest_path.with_suffix(dest_path.suffix + ".raw")
-                )
-                with open(final_path, "wb") as f_out:
-                    f_out.write(data)
+        if workers > 1 or (fetch_proxy and fetch_workers > 1):
+            outcomes = self._restore_parallel(
+                unique_files,
+                restore_entry,
+                fetch_paths,
+                safe_restore_path,
+                clean,
+                fetch_proxy,
+                workers,
+                fetch_workers,
+            )
+        else:
+            outcomes = self._restore_serial(
+                unique_files,
+                restore_entry,
+                safe_restore_path,
+                clean,
+            )
 
-                success_count += 1
-                results[rel_path_str] = True
+        def settle(rel_path_str, info, outcome) -> bool:
+            nonlocal success_count, damaged_count
+            results[rel_path_str] = False
+            if isinstance(outcome, Exception):
+                error_list.append(f"{rel_path_str}: {outcome}")
+                return False
 
-                # --- VERIFY ---
-                if decrypt_data and decompress_data:
-                    if get_file_hash(final_path) != info["hash"]:
-                        print(f"ALARM: {rel_path_str} damaged!")
+            # --- VERIFY --- (hash of the written plaintext, no second read)
+            if clean and outcome != info["hash"]:
+                print(f"ALARM: {rel_path_str} damaged!")
+                damaged_count += 1
+                return False
 
-                show_progress(
-                    ProgressEvent(
-                        processed=i, total=total_files, current_file=rel_path_str
-                    )
+            success_count += 1
+            results[rel_path_str] = True
+            show_progress(
+                ProgressEvent(
+                    processed=len(results), total=total_files, current_file=rel_path_str
                 )
+            )
+            return True
 
-            except PermissionError as e:
-                print(f"\n[!!!] {e}")
+        for rel_path_str, info, outcome in outcomes:
+            if isinstance(outcome, PermissionError):
+                results[rel_path_str] = False
+                print(f"\n[!!!] {outcome}")
+                outcomes.close()  # stops the pools, cancels what was not started
                 return results
-            except Exception as e:
-                error_list.append(f"{rel_path_str}: {e}")
+            restored = settle(rel_path_str, info, outcome)
+            for dup_path, dup_info in duplicates.get(rel_path_str, ()):
+                # a failed or damaged primary fails its duplicates the same way
+                dup_outcome = outcome
+                if restored:
+                    try:
+                        dup_outcome = copy_duplicate(rel_path_str, dup_path, dup_info)
+                    except Exception as e:
+                        dup_outcome = e
+                settle(dup_path, dup_info, dup_outcome)
 
-        print(f"\n\n=== The results of the restoration ===")
-        print(f"Successfully:   {success_count} / {total_files}")
+        if verify_only:
+            print("\n\n=== The results of the verification ===")
+            print(f"Intact:   {success_count} / {total_files}")
+        else:
+            print("\n\n=== The results of the restoration ===")
+            print(f"Successfully:   {success_count} / {total_files}")
+        if sync:
+            print(f"Already current: {len(current)}")
+        if copy_methods:
+            methods = ", ".join(f"{n} {m}" for m, n in sorted(copy_methods.items()))
+            print(f"Copied without decoding: {sum(copy_methods.values())} ({methods})")
+        if damaged_count:
+            print(f"Damaged:  {damaged_count}")
         print()
         if error_list:
             print(f"Errors:    {len(error_list)}")
@@ -317,10 +1342,251 @@ class BackupManager:
 
         return results
 
+    def _stored_as_restored(
+        self, info: dict, salt_hex, decrypt_data: bool, decompress_data: bool
+    ) -> bool:
+        """True if the single object of an entry holds exactly the bytes to restore:
+        raw objects, and any object in technical mode."""
+        if info.get("chunks"):
+            return False
+        fmt = info.get("format")
+        if fmt == "raw" or not (decrypt_data or decompress_data):
+            return True
+        if fmt == "framed":
+            return not (decrypt_data and decompress_data)
+        # written before the framed format: raw unless encrypted or compressed
+        return not salt_hex and not info.get("compressed", False)
+
+    def _copy_stored_object(self, obj_path: Path, final_path: Path) -> str:
+        """Copies an object to final_path in the kernel where possible
+        (fileclone.py): a reflink or copy_file_range, a range of the pack
+        for packed objects. Returns the method used."""
+        location = self.pack_index.get(obj_path.name)
+        if location:
+            return fileclone.copy_range(
+                packs.pack_path(self.packs_path, location.pack_id),
+                location.offset,
+                location.length,
+                final_path,
+            )
+        return fileclone.clone_file(obj_path, final_path)
+
+    def _group_duplicates(
+        self, files: Mapping, salt_hex, global_compression
+    ) -> tuple[dict, dict[str, list[tuple[str, dict]]]]:
+        """Splits manifest entries into the first entry for each set of objects
+        and, per first entry, the later entries stored in the same objects."""
+        first_by_objects = {}
+        unique_files, duplicates = {}, {}
+        for rel_path_str, info in files.items():
+            key = (
+                info.get("format"),
+                info.get("compressed", False),
+                tuple(self._entry_object_paths(info, salt_hex, global_compression)),
+            )
+            primary = first_by_objects.setdefault(key, rel_path_str)
+            if primary == rel_path_str:
+                unique_files[rel_path_str] = info
+            else:
+                duplicates.setdefault(primary, []).append((rel_path_str, info))
+        return unique_files, duplicates
+
+    def _final_path(
+        self, restore_root: Optional[Path], rel_path_str: str, clean: bool
+    ) -> Optional[Path]:
+        if restore_root is None:
+            return None  # verify only, nothing is written
+        # Write clean data; technical mode keeps the stored bytes as <name>.raw
+        dest_path = restore_root / rel_path_str
+        return dest_path if clean else dest_path.with_suffix(dest_path.suffix + ".raw")
+
+    def _restore_serial(self, files: dict, restore_entry, restore_root, clean):
+        """Yields (rel_path, info, written hash or the exception) in manifest order."""
+        for rel_path_str, info in files.items():
+            try:
+                final_path = self._final_path(restore_root, rel_path_str, clean)
+                yield rel_path_str, info, restore_entry(info, final_path)
+            except Exception as e:
+                yield rel_path_str, info, e
+
+    def _restore_parallel(
+        self,
+        files: dict,
+        restore_entry,
+        fetch_paths,
+        restore_root,
+        clean,
+        fetch_proxy,
+        workers,
+        fetch_workers,
+    ):
+        """Like _restore_serial, with decode/write in a thread pool and, for
+        remote storage, objects downloaded ahead by a pool of fetchers.
+        At most (workers + fetch_workers) * QUEUE_DEPTH_PER_WORKER files are in
+        flight, which also bounds the memory held by prefetched objects."""
+        _ = self.pack_index  # loaded here once, not concurrently by the threads
+        window = (workers + fetch_workers) * QUEUE_DEPTH_PER_WORKER
+        fetch_pool = (
+            ThreadPoolExecutor(max_workers=fetch_workers) if fetch_proxy else None
+        )
+        pool = ThreadPoolExecutor(max_workers=workers)
+        in_flight = deque()
+
+        def finish():
+            rel_path_str, info, future = in_flight.popleft()
+            try:
+                return rel_path_str, info, future.result()
+            except Exception as e:
+                return rel_path_str, info, e
+
+        try:
+            for rel_path_str, info in files.items():
+                prefetched = None
+                final_path = self._final_path(restore_root, rel_path_str, clean)
+                paths = fetch_paths(info, final_path) if fetch_pool else []
+                # Chunked files may be large: their chunks are fetched while decoding
+                if len(paths) == 1:
+                    prefetched = [
+                        fetch_pool.submit(self._fetch_object, paths[0], fetch_proxy)
+                    ]
+                future = pool.submit(restore_entry, info, final_path, prefetched)
+                in_flight.append((rel_path_str, info, future))
+                if len(in_flight) >= window:
+                    yield finish()
+            while in_flight:
+                yield finish()
+        finally:
+            for _, _, future in in_flight:
+                future.cancel()
+            pool.shutdown(wait=True, cancel_futures=True)
+            if fetch_pool:
+                fetch_pool.shutdown(wait=True, cancel_futures=True)
+
+    def _object_path_for_entry(
+        self, info: dict, salt_hex: str | None, global_compression: bool
+    ) -> Path:
+        """Object of a manifest entry: the recorded id, or the path derived
+        from the hash for manifests written before object ids were recorded."""
+        object_id = info.get("object")
+        if object_id:
+            return self.objects_path / object_id[:2] / object_id
+        return self._get_object_path(
+            info["hash"],
+            encrypted=bool(salt_hex),
+            compressed=global_compression,
+            salt=salt_hex or "",
+        )
+
+    def _entry_object_paths(
+        self, info: dict, salt_hex: str | None, global_compression: bool
+    ) -> list[Path]:
+        """Objects holding the content of a manifest entry, in order."""
+        if not info.get("chunks"):
+            return [self._object_path_for_entry(info, salt_hex, global_compression)]
+        framed = info.get("format") == "framed"
+        return [
+            self._get_object_path(
+                chunk_hash,
+                encrypted=bool(salt_hex),
+                compressed=(
+                    info.get("compressed", False) if framed else global_compression
+                ),
+                salt=salt_hex or "",
+                framed=framed,
+                codec=info.get("codec", compressors.DEFAULT_CODEC),
+            )
+            for chunk_hash, _ in info["chunks"]
+        ]
+
+    def _iter_entry(
+        self,
+        info,
+        crypter,
+        salt_hex,
+        global_compression,
+        decrypt_data,
+        decompress_data,
+        fetch_proxy=None,
+        prefetched: Optional[list[Future]] = None,
+    ) -> Iterator[bytes]:
+        """Yields the restored content of a manifest entry, chunk by chunk.
+        prefetched holds downloads of the entry's objects started in advance."""
+        obj_paths = self._entry_object_paths(info, salt_hex, global_compression)
+        for n, obj_path in enumerate(obj_paths):
+            if prefetched:
+                f_obj = _as_file(prefetched[n].result())
+            else:
+                f_obj = self._open_object(obj_path, fetch_proxy)
+            with f_obj:
+                yield from self._iter_plaintext(
+                    info, f_obj, crypter, salt_hex, decrypt_data, decompress_data
+                )
+
+    def _open_object(self, obj_path: Path, fetch_proxy=None) -> BinaryIO:
+        """Opens a standalone or packed object; fetch_proxy(rel_path, byte_range=None)
+        downloads it, packed objects with a ranged request, as bytes or a file."""
+        if fetch_proxy:
+            return _as_file(self._fetch_object(obj_path, fetch_proxy))
+        location = self.pack_index.get(obj_path.name)
+        if location:
+            return io.BytesIO(packs.read_packed(self.packs_path, location))
+        return open(obj_path, "rb")
+
+    def _fetch_object(self, obj_path: Path, fetch_proxy) -> bytes | BinaryIO:
+        """Downloads an object; a packed one with a ranged request."""
+        location = self.pack_index.get(obj_path.name)
+        if location:
+            rel_pack = packs.pack_path(self.packs_path, location.pack_id)
+            return fetch_proxy(
+                rel_pack.relative_to(self.backup_base),
+                (location.offset, location.length),
+            )
+        return fetch_proxy(obj_path.relative_to(self.backup_base))
+
+    def _iter_plaintext(
+        self, info, f_obj, crypter, salt_hex, decrypt_data, decompress_data
+    ) -> Iterator[bytes]:
+        """Yields the restored content of an object in bounded chunks.
+        Technical mode (no decrypt/decompress) yields the stored bytes."""
+        fmt = info.get("format")
+        if fmt == "raw" or (fmt == "framed" and not (decrypt_data and decompress_data)):
+            yield from iter(lambda: f_obj.read(READ_BLOCK_SIZE), b"")
+        elif fmt == "framed":
+            if salt_hex and not crypter:
+                raise ValueError("Object is encrypted, password required")
+            yield from frames.iter_decoded(f_obj, compressors.for_entry(info), crypter)
+        else:
+            # Objects written before the framed format are decoded in memory
+            yield self._decode_object(
+                f_obj.read(),
+                crypter,
+                salt_hex,
+                compressors.for_entry(info),
+                decrypt_data,
+                decompress_data,
+            )
+
+    def _write_chunks(self, chunks: Iterator[bytes], final_path: Path) -> str:
+        """Writes chunks to final_path and returns the SHA-256 of what was written.
+        The file is replaced only once complete: a failed restore leaves the
+        previous file (if any) in place and no partial file behind."""
+        sha256 = hashlib.sha256()
+        part_path = final_path.with_name(f".{final_path.name}.part")
+        try:
+            with open(part_path, "wb") as f_out:
+                for chunk in chunks:
+                    sha256.update(chunk)
+                    f_out.write(chunk)
+            os.replace(part_path, final_path)
+        except BaseException:
+            part_path.unlink(missing_ok=True)
+            raise
+        return sha256.hexdigest()
+
     def _version_matches(self, v_dir: Path, date_hint: str | None) -> bool:
         if not v_dir.is_dir():
             return False
-        if not (v_dir / MANIFEST_FILE).exists():
+        if not manifests.manifest_path(v_dir).exists():
             return False
         if date_hint and date_hint not in v_dir.name:
             return False
@@ -338,7 +1604,7 @@ class BackupManager:
             else [
                 d
                 for d in self.backup_base.iterdir()
-                if d.is_dir() and d.name != "objects"
+                if d.is_dir() and d.name not in ("objects", "packs")
             ]
         )
 
@@ -353,65 +1619,108 @@ class BackupManager:
         versions.sort(key=lambda x: x.name)
         return versions
 
+    def load_latest_manifest(self, project_name: str) -> Mapping | None:
+        """Returns the manifest of the newest local version of the project."""
+        versions = self._find_target_versions(project_name)
+        if not versions:
+            return None
+        try:
+            return manifests.open_manifest(versions[-1])
+        except (OSError, ValueError) as e:
+            logger.warning(f"Failed to load manifest {versions[-1]}: {e}")
+            return None
+
     def _crypter_from_manifest(
-        self, manifest: dict, password: str
+        self, manifest: Mapping, password: str, session: Optional[UnlockSession] = None
     ) -> "FileCrypter | None":
-        """Creates a FileCrypter with parameters from the manifest."""
+        """Creates a FileCrypter with parameters from the manifest.
+        Keys come from the session, or from the process-wide key cache."""
         salt_hex = manifest["info"].get("salt")
-        if not salt_hex or not password:
+        if not salt_hex or not (password or session):
             return None
         kdf = manifest["info"].get("kdf_params") or {}
-        return FileCrypter(
-            password,
-            salt=bytes.fromhex(salt_hex),
-            time_cost=kdf.get("time_cost"),
-            memory_cost=kdf.get("memory_cost"),
-            parallelism=kdf.get("parallelism"),
-        )
+        kdf = {
+            "time_cost": kdf.get("time_cost"),
+            "memory_cost": kdf.get("memory_cost"),
+            "parallelism": kdf.get("parallelism"),
+        }
+        if session:
+            return session.crypter(bytes.fromhex(salt_hex), **kdf)
+        return DEFAULT_KEY_CACHE.crypter(password, bytes.fromhex(salt_hex), **kdf)
 
-    def verify_password(self, project_name, version_name, password, fetch_proxy=None):
-        manifest_path = self.backup_base / project_name / version_name / MANIFEST_FILE
-        with open(manifest_path, "r", encoding="utf-8") as f:
-            manifest = json.load(f)
+    def verify_password(
+        self, project_name, version_name, password=None, fetch_proxy=None, session=None
+    ):
+        manifest = manifests.open_manifest(
+            self.backup_base / project_name / version_name
+        )
 
         salt_hex = manifest["info"].get("salt")
         if not salt_hex:
             return True  # No salt - no encrypt
 
-        # Try decrypt first file
+        test_crypter = self._crypter_from_manifest(manifest, password, session)
+        if test_crypter is None:
+            return False
+        key_check = manifest["info"].get("key_check")
+        if key_check:
+            return test_crypter.matches_key_check(key_check)
+
+        # Manifests without a key check: decrypt the smallest object
         files = manifest.get("files", {})
         if not files:
             return True
-        first_rel_path = next(iter(files))
-        info = manifest["files"][first_rel_path]
-
         is_compressed_globally = manifest["info"].get("compression_enabled", False)
-
-        obj_path = self._get_object_path(
-            info["hash"],
-            encrypted=True,
-            compressed=is_compressed_globally,
-            salt=salt_hex,
+        info = self._smallest_entry(
+            files, salt_hex, is_compressed_globally, fetch_proxy
         )
+        obj_path = self._entry_object_paths(info, salt_hex, is_compressed_globally)[0]
 
         try:
-            if fetch_proxy:
-                data = fetch_proxy(obj_path.relative_to(self.backup_base))
-            else:
-                if not obj_path.exists():
-                    logger.error(
-                        "Verification failed: Object %s not found.", obj_path.name
-                    )
-                    return False
-                with open(obj_path, "rb") as f:
-                    data = f.read()
-
-            test_crypter = self._crypter_from_manifest(manifest, password)
-            if test_crypter is None:
+            if not fetch_proxy and not self._object_exists(obj_path):
+                logger.error("Verification failed: Object %s not found.", obj_path.name)
                 return False
-            test_crypter.decrypt(data)
+
+            with self._open_object(obj_path, fetch_proxy) as f_obj:
+                if info.get("format") == "framed":
+                    # One frame is enough to authenticate the key
+                    frames.check_first_frame(f_obj, test_crypter)
+                else:
+                    test_crypter.decrypt(f_obj.read())
             return True
         except Exception as e:
             # If this is an authentication error ChaCha20Poly1305, False is returned
             logger.debug(f"Decryption check failed: {e}")
             return False
+
+    def _smallest_entry(
+        self, files: Mapping, salt_hex, global_compression, fetch_proxy
+    ):
+        """Entry whose first object is the smallest known one. Sizes come from
+        the manifest, from the local objects, or with fetch_proxy from the remote
+        storage (at most SIZE_PROBES requests); the first entry if none is known."""
+        probes = itertools.count()
+
+        def object_size(info):
+            if info.get("chunks"):
+                return info["chunks"][0][1]
+            if "size" in info:
+                return info["size"]
+            obj_path = self._entry_object_paths(info, salt_hex, global_compression)[0]
+            if fetch_proxy:
+                if self.remote is None or next(probes) >= SIZE_PROBES:
+                    return None
+                return self.remote.object_size(obj_path.relative_to(self.backup_base))
+            try:
+                return obj_path.stat().st_size
+            except OSError:
+                return None
+
+        sized = [
+            (size, n, info)
+            for n, info in enumerate(files.values())
+            if (size := object_size(info)) is not None
+        ]
+        if not sized:
+            return next(iter(files.values()))
+        return min(sized, key=lambda item: item[:2])[2]
@@ -0,0 +1,318 @@
+"""Snapshot manifests: reading both formats, writing format 2.
+
+Format 1 (manifest.json) is one JSON document, loaded whole.
+Format 2 (manifest.sbm) is written entry by entry and read lazily:
+
+    MAGIC | u32 header length | header JSON {"format": 2, "info": {...}}
+    blocks: zlib-compressed JSON Lines of [path, entry], sorted by path
+    path index: zlib-compressed JSON [[first path, offset, length, entries], ...]
+    footer: u64 index offset | u32 index length | u64 entries | MAGIC
+
+The header alone gives the snapshot info. A lookup by path reads one block
+found by binary search over the index; iteration streams block by block.
+The writer keeps at most RUN_ENTRIES entries in memory: longer manifests are
+sorted in runs spilled to temp files and merged when the manifest is closed.
+"""
+
+import bisect
+import heapq
+import io
+import itertools
+import json
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import zlib
+from collections import OrderedDict
+from collections.abc import ItemsView, Mapping, ValuesView
+from pathlib import Path
+from typing import BinaryIO, Callable, Iterator, Optional
+
+MANIFEST_V1 = "manifest.json"
+MANIFEST_V2 = "manifest.sbm"
+MANIFEST_NAMES = (MANIFEST_V2, MANIFEST_V1)
+FORMAT_VERSION = 2
+MAGIC = b"SBM2"
+BLOCK_ENTRIES = 4096
+BLOCK_LEVEL = 6
+RUN_ENTRIES = 100_000
+CACHED_BLOCKS = 8
+
+_HEADER_LEN = struct.Struct(">I")
+_FOOTER = struct.Struct(">QIQ4s")
+_DECODER = json.JSONDecoder()
+
+
+class ManifestError(ValueError):
+    pass
+
+
+def _record(path: str, entry: dict) -> str:
+    return json.dumps([path, entry], ensure_ascii=False, separators=(",", ":")) + "\n"
+
+
+def _record_path(line: str) -> str:
+    # a record starts with '["': decode the path without the entry
+    return _DECODER.raw_decode(line, 1)[0]
+
+
+class ManifestWriter:
+    """Writes a format 2 manifest to path. Entries can be added in any order;
+    the file appears only once close() succeeds."""
+
+    def __init__(self, path: Path, run_entries: int = RUN_ENTRIES):
+        self.path = path
+        self.count = 0
+        self._run_entries = run_entries
+        self._pending: list[tuple[str, dict]] = []
+        self._runs: list[Path] = []
+        self._spill_dir: Optional[tempfile.TemporaryDirectory] = None
+
+    def add(self, rel_path: str, entry: dict) -> None:
+        self._pending.append((rel_path, entry))
+        self.count += 1
+        if len(self._pending) >= self._run_entries:
+            self._spill()
+
+    def _spill(self) -> None:
+        if self._spill_dir is None:
+            # removed by discard(), or when the writer is collected after an error
+            self._spill_dir = tempfile.TemporaryDirectory(
+                prefix=".manifest-", dir=self.path.parent
+            )
+        self._pending.sort(key=lambda item: item[0])
+        run = Path(self._spill_dir.name) / f"{len(self._runs)}.jsonl"
+        with open(run, "w", encoding="utf-8") as f:
+            f.writelines(_record(path, entry) for path, entry in self._pending)
+        self._runs.append(run)
+        self._pending = []
+
+    def _sorted_records(self) -> Iterator[str]:
+        if not self._runs:
+            self._pending.sort(key=lambda item: item[0])
+            for path, entry in self._pending:
+                yield _record(path, entry)
+            return
+        self._spill()
+        runs = [open(run, "r", encoding="utf-8") for run in self._runs]
+        try:
+            yield from heapq.merge(*runs, key=_record_path)
+        finally:
+            for f in runs:
+                f.close()
+
+    def close(self, info: dict) -> None:
+        """Writes the header with info, the sorted entries and the path index."""
+        part = self.path.with_name(f".{self.path.name}.part")
+        try:
+            with open(part, "wb") as f:
+                header = json.dumps(
+                    {"format": FORMAT_VERSION, "info": info}, ensure_ascii=False
+                ).encode("utf-8")
+                f.write(MAGIC + _HEADER_LEN.pack(len(header)) + header)
+                index = []
+                for block in itertools.batched(self._sorted_records(), BLOCK_ENTRIES):
+                    data = zlib.compress("".join(block).encode("utf-8"), BLOCK_LEVEL)
+                    index.append(
+                        [_record_path(block[0]), f.tell(), len(data), len(block)]
+                    )
+                    f.write(data)
+                index_offset = f.tell()
+                index_data = zlib.compress(
+                    json.dumps(index, ensure_ascii=False).encode("utf-8"), BLOCK_LEVEL
+                )
+                f.write(index_data)
+                f.write(_FOOTER.pack(index_offset, len(index_data), self.count, MAGIC))
+            os.replace(part, self.path)
+        finally:
+            part.unlink(missing_ok=True)
+            self.discard()
+
+    def discard(self) -> None:
+        """Removes the spilled runs; the manifest is not written."""
+        self._pending = []
+        self._runs = []
+        if self._spill_dir is not None:
+            self._spill_dir.cleanup()
+            self._spill_dir = None
+
+
+def _read_header(f: BinaryIO) -> dict:
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ManifestError("Not a format 2 manifest")
+    (length,) = _HEADER_LEN.unpack(f.read(_HEADER_LEN.size))
+    header = json.loads(f.read(length))
+    if header.get("format") != FORMAT_VERSION:
+        raise ManifestError(f"Unsupported manifest format {header.get('format')!r}")
+    return header["info"]
+
+
+class ManifestFiles(Mapping):
+    """The entries of a format 2 manifest by relative path, read on demand.
+    The last CACHED_BLOCKS blocks used by lookups are kept decoded."""
+
+    def __init__(self, opener: Callable[[], BinaryIO], index: list, count: int):
+        self._open = opener
+        self._index = index
+        self._first_paths = [block[0] for block in index]
+        self._count = count
+        self._cache: OrderedDict[int, dict] = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _decode_block(data: bytes) -> dict:
+        try:
+            # records end with "\n" only: paths may hold U+2028 and other line
+            # separators that splitlines() would also split on
+            lines = zlib.decompress(data).decode("utf-8").split("\n")[:-1]
+        except zlib.error as e:
+            raise ManifestError(f"Manifest block is damaged: {e}") from e
+        return dict(json.loads(line) for line in lines)
+
+    def _block(self, n: int) -> dict:
+        with self._lock:
+            if n in self._cache:
+                self._cache.move_to_end(n)
+                return self._cache[n]
+        _, offset, length, _ = self._index[n]
+        with self._open() as f:
+            f.seek(offset)
+            block = self._decode_block(f.read(length))
+        with self._lock:
+            self._cache[n] = block
+            while len(self._cache) > CACHED_BLOCKS:
+                self._cache.popitem(last=False)
+        return block
+
+    def _iter_blocks(self) -> Iterator[dict]:
+        # sequential reads through one handle, without filling the cache
+        with self._open() as f:
+            for _, offset, length, _ in self._index:
+                f.seek(offset)
+                yield self._decode_block(f.read(length))
+
+    def __getitem__(self, rel_path: str) -> dict:
+        n = bisect.bisect_right(self._first_paths, rel_path) - 1
+        if n < 0:
+            raise KeyError(rel_path)
+        return self._block(n)[rel_path]
+
+    def __iter__(self) -> Iterator[str]:
+        for block in self._iter_blocks():
+            yield from block
+
+    def __len__(self) -> int:
+        return self._count
+
+    def items(self) -> ItemsView:
+        return _StreamedItems(self)
+
+    def values(self) -> ValuesView:
+        return _StreamedValues(self)
+
+
+class _StreamedItems(ItemsView):
+    def __iter__(self):
+        for block in self._mapping._iter_blocks():
+            yield from block.items()
+
+
+class _StreamedValues(ValuesView):
+    def __iter__(self):
+        for block in self._mapping._iter_blocks():
+            yield from block.values()
+
+
+class Manifest(Mapping):
+    """A format 2 manifest. Reads like the format 1 dict: manifest["info"] and
+    manifest["files"], but only the header and the path index are loaded."""
+
+    def __init__(self, opener: Callable[[], BinaryIO]):
+        self._open = opener
+        with opener() as f:
+            self.info = _read_header(f)
+            f.seek(0, os.SEEK_END)
+            if f.tell() < _FOOTER.size:
+                raise ManifestError("Manifest is truncated")
+            f.seek(-_FOOTER.size, os.SEEK_END)
+            index_offset, index_length, count, magic = _FOOTER.unpack(
+                f.read(_FOOTER.size)
+            )
+            if magic != MAGIC:
+                raise ManifestError("Manifest is truncated")
+            f.seek(index_offset)
+            try:
+                index = json.loads(zlib.decompress(f.read(index_length)))
+            except zlib.error as e:
+                raise ManifestError(f"Manifest index is damaged: {e}") from e
+        self.files = ManifestFiles(opener, index, count)
+
+    def __getitem__(self, key: str):
+        if key == "info":
+            return self.info
+        if key == "files":
+            return self.files
+        raise KeyError(key)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(("info", "files"))
+
+    def __len__(self) -> int:
+        return 2
+
+    def copy_to(self, path: Path) -> None:
+        with self._open() as f_src, open(path, "wb") as f_dst:
+            shutil.copyfileobj(f_src, f_dst)
+
+
+def manifest_path(v_dir: Path) -> Path:
+    """The manifest of a version directory: format 2 if present, else format 1.
+    The returned path may not exist."""
+    path = v_dir / MANIFEST_V2
+    return path if path.exists() else v_dir / MANIFEST_V1
+
+
+def is_manifest_name(name: str) -> bool:
+    return name.endswith(MANIFEST_NAMES)
+
+
+def open_manifest(v_dir: Path) -> Mapping:
+    """The manifest of a version directory, in either format.
+    Raises OSError if there is none, ValueError if it is damaged."""
+    path = manifest_path(v_dir)
+    if path.name == MANIFEST_V2:
+        return Manifest(lambda: open(path, "rb"))
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def read_info(v_dir: Path) -> dict:
+    """Snapshot info without the file entries (format 2 reads the header only)."""
+    path = manifest_path(v_dir)
+    if path.name == MANIFEST_V2:
+        with open(path, "rb") as f:
+            return _read_header(f)
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)["info"]
+
+
+def parse_manifest(data: bytes) -> Mapping:
+    """A manifest downloaded as bytes, in either format."""
+    if data.startswith(MAGIC):
+        return Manifest(lambda: io.BytesIO(data))
+    return json.loads(data)
+
+
+def save_copy(manifest: Mapping, v_dir: Path) -> Path:
+    """Stores a manifest obtained elsewhere (e.g. from the cloud) in v_dir,
+    in its own format. Returns the written path."""
+    if isinstance(manifest, Manifest):
+        path = v_dir / MANIFEST_V2
+        manifest.copy_to(path)
+    else:
+        path = v_dir / MANIFEST_V1
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=4, ensure_ascii=False)
+    return path
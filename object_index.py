@@ -0,0 +1,94 @@
+"""Persistent index of stored object ids.
+
+Answers "is this object already stored?" without a stat() per object locally
+or a HEAD request per object in the cloud. The index is a SQLite table in WAL
+mode; writes are committed in batches. After a crash the index may miss
+objects written since the last commit, never list objects that were not
+written, so a miss is always confirmed against the storage itself.
+"""
+
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Iterable
+
+COMMIT_EVERY = 1000
+
+
+class ObjectIndex:
+    def __init__(self, db_path: Path):
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS objects (id TEXT PRIMARY KEY) WITHOUT ROWID"
+        )
+        self._conn.commit()
+
+    def __contains__(self, object_id: str) -> bool:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT 1 FROM objects WHERE id = ?", (object_id,)
+            ).fetchone()
+        return row is not None
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM objects").fetchone()[0]
+
+    def add(self, object_id: str) -> None:
+        self.add_many([object_id])
+
+    def add_many(self, object_ids: Iterable[str]) -> None:
+        with self._lock:
+            cursor = self._conn.executemany(
+                "INSERT OR IGNORE INTO objects (id) VALUES (?)",
+                ((object_id,) for object_id in object_ids),
+            )
+            self._pending += max(cursor.rowcount, 0)
+            if self._pending >= COMMIT_EVERY:
+                self._commit()
+
+    def replace_all(self, object_ids: Iterable[str]) -> int:
+        """Rebuilds the index from a full listing. Returns the number of ids."""
+        with self._lock:
+            self._conn.execute("DELETE FROM objects")
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO objects (id) VALUES (?)",
+                ((object_id,) for object_id in object_ids),
+            )
+            self._commit()
+            return self._conn.execute("SELECT COUNT(*) FROM objects").fetchone()[0]
+
+    def replace_prefix(self, prefix: str, object_ids: Iterable[str]) -> int:
+        """Like replace_all for the ids starting with prefix, the others are
+        kept. Returns the number of ids with the prefix."""
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM objects WHERE substr(id, 1, ?) = ?", (len(prefix), prefix)
+            )
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO objects (id) VALUES (?)",
+                ((object_id,) for object_id in object_ids),
+            )
+            self._commit()
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM objects WHERE substr(id, 1, ?) = ?",
+                (len(prefix), prefix),
+            ).fetchone()[0]
+
+    def flush(self) -> None:
+        with self._lock:
+            self._commit()
+
+    def close(self) -> None:
+        self.flush()
+        self._conn.close()
+
+    def _commit(self) -> None:
+        self._conn.commit()
+        self._pending = 0
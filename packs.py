@@ -0,0 +1,156 @@
+"""Pack files: many small objects appended into one file.
+
+A pack is MAGIC followed by the encoded objects back to back. Its index
+(packs/<pack id>.idx) lists every object as a fixed-size record
+(object id, offset, length). The index is written when the pack is sealed,
+so an object is visible only once its pack is complete. Objects are stored
+exactly as they would be standalone, a packed object is read with one
+seek (locally) or one ranged GET (in the cloud).
+"""
+
+import os
+import struct
+from dataclasses import dataclass
+from pathlib import Path
+from typing import BinaryIO, Callable, Optional
+
+MAGIC = b"SBP1"
+INDEX_MAGIC = b"SBI1"
+PACK_TARGET_SIZE = 64 * 1024 * 1024
+# Encoded objects above this size are stored standalone
+PACK_THRESHOLD = 8 * 1024 * 1024
+
+_RECORD = struct.Struct(">32sQI")
+
+
+class CorruptPackError(ValueError):
+    pass
+
+
+@dataclass(frozen=True)
+class PackLocation:
+    pack_id: str
+    offset: int
+    length: int
+
+
+def pack_path(packs_dir: Path, pack_id: str) -> Path:
+    return packs_dir / f"{pack_id}.pack"
+
+
+def index_path(packs_dir: Path, pack_id: str) -> Path:
+    return packs_dir / f"{pack_id}.idx"
+
+
+def encode_index(entries: dict[str, PackLocation]) -> bytes:
+    records = [
+        _RECORD.pack(bytes.fromhex(object_id), loc.offset, loc.length)
+        for object_id, loc in sorted(entries.items())
+    ]
+    return INDEX_MAGIC + b"".join(records)
+
+
+def decode_index(pack_id: str, data: bytes) -> dict[str, PackLocation]:
+    if data[: len(INDEX_MAGIC)] != INDEX_MAGIC:
+        raise CorruptPackError(f"Not a pack index: {pack_id}")
+    body = data[len(INDEX_MAGIC) :]
+    if len(body) % _RECORD.size:
+        raise CorruptPackError(f"Pack index is truncated: {pack_id}")
+    return {
+        raw_id.hex(): PackLocation(pack_id, offset, length)
+        for raw_id, offset, length in _RECORD.iter_unpack(body)
+    }
+
+
+class PackIndex:
+    """Object id -> PackLocation for every sealed pack in packs_dir."""
+
+    def __init__(self, packs_dir: Path):
+        self.packs_dir = packs_dir
+        self._locations: dict[str, PackLocation] = {}
+        self.load()
+
+    def load(self) -> None:
+        """(Re)reads all pack indexes, e.g. after they were synced from the cloud."""
+        self._locations = {}
+        if not self.packs_dir.exists():
+            return
+        for idx in sorted(self.packs_dir.glob("*.idx")):
+            self._locations.update(decode_index(idx.stem, idx.read_bytes()))
+
+    def add(self, object_id: str, location: PackLocation) -> None:
+        self._locations[object_id] = location
+
+    def get(self, object_id: str) -> Optional[PackLocation]:
+        return self._locations.get(object_id)
+
+    def __contains__(self, object_id: str) -> bool:
+        return object_id in self._locations
+
+    def __len__(self) -> int:
+        return len(self._locations)
+
+
+class PackWriter:
+    """Appends objects to the current pack and seals it at target_size.
+    on_sealed(pack_path, index_path) is called once both files are complete."""
+
+    def __init__(
+        self,
+        packs_dir: Path,
+        index: PackIndex,
+        target_size: int = PACK_TARGET_SIZE,
+        on_sealed: Optional[Callable[[Path, Path], None]] = None,
+    ):
+        self.packs_dir = packs_dir
+        self.index = index
+        self.target_size = target_size
+        self.on_sealed = on_sealed
+        self._pack_id = None
+        self._file: Optional[BinaryIO] = None
+        self._entries: dict[str, PackLocation] = {}
+
+    def add(self, object_id: str, data: bytes) -> PackLocation:
+        if self._file is None:
+            self._open()
+        offset = self._file.tell()
+        self._file.write(data)
+        location = PackLocation(self._pack_id, offset, len(data))
+        self._entries[object_id] = location
+        # visible to deduplication in this run right away
+        self.index.add(object_id, location)
+        if self._file.tell() >= self.target_size:
+            self.close()
+        return location
+
+    def close(self) -> None:
+        """Seals the current pack: flushes it and writes its index."""
+        if self._file is None:
+            return
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        self._file = None
+        idx = index_path(self.packs_dir, self._pack_id)
+        tmp = idx.with_suffix(".idx.tmp")
+        tmp.write_bytes(encode_index(self._entries))
+        os.replace(tmp, idx)
+        self._entries = {}
+        if self.on_sealed:
+            self.on_sealed(pack_path(self.packs_dir, self._pack_id), idx)
+
+    def _open(self) -> None:
+        self.packs_dir.mkdir(parents=True, exist_ok=True)
+        # random ids: two machines writing to one bucket never collide
+        self._pack_id = os.urandom(16).hex()
+        self._file = open(pack_path(self.packs_dir, self._pack_id), "wb")
+        self._file.write(MAGIC)
+
+
+def read_packed(packs_dir: Path, location: PackLocation) -> bytes:
+    with open(pack_path(packs_dir, location.pack_id), "rb") as f:
+        f.seek(location.offset)
+        data = f.read(location.length)
+    if len(data) != location.length:
+        raise CorruptPackError(f"Pack {location.pack_id} is truncated")
+    return data
@@ -1,6 +1,8 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from classes import ScanResult, ProgressEvent
-from typing import Optional, Callable
+from classes import ScanResult, ProgressEvent, FileStat
+from typing import Iterator, Optional, Callable
 from hasher import get_file_hash
 import logging
 
@@ -15,6 +17,9 @@ IGNORE_DIRS = {
 
 IGNORE_EXTENSIONS = {".tmp", ".log", ".bak", ".swp"}
 
+# How many files per worker may wait in the hashing queue
+QUEUE_DEPTH_PER_WORKER = 4
+
 logger = logging.getLogger(__name__)
 
 
@@ -22,25 +27,81 @@ def _should_skip(path: Path) -> bool:
     return path.suffix.lower() in IGNORE_EXTENSIONS
 
 
+def _is_unchanged(file_stat: FileStat, previous_entry: Optional[dict]) -> bool:
+    """True if the previous manifest entry has the same stat fingerprint and a hash."""
+    if not previous_entry or not previous_entry.get("hash"):
+        return False
+    return FileStat.from_entry(previous_entry) == file_stat
+
+
+def _iter_files(folder_path: Path) -> Iterator[Path]:
+    for root, dirs, filenames in folder_path.walk():
+        dirs[:] = [d for d in dirs if d not in IGNORE_DIRS]
+        for name in filenames:
+            path = root / name
+            if not _should_skip(path):
+                yield path
+
+
+def _hash_file(
+    path: Path, previous_entry: Optional[dict] = None, defer_hashing: bool = False
+) -> tuple[FileStat, str | None]:
+    """Stats and hashes a file, reusing the previous hash if the fingerprint matches.
+    With defer_hashing the hash of a changed file is left as None.
+    Raises OSError if the file cannot be stat'ed."""
+    file_stat = FileStat.from_stat(path.stat())
+    if _is_unchanged(file_stat, previous_entry):
+        return file_stat, previous_entry["hash"]
+    if defer_hashing:
+        return file_stat, None
+    return file_stat, get_file_hash(path)
+
+
+def _register_file(
+    path: Path,
+    file_stat: FileStat,
+    file_hash: str | None,
+    files: list,
+    file_data_map: dict,
+    progress_callback: Optional[Callable[[ProgressEvent], None]],
+    file_stats: Optional[dict] = None,
+    allow_pending: bool = False,
+) -> int:
+    if not file_hash and not allow_pending:
+        return 0
+    files.append(path)
+    file_data_map[path] = file_hash
+    if file_stats is not None:
+        file_stats[path] = file_stat
+    if progress_callback:
+        progress_callback(ProgressEvent(processed=len(files), current_file=path.name))
+    return file_stat.size
+
+
 def _process_file(
     path: Path,
     files: list,
     file_data_map: dict,
     progress_callback: Optional[Callable[[ProgressEvent], None]],
+    previous_entry: Optional[dict] = None,
+    file_stats: Optional[dict] = None,
+    defer_hashing: bool = False,
 ) -> int:
     """Hashes a single file and registers it in the result maps.
+    The hash from previous_entry is reused if the stat fingerprint still matches.
     Returns file size on success, 0 if failed."""
     try:
-        file_stat = path.stat()
-        file_hash = get_file_hash(path)
-        if file_hash:
-            files.append(path)
-            file_data_map[path] = file_hash
-            if progress_callback:
-                progress_callback(
-                    ProgressEvent(processed=len(files), current_file=path.name)
-                )
-            return file_stat.st_size
+        file_stat, file_hash = _hash_file(path, previous_entry, defer_hashing)
+        return _register_file(
+            path,
+            file_stat,
+            file_hash,
+            files,
+            file_data_map,
+            progress_callback,
+            file_stats,
+            allow_pending=defer_hashing,
+        )
     except OSError as e:
         logger.warning(f"Skip file {path}: {e}")
     return 0
@@ -49,32 +110,101 @@ def _process_file(
 def scan_files(
     folder_path: Path,
     progress_callback: Optional[Callable[[ProgressEvent], None]] = None,
+    previous_manifest: Optional[dict] = None,
+    workers: int = 1,
+    defer_hashing: bool = False,
 ) -> ScanResult:
+    """Walks folder_path and hashes every file.
+
+    If previous_manifest is given, files whose size, mtime_ns, inode and ctime_ns
+    match the entry of the previous snapshot are not read again.
+    With workers > 1 files are hashed by a thread pool (hashlib releases the GIL);
+    results are collected in walk order, so the ScanResult is the same as serial.
+    With defer_hashing changed files get hash None: create_backup hashes them
+    in the same pass that compresses and stores them, so each file is read once."""
     files = []
     total_size = 0
     file_data_map = {}
+    file_stats = {}
+    previous_files = (previous_manifest or {}).get("files") or {}
 
     if not folder_path.exists() or not folder_path.is_dir():
         logger.error(f"The directory {folder_path} is not found or not is dir.")
         raise ValueError("Invalid directory path")
 
-    for root, dirs, filenames in folder_path.walk():
-        dirs[:] = [d for d in dirs if d not in IGNORE_DIRS]
-        for name in filenames:
-            path = root / name
-            if _should_skip(path):
-                continue
-            total_size += _process_file(path, files, file_data_map, progress_callback)
+    def previous_entry(path: Path) -> Optional[dict]:
+        return previous_files.get(str(path.relative_to(folder_path)))
+
+    if workers <= 1:
+        for path in _iter_files(folder_path):
+            total_size += _process_file(
+                path,
+                files,
+                file_data_map,
+                progress_callback,
+                previous_entry=previous_entry(path),
+                file_stats=file_stats,
+                defer_hashing=defer_hashing,
+            )
+    else:
+        # Bounded queue: the walk never runs more than max_pending files ahead
+        max_pending = workers * QUEUE_DEPTH_PER_WORKER
+        pending = deque()
+
+        def collect_oldest() -> int:
+            path, future = pending.popleft()
+            try:
+                file_stat, file_hash = future.result()
+            except OSError as e:
+                logger.warning(f"Skip file {path}: {e}")
+                return 0
+            return _register_file(
+                path,
+                file_stat,
+                file_hash,
+                files,
+                file_data_map,
+                progress_callback,
+                file_stats,
+                allow_pending=defer_hashing,
+            )
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for path in _iter_files(folder_path):
+                pending.append(
+                    (
+                        path,
+                        pool.submit(
+                            _hash_file, path, previous_entry(path), defer_hashing
+                        ),
+                    )
+                )
+                if len(pending) >= max_pending:
+                    total_size += collect_oldest()
+            while pending:
+                total_size += collect_oldest()
+
+    previous_entries = {}
+    for path in files:
+        entry = previous_entry(path)
+        if _is_unchanged(file_stats[path], entry):
+            previous_entries[path] = entry
+    reused = len(previous_entries)
 
     result = ScanResult(
         files=files,
         total_files=len(files),
         total_size=total_size,
         file_hashes=file_data_map,
+        file_stats=file_stats,
+        reused_hashes=reused,
+        previous_entries=previous_entries,
+        previous_info=dict((previous_manifest or {}).get("info") or {}),
     )
 
     print()
     logger.info(
         f"Scanning files is completed, total files: {len(files)} / volume: {total_size / (1024**2):.2f} Mb"
+        f" / hashes reused: {reused}"
     )
     return result
@@ -1,9 +1,14 @@
+import hashlib
 import io
 import json
 import shutil
+import struct
 import sys
+import threading
+import time
 import unittest
 import os
+import zlib
 from pathlib import Path
 from unittest.mock import MagicMock, patch
 from pydantic import ValidationError
@@ -15,12 +20,30 @@ os.environ.setdefault("ALLOWED_SOURCE_PATH", "/data")
 
 sys.path.append(str(Path(__file__).parent.parent))
 
-from classes import ProgressEvent
-from utils import show_progress
+from classes import ProgressEvent, SnapshotSummary
+from utils import (
+    show_progress,
+    resolve_workers,
+    resolve_flag,
+    resolve_codec,
+    resolve_part_size,
+    MAX_WORKERS,
+    MAX_PART_SIZE_MB,
+    MIN_PART_SIZE_MB,
+)
 from hasher import get_file_hash
 from scanner import scan_files, _should_skip, _process_file
 from manager import BackupManager
-from crypter import FileCrypter
+from compressibility import CompressibilityDetector
+import chunker
+import compressors
+import fileclone
+import frames
+import manifests
+import packs
+from catalog import CATALOG_FILE, SnapshotCatalog
+from object_index import ObjectIndex
+from crypter import FileCrypter, KeyCache, UnlockSession
 from api import BackupRequest
 
 
@@ -133,6 +156,133 @@ class TestScanner(unittest.TestCase):
         result = scan_files(self.base, progress_callback=callback)
         self.assertGreater(result.total_files, 0)
 
+    def _previous_manifest(self, scan_res):
+        files = {}
+        for path, f_hash in scan_res.file_hashes.items():
+            entry = {"hash": f_hash}
+            entry.update(scan_res.file_stats[path].to_entry())
+            files[str(path.relative_to(self.base))] = entry
+        return {"info": {}, "files": files}
+
+    def test_scan_reuses_hash_for_unchanged_file(self):
+        """Stat fingerprint matches previous manifest — file is not read again."""
+        first = scan_files(self.base)
+        previous = self._previous_manifest(first)
+        with patch("scanner.get_file_hash") as mock_hash:
+            second = scan_files(self.base, previous_manifest=previous)
+        mock_hash.assert_not_called()
+        self.assertEqual(second.reused_hashes, 1)
+        self.assertEqual(second.file_hashes, first.file_hashes)
+
+    def test_scan_rehashes_changed_file(self):
+        """A changed mtime invalidates the fingerprint — file is hashed again."""
+        first = scan_files(self.base)
+        previous = self._previous_manifest(first)
+        note = self.base / "note.txt"
+        note.write_bytes(b"changed")
+        os.utime(note, ns=(0, 1_000_000_000))
+        second = scan_files(self.base, previous_manifest=previous)
+        self.assertEqual(second.reused_hashes, 0)
+        self.assertEqual(second.file_hashes[note], get_file_hash(note))
+
+    def test_scan_old_manifest_without_stats(self):
+        """Entries without stat fields (old manifests) are never reused."""
+        first = scan_files(self.base)
+        previous = {
+            "files": {
+                str(p.relative_to(self.base)): {"hash": "0" * 64}
+                for p in first.files
+            }
+        }
+        second = scan_files(self.base, previous_manifest=previous)
+        self.assertEqual(second.reused_hashes, 0)
+        self.assertEqual(second.file_hashes, first.file_hashes)
+
+    def test_parallel_scan_matches_serial(self):
+        """Thread pool scan returns the same ScanResult as the serial walk."""
+        for i in range(40):
+            sub = self.base / f"dir{i % 3}"
+            sub.mkdir(exist_ok=True)
+            (sub / f"f{i}.txt").write_bytes(os.urandom(100 + i))
+        serial = scan_files(self.base)
+        callback = MagicMock()
+        parallel = scan_files(self.base, progress_callback=callback, workers=4)
+        self.assertEqual(parallel.files, serial.files)
+        self.assertEqual(parallel.file_hashes, serial.file_hashes)
+        self.assertEqual(parallel.file_stats, serial.file_stats)
+        self.assertEqual(parallel.total_size, serial.total_size)
+        self.assertEqual(callback.call_count, serial.total_files)
+        processed = [c.args[0].processed for c in callback.call_args_list]
+        self.assertEqual(processed, list(range(1, serial.total_files + 1)))
+
+    def test_parallel_scan_skips_unreadable_file(self):
+        """OSError raised in a worker is logged and the file is skipped."""
+        real_stat = Path.stat
+
+        def broken_stat(path, *a, **kw):
+            if path.name == "note.txt":
+                raise OSError("gone")
+            return real_stat(path, *a, **kw)
+
+        (self.base / "other.txt").write_bytes(b"other")
+        with patch.object(Path, "stat", broken_stat):
+            result = scan_files(self.base, workers=2)
+        self.assertEqual([p.name for p in result.files], ["other.txt"])
+
+
+class TestResolveWorkers(unittest.TestCase):
+    def test_explicit_value_wins(self):
+        with patch.dict(os.environ, {"SB_TEST_WORKERS": "8"}):
+            self.assertEqual(resolve_workers(3, "SB_TEST_WORKERS"), 3)
+
+    def test_env_fallback(self):
+        with patch.dict(os.environ, {"SB_TEST_WORKERS": "8"}):
+            self.assertEqual(resolve_workers(None, "SB_TEST_WORKERS"), 8)
+
+    def test_invalid_env_uses_default(self):
+        with patch.dict(os.environ, {"SB_TEST_WORKERS": "many"}):
+            self.assertEqual(resolve_workers(None, "SB_TEST_WORKERS", default=2), 2)
+
+    def test_clamped(self):
+        self.assertEqual(resolve_workers(0, "SB_TEST_WORKERS"), 1)
+        self.assertEqual(resolve_workers(10_000, "SB_TEST_WORKERS"), MAX_WORKERS)
+
+
+class TestResolvePartSize(unittest.TestCase):
+    def test_env_fallback(self):
+        with patch.dict(os.environ, {"SB_TEST_PART": "64"}):
+            self.assertEqual(resolve_part_size(None, "SB_TEST_PART"), 64)
+
+    def test_clamped_to_s3_limits(self):
+        self.assertEqual(resolve_part_size(1, "SB_TEST_PART"), MIN_PART_SIZE_MB)
+        self.assertEqual(resolve_part_size(10**6, "SB_TEST_PART"), MAX_PART_SIZE_MB)
+
+
+class TestResolveFlag(unittest.TestCase):
+    def test_explicit_value_wins(self):
+        with patch.dict(os.environ, {"SB_TEST_FLAG": "1"}):
+            self.assertFalse(resolve_flag(False, "SB_TEST_FLAG"))
+
+    def test_env_fallback(self):
+        with patch.dict(os.environ, {"SB_TEST_FLAG": "yes"}):
+            self.assertTrue(resolve_flag(None, "SB_TEST_FLAG"))
+        with patch.dict(os.environ, {"SB_TEST_FLAG": "0"}):
+            self.assertFalse(resolve_flag(None, "SB_TEST_FLAG", default=True))
+
+
+class TestResolveCodec(unittest.TestCase):
+    def test_explicit_value_wins(self):
+        with patch.dict(os.environ, {"SB_TEST_CODEC": "none"}):
+            self.assertEqual(resolve_codec("ZLIB:9", "SB_TEST_CODEC"), "zlib:9")
+
+    def test_invalid_env_uses_default(self):
+        with patch.dict(os.environ, {"SB_TEST_CODEC": "brotli"}):
+            self.assertEqual(resolve_codec(None, "SB_TEST_CODEC"), "zlib")
+
+    def test_invalid_explicit_value_raises(self):
+        with self.assertRaises(ValueError):
+            resolve_codec("zlib:99", "SB_TEST_CODEC")
+
 
 # ---------------------------------------------------------------------------
 # manager.py — missing lines
@@ -184,8 +334,7 @@ class TestBackupManagerEdgeCases(unittest.TestCase):
             scan_res, self.source, "Proj", password="pass", forced_salt=salt
         )
         versions = manager._find_target_versions("Proj")
-        with open(versions[0] / "manifest.json") as f:
-            m = json.load(f)
+        m = manifests.open_manifest(versions[0])
         self.assertEqual(m["info"]["salt"], salt)
 
     def test_restore_with_fetch_proxy(self):
@@ -208,15 +357,48 @@ class TestBackupManagerEdgeCases(unittest.TestCase):
         ver = versions[0]
 
         obj_dir = self.storage / "objects"
-        for obj in obj_dir.rglob("*"):
+        for obj in obj_dir.glob("*/*"):
             if obj.is_file():
                 obj.write_bytes(b"corrupted")
                 break
 
         with patch("builtins.print") as mock_print:
-            manager.restore_version("Proj", ver.name, self.restore)
+            results = manager.restore_version("Proj", ver.name, self.restore)
         printed = " ".join(str(c) for c in mock_print.call_args_list)
         self.assertIn("ALARM", printed)
+        self.assertIn(False, results.values())  # damaged file reported as failed
+
+    def test_verify_only_writes_nothing(self):
+        manager = self._backup(compress=True)
+        ver = manager._find_target_versions("Proj")[0]
+        for workers in (1, 4):
+            with self.subTest(workers=workers):
+                results = manager.restore_version(
+                    "Proj", ver.name, None, verify_only=True, workers=workers
+                )
+                self.assertTrue(results)
+                self.assertTrue(all(results.values()))
+        self.assertEqual(list(self.restore.iterdir()), [])
+
+    def test_verify_only_flags_damaged_object(self):
+        manager = self._backup(compress=False)
+        ver = manager._find_target_versions("Proj")[0]
+        manifest = manager.load_latest_manifest("Proj")
+        rel, entry = next(iter(manifest["files"].items()))
+        obj = self.storage / "objects" / entry["object"][:2] / entry["object"]
+        obj.write_bytes(b"bit rot")
+        with patch("builtins.print"):
+            results = manager.restore_version("Proj", ver.name, None, verify_only=True)
+        self.assertFalse(results[rel])
+        self.assertEqual(sum(results.values()), len(results) - 1)
+
+    def test_verify_only_needs_decoded_mode(self):
+        manager = self._backup(compress=False)
+        ver = manager._find_target_versions("Proj")[0]
+        with self.assertRaises(ValueError):
+            manager.restore_version(
+                "Proj", ver.name, None, decrypt_data=False, verify_only=True
+            )
 
     def test_restore_exception_appended_to_error_list(self):
         """Exception during restore appended to error_list — lines 245-246."""
@@ -309,21 +491,154 @@ class TestBackupManagerEdgeCases(unittest.TestCase):
             manager.verify_password("Proj", ver.name, "secret", fetch_proxy=fetch_proxy)
         )
 
+    def _drop_key_check(self, ver):
+        """Turns the manifest into one written before key checks existed."""
+        manifest = load_as_v1(ver)
+        del manifest["info"]["key_check"]
+        save_as_v1(ver, manifest)
+
     def test_verify_password_object_not_found(self):
         """Object file missing → returns False — lines 366, 369-372."""
         manager = self._backup(compress=False, password="secret")
         versions = manager._find_target_versions("Proj")
         ver = versions[0]
+        self._drop_key_check(ver)
         shutil.rmtree(self.storage / "objects")
         result = manager.verify_password("Proj", ver.name, "secret")
         self.assertFalse(result)
 
+    def test_verify_password_uses_key_check_only(self):
+        """With a key check in the manifest no object is read."""
+        manager = self._backup(password="secret")
+        ver = manager._find_target_versions("Proj")[0]
+        self.assertEqual(len(manager.load_latest_manifest("Proj")["info"]["key_check"]), 64)
+        shutil.rmtree(self.storage / "objects")
+        fetch_proxy = MagicMock()
+        self.assertTrue(manager.verify_password("Proj", ver.name, "secret", fetch_proxy))
+        self.assertFalse(manager.verify_password("Proj", ver.name, "wrong", fetch_proxy))
+        fetch_proxy.assert_not_called()
+
+    def test_verify_password_old_manifest_reads_smallest_object(self):
+        (self.source / "big.bin").write_bytes(os.urandom(300_000))
+        manager = self._backup(password="secret")
+        ver = manager._find_target_versions("Proj")[0]
+        self._drop_key_check(ver)
+        fetched = []
+
+        def fetch_proxy(rel_path, byte_range=None):
+            fetched.append(rel_path)
+            return (self.storage / rel_path).read_bytes()
+
+        self.assertTrue(manager.verify_password("Proj", ver.name, "secret", fetch_proxy))
+        self.assertFalse(manager.verify_password("Proj", ver.name, "wrong", fetch_proxy))
+        small = manager.load_latest_manifest("Proj")["files"]["file.txt"]["object"]
+        self.assertEqual({p.name for p in fetched}, {small})
+
+    def test_verify_password_sizes_from_remote(self):
+        """Entries without a size: the remote storage tells the object sizes."""
+        (self.source / "big.bin").write_bytes(os.urandom(300_000))
+        (self.source / "a.bin").write_bytes(os.urandom(200_000))  # listed first
+        manager = self._backup(password="secret")
+        ver = manager._find_target_versions("Proj")[0]
+        manifest = load_as_v1(ver)
+        del manifest["info"]["key_check"]
+        for info in manifest["files"].values():
+            del info["size"]
+        save_as_v1(ver, manifest)
+        remote = MagicMock()
+        remote.object_size.side_effect = lambda rel: (self.storage / rel).stat().st_size
+        fetched = []
+
+        def fetch_proxy(rel_path, byte_range=None):
+            fetched.append(rel_path.name)
+            return (self.storage / rel_path).read_bytes()
+
+        cloud_manager = BackupManager(self.storage, remote=remote)
+        self.assertTrue(
+            cloud_manager.verify_password("Proj", ver.name, "secret", fetch_proxy)
+        )
+        self.assertEqual(remote.object_size.call_count, 3)
+        self.assertEqual(fetched, [manifest["files"]["file.txt"]["object"]])
+
     def test_remove_padding_short_data(self):
         """_remove_padding with data shorter than 4 bytes."""
         manager = BackupManager(self.storage)
         result = manager._remove_padding(b"\x00\x00")
         self.assertEqual(result, b"\x00\x00")
 
+    def test_manifest_records_stat_fingerprint(self):
+        """create_backup stores size/mtime_ns/inode/ctime_ns for each file."""
+        manager = self._backup(compress=False)
+        manifest = manager.load_latest_manifest("Proj")
+        entry = manifest["files"]["file.txt"]
+        st = (self.source / "file.txt").stat()
+        self.assertEqual(entry["size"], len(self.content))
+        self.assertEqual(entry["mtime_ns"], st.st_mtime_ns)
+        self.assertEqual(entry["inode"], st.st_ino)
+        self.assertEqual(entry["ctime_ns"], st.st_ctime_ns)
+
+    def test_load_latest_manifest_missing_project(self):
+        manager = BackupManager(self.storage)
+        self.assertIsNone(manager.load_latest_manifest("NoSuchProject"))
+
+    def _count_source_opens(self, fn):
+        """Runs fn and counts how many times files under source are opened."""
+        original_open = open
+        opened = []
+
+        def counting_open(path, *a, **kw):
+            if Path(path).parent == self.source:
+                opened.append(Path(path).name)
+            return original_open(path, *a, **kw)
+
+        with patch("builtins.open", side_effect=counting_open):
+            fn()
+        return opened
+
+    def test_deferred_hash_single_read(self):
+        """Scan without hashing + create_backup reads each file exactly once."""
+        manager = BackupManager(self.storage)
+        scan_res = scan_files(self.source, defer_hashing=True)
+        self.assertIsNone(scan_res.file_hashes[self.source / "file.txt"])
+        opened = self._count_source_opens(
+            lambda: manager.create_backup(scan_res, self.source, "Proj")
+        )
+        self.assertEqual(opened, ["file.txt"])
+        manifest = manager.load_latest_manifest("Proj")
+        self.assertEqual(
+            manifest["files"]["file.txt"]["hash"],
+            get_file_hash(self.source / "file.txt"),
+        )
+
+    def test_deferred_hash_duplicate_dropped(self):
+        """Identical files hashed during backup are stored once."""
+        (self.source / "copy.txt").write_bytes(self.content)
+        manager = BackupManager(self.storage)
+        scan_res = scan_files(self.source, defer_hashing=True)
+        result = manager.create_backup(scan_res, self.source, "Proj", compress=False)
+        self.assertEqual((result.copied, result.skipped), (1, 1))
+        self.assertEqual(len(list(self.storage.glob("objects/*/*"))), 1)
+
+    def test_known_hash_existing_object_not_read(self):
+        """Second backup with scan hashes does not open unchanged files."""
+        manager = self._backup()
+        scan_res = scan_files(self.source)
+        opened = self._count_source_opens(
+            lambda: manager.create_backup(scan_res, self.source, "Proj")
+        )
+        self.assertEqual(opened, [])
+
+    def test_file_changed_after_scan_stores_current_hash(self):
+        manager = BackupManager(self.storage)
+        scan_res = scan_files(self.source)
+        (self.source / "file.txt").write_bytes(b"new content")
+        manager.create_backup(scan_res, self.source, "Proj", compress=False)
+        manifest = manager.load_latest_manifest("Proj")
+        self.assertEqual(
+            manifest["files"]["file.txt"]["hash"],
+            get_file_hash(self.source / "file.txt"),
+        )
+
     def test_create_backup_file_read_error(self):
         """Exception during file read increments errors counter."""
         manager = BackupManager(self.storage)
@@ -340,6 +655,1394 @@ class TestBackupManagerEdgeCases(unittest.TestCase):
         self.assertGreater(result.errors, 0)
 
 
+# ---------------------------------------------------------------------------
+# frames.py — streaming object format
+# ---------------------------------------------------------------------------
+
+
+class TestFrames(unittest.TestCase):
+    def setUp(self):
+        self.crypter = FileCrypter("pass", time_cost=1, memory_cost=64, parallelism=1)
+        self.data = os.urandom(3000) + b"abc" * 5000
+
+    def _encode(self, compress, crypter, frame_size=1024):
+        out = io.BytesIO()
+        writer = frames.FrameWriter(out, compress, crypter, frame_size=frame_size)
+        for i in range(0, len(self.data), 700):
+            writer.write(self.data[i : i + 700])
+        writer.close()
+        return out.getvalue()
+
+    def _decode(self, blob, compress, crypter):
+        return b"".join(frames.iter_decoded(io.BytesIO(blob), compress, crypter))
+
+    def test_roundtrip_all_modes(self):
+        for compress in (False, True):
+            for crypter in (None, self.crypter):
+                blob = self._encode(compress, crypter)
+                self.assertEqual(self._decode(blob, compress, crypter), self.data)
+
+    def test_multiple_frames_written(self):
+        blob = self._encode(False, None, frame_size=1024)
+        payloads = list(frames.iter_frames(io.BytesIO(blob)))
+        self.assertGreater(len(payloads), 5)
+        self.assertEqual(b"".join(payloads), self.data)
+
+    def test_wrong_key_fails(self):
+        from cryptography.exceptions import InvalidTag
+
+        blob = self._encode(True, self.crypter)
+        other = FileCrypter("other", salt=self.crypter.salt, time_cost=1, memory_cost=64, parallelism=1)
+        with self.assertRaises(InvalidTag):
+            self._decode(blob, True, other)
+
+    def test_truncated_object_detected(self):
+        blob = self._encode(False, None)
+        with self.assertRaises(frames.CorruptObjectError):
+            self._decode(blob[: len(blob) // 2], False, None)
+
+    def test_dropped_frame_detected(self):
+        """Frame index is authenticated — removing a frame breaks decryption."""
+        from cryptography.exceptions import InvalidTag
+
+        blob = io.BytesIO(self._encode(False, self.crypter))
+        blob.read(len(frames.MAGIC) + frames.OBJECT_NONCE_LEN)
+        object_header_end = blob.tell()
+        header = frames._HEADER.unpack(blob.read(frames._HEADER.size))
+        first_frame_end = blob.tell() + header[0]
+        raw = blob.getvalue()
+        tampered = raw[:object_header_end] + raw[first_frame_end:]
+        with self.assertRaises(InvalidTag):
+            self._decode(tampered, False, self.crypter)
+
+    def test_frame_from_other_object_detected(self):
+        """Same key, same frame index: the object nonce still tells them apart."""
+        from cryptography.exceptions import InvalidTag
+
+        blob, other = self._encode(False, self.crypter), self._encode(False, self.crypter)
+        start = len(frames.MAGIC) + frames.OBJECT_NONCE_LEN
+        first_frame_end = start + frames._HEADER.size
+        first_frame_end += frames._HEADER.unpack_from(blob, start)[0]
+        tampered = blob[:start] + other[start:first_frame_end] + blob[first_frame_end:]
+        with self.assertRaises(InvalidTag):
+            self._decode(tampered, False, self.crypter)
+
+    def test_objects_without_nonce_still_decode(self):
+        record = self.crypter.encrypt(
+            frames.add_padding(b"old object"),
+            frames.MAGIC_V1 + struct.pack(">QB", 0, frames.FLAG_FINAL),
+        )
+        blob = (
+            frames.MAGIC_V1
+            + frames._HEADER.pack(len(record), frames.FLAG_FINAL)
+            + record
+        )
+        self.assertEqual(self._decode(blob, False, self.crypter), b"old object")
+
+    def test_not_framed(self):
+        with self.assertRaises(frames.CorruptObjectError):
+            self._decode(b"garbage", False, None)
+
+
+class TestStreamingObjects(unittest.TestCase):
+    def setUp(self):
+        self.base = Path(__file__).parent.parent / "test_sandbox_stream"
+        self.source = self.base / "source"
+        self.storage = self.base / "storage"
+        self.restore = self.base / "restore"
+        for p in [self.source, self.storage, self.restore]:
+            shutil.rmtree(p, ignore_errors=True)
+            p.mkdir(parents=True)
+        self.content = os.urandom(200_000) + b"x" * 300_000
+        (self.source / "big.bin").write_bytes(self.content)
+
+    def tearDown(self):
+        shutil.rmtree(self.base, ignore_errors=True)
+
+    def _restore(self, manager, password=None):
+        ver = manager._find_target_versions("Big")[0]
+        manager.restore_version("Big", ver.name, self.restore, password=password)
+        return (self.restore / f"Big_{ver.name}" / "big.bin").read_bytes()
+
+    def test_spilled_object_roundtrip(self):
+        """Objects above the in-memory limit are staged on disk and streamed."""
+        manager = BackupManager(self.storage)
+        calls = []
+        with patch("manager.STAGE_IN_MEMORY_LIMIT", 1024):
+            scan_res = scan_files(self.source, defer_hashing=True)
+            manager.create_backup(
+                scan_res,
+                self.source,
+                "Big",
+                password="pw",
+                after_obj_created=lambda p, d: calls.append(d),
+            )
+        self.assertIsInstance(calls[0], Path)  # spilled object passed by path
+        self.assertEqual(list(self.storage.glob("objects/.stage-*")), [])
+        self.assertEqual(self._restore(manager, password="pw"), self.content)
+
+    def test_framed_manifest_entry(self):
+        manager = BackupManager(self.storage)
+        manager.create_backup(scan_files(self.source), self.source, "Big")
+        entry = manager.load_latest_manifest("Big")["files"]["big.bin"]
+        self.assertEqual(entry["format"], "framed")
+        obj = self.storage / "objects" / entry["object"][:2] / entry["object"]
+        self.assertEqual(obj.read_bytes()[:4], frames.MAGIC)
+        self.assertEqual(self._restore(manager), self.content)
+
+    def test_legacy_object_still_restores(self):
+        """Manifests without object ids use the old path and whole-object decode."""
+        manager = BackupManager(self.storage)
+        crypter = FileCrypter("pw", time_cost=1, memory_cost=64, parallelism=1)
+        file_hash = get_file_hash(self.source / "big.bin")
+        obj_path = manager._get_object_path(
+            file_hash, encrypted=True, compressed=True, salt=crypter.salt.hex()
+        )
+        obj_path.parent.mkdir(parents=True)
+        legacy = crypter.encrypt(manager._add_padding(zlib.compress(self.content)))
+        obj_path.write_bytes(legacy)
+        ver_dir = self.storage / "Big" / "2024-01-01_00-00-00"
+        ver_dir.mkdir(parents=True)
+        manifest = {
+            "info": {
+                "salt": crypter.salt.hex(),
+                "kdf_params": {"time_cost": 1, "memory_cost": 64, "parallelism": 1},
+                "total_files": 1,
+                "compression_enabled": True,
+            },
+            "files": {"big.bin": {"hash": file_hash, "compressed": True}},
+        }
+        (ver_dir / "manifest.json").write_text(json.dumps(manifest))
+        self.assertTrue(manager.verify_password("Big", ver_dir.name, "pw"))
+        self.assertEqual(self._restore(manager, password="pw"), self.content)
+
+
+SMALL_CHUNKS = {"MIN_SIZE": 1024, "AVG_SIZE": 4096, "MAX_SIZE": 16384}
+
+
+class TestPacks(unittest.TestCase):
+    def setUp(self):
+        self.base = Path(__file__).parent.parent / "test_sandbox_packs"
+        self.source = self.base / "source"
+        self.storage = self.base / "storage"
+        self.restore = self.base / "restore"
+        for p in [self.source, self.storage, self.restore]:
+            shutil.rmtree(p, ignore_errors=True)
+            p.mkdir(parents=True)
+        for i in range(20):
+            (self.source / f"f{i}.txt").write_bytes(f"small file {i}".encode() * 10)
+
+    def tearDown(self):
+        shutil.rmtree(self.base, ignore_errors=True)
+
+    def _backup(self, manager, **kwargs):
+        return manager.create_backup(
+            scan_files(self.source), self.source, "Packed", pack_objects=True, **kwargs
+        )
+
+    def _restore(self, manager, **kwargs):
+        ver = manager._find_target_versions("Packed")[-1]
+        manager.restore_version("Packed", ver.name, self.restore, **kwargs)
+        return self.restore / f"Packed_{ver.name}"
+
+    def test_index_roundtrip(self):
+        entries = {"ab" * 32: packs.PackLocation("p1", 4, 10)}
+        self.assertEqual(packs.decode_index("p1", packs.encode_index(entries)), entries)
+        with self.assertRaises(packs.CorruptPackError):
+            packs.decode_index("p1", packs.encode_index(entries)[:-1])
+
+    def test_writer_seals_at_target_size(self):
+        index = packs.PackIndex(self.storage / "packs")
+        sealed = []
+        writer = packs.PackWriter(
+            self.storage / "packs", index, target_size=100,
+            on_sealed=lambda p, i: sealed.append(p),
+        )
+        for n in range(5):
+            writer.add(f"{n:064x}", b"x" * 60)
+        writer.close()
+        self.assertEqual(len(sealed), 3)
+        reloaded = packs.PackIndex(self.storage / "packs")
+        self.assertEqual(len(reloaded), 5)
+        loc = reloaded.get(f"{4:064x}")
+        self.assertEqual(packs.read_packed(self.storage / "packs", loc), b"x" * 60)
+
+    def test_small_objects_are_packed(self):
+        manager = BackupManager(self.storage)
+        res = self._backup(manager, password="pw")
+        self.assertEqual(res.copied, 20)
+        self.assertEqual(list(self.storage.glob("objects/*/*")), [])
+        self.assertEqual(len(list(self.storage.glob("packs/*.pack"))), 1)
+        # a second snapshot finds every object in the pack index
+        salt = manager.load_latest_manifest("Packed")["info"]["salt"]
+        second = self._backup(BackupManager(self.storage), password="pw", forced_salt=salt)
+        self.assertEqual(second.skipped, 20)
+        restored = self._restore(BackupManager(self.storage), password="pw")
+        for i in range(20):
+            self.assertEqual(
+                (restored / f"f{i}.txt").read_bytes(), f"small file {i}".encode() * 10
+            )
+
+    def test_large_objects_stay_standalone(self):
+        (self.source / "big.bin").write_bytes(os.urandom(5000))
+        manager = BackupManager(self.storage)
+        with patch("packs.PACK_THRESHOLD", 1000):
+            self._backup(manager)
+        self.assertEqual(len(list(self.storage.glob("objects/*/*"))), 1)
+        restored = self._restore(BackupManager(self.storage))
+        self.assertEqual(
+            (restored / "big.bin").read_bytes(), (self.source / "big.bin").read_bytes()
+        )
+
+    def test_cloud_hook_and_ranged_restore(self):
+        uploaded = {}
+
+        def hook(rel_path, data):
+            uploaded[rel_path] = data.read_bytes() if isinstance(data, Path) else data
+
+        manager = BackupManager(self.storage)
+        self._backup(manager, after_obj_created=hook)
+        kinds = [p.suffix for p in uploaded]
+        self.assertEqual(kinds, [".pack", ".idx", ".sbm"])  # manifest goes last
+
+        ranges = []
+
+        def fetch(rel_path, byte_range=None):
+            ranges.append(byte_range)
+            offset, length = byte_range
+            return uploaded[rel_path][offset : offset + length]
+
+        shutil.rmtree(self.storage)  # cloud mode: only indexes and manifests are local
+        for rel_path, data in uploaded.items():
+            if rel_path.suffix != ".pack":
+                (self.storage / rel_path).parent.mkdir(parents=True, exist_ok=True)
+                (self.storage / rel_path).write_bytes(data)
+        restored = self._restore(BackupManager(self.storage), fetch_proxy=fetch)
+        self.assertEqual(len(ranges), 20)
+        self.assertEqual((restored / "f3.txt").read_bytes(), b"small file 3" * 10)
+
+
+class TestObjectIndex(unittest.TestCase):
+    def setUp(self):
+        self.base = Path(__file__).parent.parent / "test_sandbox_index"
+        self.source = self.base / "source"
+        self.storage = self.base / "storage"
+        for p in [self.source, self.storage]:
+            shutil.rmtree(p, ignore_errors=True)
+            p.mkdir(parents=True)
+        (self.source / "a.txt").write_bytes(b"alpha")
+        (self.source / "b.txt").write_bytes(b"beta")
+
+    def tearDown(self):
+        shutil.rmtree(self.base, ignore_errors=True)
+
+    def test_persisted_and_replaced(self):
+        index = ObjectIndex(self.base / "i.db")
+        index.add_many(["a", "b", "a"])
+        index.close()
+        index = ObjectIndex(self.base / "i.db")
+        self.assertEqual(len(index), 2)
+        self.assertIn("a", index)
+        self.assertEqual(index.replace_all(["c"]), 1)
+        self.assertNotIn("a", index)
+        index.close()
+
+    def test_known_objects_are_not_probed(self):
+        manager = BackupManager(self.storage)
+        manager.create_backup(scan_files(self.source), self.source, "Idx")
+        probed = []
+        original_exists = Path.exists
+
+        def counting_exists(path, *a, **kw):
+            if self.storage / "objects" in path.parents:
+                probed.append(path)
+            return original_exists(path, *a, **kw)
+
+        with patch.object(Path, "exists", counting_exists):
+            res = BackupManager(self.storage).create_backup(
+                scan_files(self.source), self.source, "Idx"
+            )
+        self.assertEqual(res.skipped, 2)
+        self.assertEqual(probed, [])
+
+    def test_unindexed_object_found_and_recorded(self):
+        """Objects written before the index existed are found on disk."""
+        manager = BackupManager(self.storage)
+        manager.create_backup(scan_files(self.source), self.source, "Idx")
+        manager.object_index.close()
+        (self.storage / "objects" / ".index.sqlite").unlink()
+        manager = BackupManager(self.storage)
+        res = manager.create_backup(scan_files(self.source), self.source, "Idx")
+        self.assertEqual(res.skipped, 2)
+        self.assertEqual(len(manager.object_index), 2)
+
+    def test_rebuild_drops_missing_objects(self):
+        manager = BackupManager(self.storage)
+        manager.create_backup(scan_files(self.source), self.source, "Idx")
+        victim = next(self.storage.glob("objects/*/*"))
+        victim.unlink()
+        self.assertEqual(manager.rebuild_object_index(), 1)
+        self.assertNotIn(victim.name, manager.object_index)
+
+
+class TestParallelBackup(unittest.TestCase):
+    def setUp(self):
+        self.base = Path(__file__).parent.parent / "test_sandbox_parallel"
+        self.source = self.base / "source"
+        self.restore = self.base / "restore"
+        for p in [self.source, self.restore]:
+            shutil.rmtree(p, ignore_errors=True)
+            p.mkdir(parents=True)
+        for i in range(12):
+            sub = self.source / f"d{i % 3}"
+            sub.mkdir(exist_ok=True)
+            (sub / f"f{i}.txt").write_bytes(f"content {i % 8}".encode() * 500)
+        (self.source / "photo.jpg").write_bytes(os.urandom(3000))
+
+    def tearDown(self):
+        shutil.rmtree(self.base, ignore_errors=True)
+
+    def _backup(self, name, workers, **kwargs):
+        manager = BackupManager(self.base / name)
+        res = manager.create_backup(
+            scan_files(self.source, defer_hashing=True),
+            self.source,
+            "Par",
+            workers=workers,
+            **kwargs,
+        )
+        return manager, res
+
+    def test_same_result_as_serial(self):
+        _, serial = self._backup("serial", 1)
+        manager, parallel = self._backup("parallel", 3)
+        self.assertEqual(parallel, serial)
+        self.assertEqual((parallel.copied, parallel.skipped), (9, 4))
+        files_serial = BackupManager(self.base / "serial").load_latest_manifest("Par")["files"]
+        files_parallel = manager.load_latest_manifest("Par")["files"]
+        self.assertEqual(list(files_parallel), list(files_serial))
+        self.assertEqual(files_parallel, files_serial)
+
+    def test_encrypted_key_derived_once(self):
+        import crypter
+
+        with patch("crypter.hash_secret_raw", wraps=crypter.hash_secret_raw) as kdf:
+            manager, res = self._backup("enc", 2, password="pw")
+        self.assertEqual(kdf.call_count, 1)
+        self.assertEqual(res.errors, 0)
+        ver = manager._find_target_versions("Par")[-1]
+        manager.restore_version("Par", ver.name, self.restore, password="pw")
+        restored = self.restore / f"Par_{ver.name}" / "d1" / "f4.txt"
+        self.assertEqual(restored.read_bytes(), b"content 4" * 500)
+
+    def test_errors_counted_like_serial(self):
+        scan_res = scan_files(self.source, defer_hashing=True)
+        (self.source / "d0" / "f0.txt").unlink()  # vanishes between scan and backup
+        manager = BackupManager(self.base / "err")
+        res = manager.create_backup(scan_res, self.source, "Par", workers=2)
+        self.assertEqual(res.errors, 1)
+        self.assertNotIn("d0/f0.txt", manager.load_latest_manifest("Par")["files"])
+
+    def test_spilled_objects_from_workers(self):
+        with patch("manager.STAGE_IN_MEMORY_LIMIT", 1024):
+            manager, res = self._backup("spill", 2)
+        self.assertEqual(list((self.base / "spill").glob("objects/.stage-*")), [])
+        ver = manager._find_target_versions("Par")[-1]
+        manager.restore_version("Par", ver.name, self.restore)
+        restored = self.restore / f"Par_{ver.name}" / "photo.jpg"
+        self.assertEqual(restored.read_bytes(), (self.source / "photo.jpg").read_bytes())
+
+
+class TestParallelRestore(unittest.TestCase):
+    def setUp(self):
+        self.base = Path(__file__).parent.parent / "test_sandbox_prestore"
+        self.source = self.base / "source"
+        self.storage = self.base / "storage"
+        for p in [self.source, self.storage]:
+            shutil.rmtree(p, ignore_errors=True)
+            p.mkdir(parents=True)
+        for i in range(15):
+            (self.source / f"f{i:02}.txt").write_bytes(f"file {i}".encode() * 300)
+        self.manager = BackupManager(self.storage)
+        self.manager.create_backup(scan_files(self.source), self.source, "PR")
+        self.version = self.manager._find_target_versions("PR")[-1].name
+
+    def tearDown(self):
+        shutil.rmtree(self.base, ignore_errors=True)
+
+    def _restore(self, name, **kwargs):
+        target = self.base / name
+        with patch("builtins.print"):
+            results = self.manager.restore_version("PR", self.version, target, **kwargs)
+        return results, target / f"PR_{self.version}"
+
+    def test_same_results_as_serial(self):
+        serial, _ = self._restore("serial")
+        parallel, restored = self._restore("parallel", workers=4)
+        self.assertEqual(list(parallel.items()), list(serial.items()))
+        self.assertTrue(all(parallel.values()))
+        self.assertEqual((restored / "f07.txt").read_bytes(), b"file 7" * 300)
+
+    def test_fetchers_prefetch_concurrently(self):
+        import threading
+        import time
+
+        lock = threading.Lock()
+        active, peak = [0], [0]
+
+        def slow_fetch(rel_path, byte_range=None):
+            with lock:
+                active[0] += 1
+                peak[0] = max(peak[0], active[0])
+            time.sleep(0.01)
+            with lock:
+                active[0] -= 1
+            return (self.storage / rel_path).read_bytes()
+
+        results, restored = self._restore(
+            "remote", fetch_proxy=slow_fetch, workers=2, fetch_workers=4
+        )
+        self.assertTrue(all(results.values()))
+        self.assertGreater(peak[0], 1)
+        self.assertEqual((restored / "f14.txt").read_bytes(), b"file 14" * 300)
+
+    def test_errors_keep_their_shape(self):
+        files = self.manager.load_latest_manifest("PR")["files"]
+        obj = files["f03.txt"]["object"]
+        (self.storage / "objects" / obj[:2] / obj).unlink()
+        with patch("manager.logger") as mock_logger:
+            results, restored = self._restore("broken", workers=3)
+        self.assertEqual(list(results), list(files))
+        self.assertFalse(results["f03.txt"])
+        self.assertEqual(sum(results.values()), 14)
+        self.assertFalse((restored / "f03.txt").exists())
+        mock_logger.error.assert_called_once()
+        self.assertIn("f03.txt", mock_logger.error.call_args[0][0])
+
+    def test_permission_error_stops_restore(self):
+        original = BackupManager._write_chunks
+
+        def deny(manager, chunks, final_path):
+            if final_path.name == "f05.txt":
+                raise PermissionError("read-only target")
+            return original(manager, chunks, final_path)
+
+        with patch.object(BackupManager, "_write_chunks", deny):
+            results, _ = self._restore("denied", workers=3)
+        self.assertEqual(list(results)[-1], "f05.txt")
+        self.assertFalse(results["f05.txt"])
+
+    def test_sync_fetches_only_differing_files(self):
+        for workers in (1, 3):
+            with self.subTest(workers=workers):
+                target = self.base / f"replica{workers}"
+                fetched = []
+
+                def fetch(rel_path, byte_range=None):
+                    fetched.append(rel_path)
+                    return (self.storage / rel_path).read_bytes()
+
+                def sync():
+                    fetched.clear()
+                    with patch("builtins.print"):
+                        return self.manager.restore_version(
+                            "PR",
+                            self.version,
+                            target,
+                            fetch_proxy=fetch,
+                            workers=workers,
+                            fetch_workers=workers,
+                            sync=True,
+                        )
+
+                self.assertTrue(all(sync().values()))
+                self.assertEqual(len(fetched), 15)
+                self.assertEqual((target / "f07.txt").read_bytes(), b"file 7" * 300)
+
+                (target / "f01.txt").write_bytes(b"edited")
+                (target / "f02.txt").unlink()
+                os.utime(target / "f03.txt", ns=(0, 0))  # same content, other mtime
+                results = sync()
+                self.assertTrue(all(results.values()))
+                self.assertEqual(len(fetched), 2)
+                self.assertEqual((target / "f01.txt").read_bytes(), b"file 1" * 300)
+                self.assertTrue((target / "f02.txt").exists())
+
+                sync()
+                self.assertEqual(fetched, [])  # f03.txt got its mtime back
+
+    def test_sync_replaces_file_only_when_complete(self):
+        target = self.base / "replica"
+        target.mkdir()
+        (target / "f04.txt").write_bytes(b"old")
+        files = self.manager.load_latest_manifest("PR")["files"]
+        obj = files["f04.txt"]["object"]
+        (self.storage / "objects" / obj[:2] / obj).write_bytes(b"broken")
+        with patch("builtins.print"), patch("manager.logger"):
+            results = self.manager.restore_version("PR", self.version, target, sync=True)
+        self.assertFalse(results["f04.txt"])
+        self.assertEqual((target / "f04.txt").read_bytes(), b"old")
+        self.assertEqual([p.name for p in target.glob(".*")], [])
+
+
+class TestDedupRestore(unittest.TestCase):
+    def setUp(self):
+        self.base = Path(__file__).parent.parent / "test_sandbox_dedup"
+        self.source = self.base / "source"
+        self.storage = self.base / "storage"
+        for p in [self.source, self.storage]:
+            shutil.rmtree(p, ignore_errors=True)
+            p.mkdir(parents=True)
+        self.shared = b"vendored library " * 500
+        for i in range(4):
+            (self.source / f"copy{i}").mkdir()
+            (self.source / f"copy{i}" / "lib.js").write_bytes(self.shared)
+        (self.source / "own.txt").write_bytes(b"unique")
+        self.manager = BackupManager(self.storage)
+        self.manager.create_backup(scan_files(self.source), self.source, "DD")
+        self.version = self.manager._find_target_versions("DD")[-1].name
+        self.fetched = []
+
+    def tearDown(self):
+        shutil.rmtree(self.base, ignore_errors=True)
+
+    def _fetch(self, rel_path, byte_range=None):
+        self.fetched.append(rel_path)
+        return (self.storage / rel_path).read_bytes()
+
+    def _restore(self, **kwargs):
+        with patch("builtins.print"):
+            return self.manager.restore_version(
+                "DD", self.version, self.base / "out", fetch_proxy=self._fetch, **kwargs
+            )
+
+    def test_each_object_fetched_once(self):
+        for workers in (1, 3):
+            with self.subTest(workers=workers):
+                self.fetched.clear()
+                shutil.rmtree(self.base / "out", ignore_errors=True)
+                results = self._restore(workers=workers, fetch_workers=workers)
+                self.assertEqual(len(results), 5)
+                self.assertTrue(all(results.values()))
+                self.assertEqual(len(self.fetched), 2)
+                restored = self.base / "out" / f"DD_{self.version}"
+                for i in range(4):
+                    path = restored / f"copy{i}" / "lib.js"
+                    self.assertEqual(path.read_bytes(), self.shared)
+
+    def test_hardlinked_duplicates(self):
+        self._restore(hardlink_duplicates=True)
+        restored = self.base / "out" / f"DD_{self.version}"
+        inodes = {(restored / f"copy{i}" / "lib.js").stat().st_ino for i in range(4)}
+        self.assertEqual(len(inodes), 1)
+
+    def test_damaged_object_fails_every_duplicate(self):
+        files = self.manager.load_latest_manifest("DD")["files"]
+        obj = files[str(Path("copy0") / "lib.js")]["object"]
+        (self.storage / "objects" / obj[:2] / obj).write_bytes(b"broken")
+        with patch("manager.logger"):
+            results = self._restore()
+        self.assertEqual(sum(results.values()), 1)  # only own.txt
+        self.assertEqual(len(results), 5)
+
+
+class TestFileClone(unittest.TestCase):
+    def setUp(self):
+        self.base = Path(__file__).parent.parent / "test_sandbox_clone"
+        shutil.rmtree(self.base, ignore_errors=True)
+        self.base.mkdir(parents=True)
+        self.src = self.base / "src.bin"
+        self.data = os.urandom(300_000)
+        self.src.write_bytes(self.data)
+
+    def tearDown(self):
+        shutil.rmtree(self.base, ignore_errors=True)
+
+    def test_clone_uses_available_method(self):
+        dst = self.base / "dst.bin"
+        dst.write_bytes(b"old")
+        method = fileclone.clone_file(self.src, dst)
+        self.assertIn(method, ("reflink", "copy_file_range", "copy"))
+        self.assertEqual(dst.read_bytes(), self.data)
+        self.assertEqual(list(self.base.glob(".*")), [])
+
+    def test_fallback_when_kernel_copy_refused(self):
+        import errno
+
+        def refuse(*args):
+            raise OSError(errno.EXDEV, "cross-device")
+
+        with patch.object(fileclone, "_refused", set()):
+            with patch("fileclone._reflink", refuse), patch("fileclone._copy_file_range", refuse):
+                method = fileclone.clone_file(self.src, self.base / "a")
+            self.assertEqual(method, "copy")
+            self.assertEqual(len(fileclone._refused), 2)  # not tried again for these devices
+        self.assertEqual((self.base / "a").read_bytes(), self.data)
+
+    def test_hardlink_replaces_existing_link(self):
+        dst = self.base / "link"
+        for _ in range(2):
+            self.assertEqual(fileclone.clone_file(self.src, dst, hardlink=True), "hardlink")
+        self.assertEqual(dst.stat().st_ino, self.src.stat().st_ino)
+        self.assertEqual(sorted(p.name for p in self.base.iterdir()), ["link", "src.bin"])
+
+
+class TestZeroCopyRestore(unittest.TestCase):
+    def setUp(self):
+        self.base = Path(__file__).parent.parent / "test_sandbox_zerocopy"
+        self.source = self.base / "source"
+        self.storage = self.base / "storage"
+        for p in [self.source, self.storage]:
+            shutil.rmtree(p, ignore_errors=True)
+            p.mkdir(parents=True)
+        self.content = os.urandom(100_000)
+        (self.source / "a.bin").write_bytes(self.content)
+        (self.source / "b.txt").write_bytes(b"text " * 1000)
+
+    def tearDown(self):
+        shutil.rmtree(self.base, ignore_errors=True)
+
+    def _restore(self, manager, **kwargs):
+        ver = manager._find_target_versions("ZC")[-1].name
+        with patch.object(BackupManager, "_iter_entry", side_effect=AssertionError("decoded")):
+            with patch("builtins.print"):
+                results = manager.restore_version("ZC", ver, self.base / "out", **kwargs)
+        return results, self.base / "out" / f"ZC_{ver}"
+
+    def test_raw_objects_copied_without_decoding(self):
+        for pack_objects in (False, True):
+            with self.subTest(pack_objects=pack_objects):
+                shutil.rmtree(self.storage, ignore_errors=True)
+                shutil.rmtree(self.base / "out", ignore_errors=True)
+                manager = BackupManager(self.storage)
+                manager.create_backup(
+                    scan_files(self.source),
+                    self.source,
+                    "ZC",
+                    compress=False,
+                    pack_objects=pack_objects,
+                )
+                results, restored = self._restore(manager)
+                self.assertTrue(all(results.values()))
+                self.assertEqual((restored / "a.bin").read_bytes(), self.content)
+                self.assertEqual((restored / "b.txt").read_bytes(), b"text " * 1000)
+
+    def test_technical_mode_copies_framed_objects(self):
+        manager = BackupManager(self.storage)
+        manager.create_backup(scan_files(self.source), self.source, "ZC", password="pw")
+        results, restored = self._restore(manager, decrypt_data=False, decompress_data=False)
+        self.assertTrue(all(results.values()))
+        entry = manager.load_latest_manifest("ZC")["files"]["a.bin"]
+        obj = self.storage / "objects" / entry["object"][:2] / entry["object"]
+        self.assertEqual((restored / "a.bin.raw").read_bytes(), obj.read_bytes())
+
+    def test_copies_read_back_only_to_verify(self):
+        manager = BackupManager(self.storage)
+        manager.create_backup(scan_files(self.source), self.source, "ZC", compress=False)
+        for clean, reads in ((True, 2), (False, 0)):
+            with self.subTest(clean=clean):
+                shutil.rmtree(self.base / "out", ignore_errors=True)
+                with patch("hashlib.file_digest", wraps=hashlib.file_digest) as digest:
+                    results, _ = self._restore(
+                        manager, decrypt_data=clean, decompress_data=clean
+                    )
+                self.assertTrue(all(results.values()))
+                self.assertEqual(digest.call_count, reads)
+
+    def test_damaged_raw_object_detected(self):
+        manager = BackupManager(self.storage)
+        manager.create_backup(scan_files(self.source), self.source, "ZC", compress=False)
+        entry = manager.load_latest_manifest("ZC")["files"]["a.bin"]
+        (self.storage / "objects" / entry["object"][:2] / entry["object"]).write_bytes(b"rot")
+        results, _ = self._restore(manager)
+        self.assertFalse(results["a.bin"])
+        self.assertTrue(results["b.txt"])
+
+    def test_copy_range(self):
+        src = self.source / "a.bin"
+        method = fileclone.copy_range(src, 1000, 5000, self.base / "part.bin")
+        self.assertIn(method, ("copy_file_range", "copy"))
+        self.assertEqual((self.base / "part.bin").read_bytes(), self.content[1000:6000])
+        with self.assertRaises(OSError):
+            fileclone.copy_range(src, 99_000, 5000, self.base / "short.bin")
+        self.assertFalse((self.base / "short.bin").exists())
+
+
+class TestChunking(unittest.TestCase):
+    def setUp(self):
+        self.base = Path(__file__).parent.parent / "test_sandbox_chunks"
+        self.source = self.base / "source"
+        self.storage = self.base / "storage"
+        self.restore = self.base / "restore"
+        for p in [self.source, self.storage, self.restore]:
+            shutil.rmtree(p, ignore_errors=True)
+            p.mkdir(parents=True)
+        self.content = os.urandom(200_000)
+        (self.source / "big.bin").write_bytes(self.content)
+        (self.source / "small.txt").write_bytes(b"small")
+        patcher = patch.multiple("chunker", **SMALL_CHUNKS)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.base, ignore_errors=True)
+
+    def _chunks(self, data):
+        return list(chunker.iter_chunks(io.BytesIO(data), 1024, 4096, 16384))
+
+    def test_chunks_are_deterministic_and_bounded(self):
+        chunks = self._chunks(self.content)
+        self.assertEqual(b"".join(chunks), self.content)
+        self.assertEqual(chunks, self._chunks(self.content))
+        self.assertTrue(all(len(c) <= 16384 for c in chunks))
+        self.assertTrue(all(len(c) >= 1024 for c in chunks[:-1]))
+
+    def test_insertion_keeps_most_chunks(self):
+        edited = self.content[:100_000] + b"inserted" + self.content[100_000:]
+        before = set(self._chunks(self.content))
+        after = self._chunks(edited)
+        kept = sum(c in before for c in after)
+        self.assertGreaterEqual(kept, len(after) - 3)
+
+    def _backup(self, manager, password=None):
+        return manager.create_backup(
+            scan_files(self.source),
+            self.source,
+            "Chunks",
+            password=password,
+            chunking=True,
+        )
+
+    def _restore(self, manager, password=None):
+        ver = manager._find_target_versions("Chunks")[-1]
+        manager.restore_version("Chunks", ver.name, self.restore, password=password)
+        return self.restore / f"Chunks_{ver.name}"
+
+    def test_chunked_roundtrip(self):
+        manager = BackupManager(self.storage)
+        self._backup(manager)
+        manifest = manager.load_latest_manifest("Chunks")
+        self.assertEqual(manifest["info"]["chunking"]["algorithm"], "fastcdc")
+        big = manifest["files"]["big.bin"]
+        self.assertNotIn("object", big)
+        self.assertGreater(len(big["chunks"]), 1)
+        self.assertEqual(sum(size for _, size in big["chunks"]), len(self.content))
+        self.assertIn("object", manifest["files"]["small.txt"])  # below MIN_SIZE
+        restored = self._restore(manager)
+        self.assertEqual((restored / "big.bin").read_bytes(), self.content)
+        self.assertEqual((restored / "small.txt").read_bytes(), b"small")
+
+    def test_encrypted_chunks_verify_and_restore(self):
+        manager = BackupManager(self.storage)
+        self._backup(manager, password="pw")
+        ver = manager._find_target_versions("Chunks")[0].name
+        self.assertTrue(manager.verify_password("Chunks", ver, "pw"))
+        self.assertFalse(manager.verify_password("Chunks", ver, "wrong"))
+        restored = self._restore(manager, password="pw")
+        self.assertEqual((restored / "big.bin").read_bytes(), self.content)
+
+    def test_edit_stores_only_changed_chunks(self):
+        manager = BackupManager(self.storage)
+        first = self._backup(manager)
+        edited = bytearray(self.content)
+        edited[150_000:150_010] = b"0123456789"
+        (self.source / "big.bin").write_bytes(bytes(edited))
+        second = self._backup(manager)
+        self.assertLess(second.bytes_written, first.bytes_written / 4)
+        restored = self._restore(manager)
+        self.assertEqual((restored / "big.bin").read_bytes(), bytes(edited))
+
+    @unittest.skipUnless(chunker.numpy, "numpy is not installed")
+    def test_numpy_search_matches_python(self):
+        data = os.urandom(3_000_000)
+        with_numpy = list(chunker.iter_chunks(io.BytesIO(data), 2048, 8192, 65536))
+        with patch("chunker.numpy", None):
+            python = list(chunker.iter_chunks(io.BytesIO(data), 2048, 8192, 65536))
+        self.assertEqual(with_numpy, python)
+
+    def test_workers_split_chunked_files(self):
+        encoded = []
+        original = BackupManager._process_chunked
+
+        def record(manager, *args):
+            encoded.append(args[-1] is not None)
+            return original(manager, *args)
+
+        manager = BackupManager(self.storage)
+        with patch.object(BackupManager, "_process_chunked", record):
+            first = manager.create_backup(
+                scan_files(self.source), self.source, "Chunks", chunking=True, workers=2
+            )
+        self.assertEqual(encoded, [True])
+        serial = BackupManager(self.base / "serial")
+        self._backup(serial)
+        self.assertEqual(
+            manager.load_latest_manifest("Chunks")["files"],
+            serial.load_latest_manifest("Chunks")["files"],
+        )
+        edited = bytearray(self.content)
+        edited[150_000:150_010] = b"0123456789"
+        (self.source / "big.bin").write_bytes(bytes(edited))
+        second = manager.create_backup(
+            scan_files(self.source), self.source, "Chunks", chunking=True, workers=2
+        )
+        self.assertLess(second.bytes_written, first.bytes_written / 4)
+        self.assertEqual(list(self.storage.glob("objects/.stage-*")), [])
+        restored = self._restore(manager)
+        self.assertEqual((restored / "big.bin").read_bytes(), bytes(edited))
+
+
+# ---------------------------------------------------------------------------
+# compressors.py — compression codecs
+# ---------------------------------------------------------------------------
+
+
+AVAILABLE_CODECS = [name for name in compressors.CODECS if compressors.is_available(name)]
+
+
+class TestCodecs(unittest.TestCase):
+    def setUp(self):
+        self.base = Path(__file__).parent.parent / "test_sandbox_codecs"
+        self.source = self.base / "source"
+        self.storage = self.base / "storage"
+        self.restore = self.base / "restore"
+        for p in [self.source, self.storage, self.restore]:
+            shutil.rmtree(p, ignore_errors=True)
+            p.mkdir(parents=True)
+        self.content = os.urandom(3000) + b"text line\n" * 100_000
+        (self.source / "doc.txt").write_bytes(self.content)
+        (self.source / "photo.jpg").write_bytes(os.urandom(20_000))
+
+    def tearDown(self):
+        shutil.rmtree(self.base, ignore_errors=True)
+
+    def _restore(self, manager, password=None):
+        ver = manager._find_target_versions("Codec")[-1]
+        manager.restore_version("Codec", ver.name, self.restore, password=password)
+        return self.restore / f"Codec_{ver.name}"
+
+    def test_frames_roundtrip_every_codec(self):
+        crypter = FileCrypter("pass", time_cost=1, memory_cost=64, parallelism=1)
+        for name in AVAILABLE_CODECS:
+            with self.subTest(codec=name):
+                codec = compressors.get_codec(name)
+                out = io.BytesIO()
+                writer = frames.FrameWriter(out, codec, crypter, frame_size=4096)
+                writer.write(self.content)
+                writer.close()
+                self.assertLess(len(out.getvalue()), len(self.content) / 4)
+                decoded = frames.iter_decoded(io.BytesIO(out.getvalue()), codec, crypter)
+                self.assertEqual(b"".join(decoded), self.content)
+
+    def test_output_is_bounded(self):
+        for name in AVAILABLE_CODECS:
+            with self.subTest(codec=name):
+                codec = compressors.get_codec(name)
+                compressor = codec.compressor()
+                bomb = compressor.compress(b"\0" * 20_000_000) + compressor.flush()
+                sizes = [len(c) for c in codec.iter_decompress([bomb])]
+                self.assertEqual(sum(sizes), 20_000_000)
+                self.assertLessEqual(max(sizes), compressors.DECOMPRESS_CHUNK)
+
+    def test_incomplete_zlib_stream_detected(self):
+        codec = compressors.get_codec("zlib")
+        compressor = codec.compressor()
+        data = compressor.compress(os.urandom(10_000)) + compressor.flush()
+        with self.assertRaises(compressors.CorruptStreamError):
+            b"".join(codec.iter_decompress([data[: len(data) // 2]]))
+
+    def test_parse_codec(self):
+        self.assertIsNone(compressors.parse_codec("none"))
+        self.assertEqual(compressors.parse_codec("zlib").level, 6)
+        self.assertEqual(compressors.parse_codec("zlib:9").label, "zlib:9")
+        for spec in ("brotli", "zlib:0", "zlib:high"):
+            with self.subTest(spec=spec), self.assertRaises(ValueError):
+                compressors.parse_codec(spec)
+
+    def test_missing_package_reported(self):
+        with patch("compressors.zstandard", None):
+            with self.assertRaises(compressors.CodecUnavailableError):
+                compressors.get_codec("zstd")
+
+    @unittest.skipUnless("zstd" in AVAILABLE_CODECS, "zstandard is not installed")
+    def test_backup_records_codec_per_file(self):
+        manager = BackupManager(self.storage)
+        result = manager.create_backup(
+            scan_files(self.source), self.source, "Codec", codec="zstd:19"
+        )
+        files = manager.load_latest_manifest("Codec")["files"]
+        self.assertEqual((files["doc.txt"]["codec"], files["doc.txt"]["level"]), ("zstd", 19))
+        self.assertNotIn("codec", files["photo.jpg"])  # not compressible
+        stats = result.codec_stats["zstd:19"]
+        self.assertEqual(stats.bytes_in, len(self.content))
+        self.assertLess(stats.ratio, 0.25)
+        self.assertEqual((self._restore(manager) / "doc.txt").read_bytes(), self.content)
+
+    @unittest.skipUnless("zstd" in AVAILABLE_CODECS, "zstandard is not installed")
+    def test_reused_object_keeps_its_level(self):
+        manager = BackupManager(self.storage)
+        manager.create_backup(scan_files(self.source), self.source, "Codec", codec="zstd:19")
+        previous = manager.load_latest_manifest("Codec")
+        result = manager.create_backup(
+            scan_files(self.source, previous_manifest=previous),
+            self.source,
+            "Codec",
+            codec="zstd:3",
+        )
+        self.assertEqual(result.copied, 0)
+        files = manager.load_latest_manifest("Codec")["files"]
+        self.assertEqual(files["doc.txt"]["level"], 19)  # the level it was written with
+
+    @unittest.skipUnless("zstd" in AVAILABLE_CODECS, "zstandard is not installed")
+    def test_codecs_do_not_share_objects(self):
+        manager = BackupManager(self.storage)
+        manager.create_backup(scan_files(self.source), self.source, "Codec")
+        zlib_id = manager.load_latest_manifest("Codec")["files"]["doc.txt"]["object"]
+        result = manager.create_backup(
+            scan_files(self.source), self.source, "Codec", codec="zstd"
+        )
+        self.assertEqual(result.copied, 1)  # only doc.txt is stored again
+        zstd_id = manager.load_latest_manifest("Codec")["files"]["doc.txt"]["object"]
+        self.assertNotEqual(zstd_id, zlib_id)
+
+    def test_codec_none_stores_raw(self):
+        manager = BackupManager(self.storage)
+        result = manager.create_backup(
+            scan_files(self.source), self.source, "Codec", codec="none"
+        )
+        manifest = manager.load_latest_manifest("Codec")
+        self.assertFalse(manifest["info"]["compression_enabled"])
+        self.assertEqual(manifest["files"]["doc.txt"]["format"], "raw")
+        self.assertEqual(result.codec_stats, {})
+
+    def test_zlib_manifest_without_codec_restores(self):
+        """Manifests written before codecs were recorded are zlib."""
+        manager = BackupManager(self.storage)
+        manager.create_backup(scan_files(self.source), self.source, "Codec", password="pw")
+        ver = manager._find_target_versions("Codec")[-1]
+        manifest = load_as_v1(ver)
+        for entry in manifest["files"].values():
+            entry.pop("codec", None)
+            entry.pop("level", None)
+        save_as_v1(ver, manifest)
+        restored = self._restore(manager, password="pw")
+        self.assertEqual((restored / "doc.txt").read_bytes(), self.content)
+
+
+# ---------------------------------------------------------------------------
+# compressibility.py — content-based compression decision
+# ---------------------------------------------------------------------------
+
+
+class TestCompressibility(unittest.TestCase):
+    def setUp(self):
+        self.base = Path(__file__).parent.parent / "test_sandbox_entropy"
+        shutil.rmtree(self.base, ignore_errors=True)
+        self.base.mkdir(parents=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.base, ignore_errors=True)
+
+    def _file(self, name, data):
+        path = self.base / name
+        path.write_bytes(data)
+        return path
+
+    def test_decision_follows_content(self):
+        detector = CompressibilityDetector()
+        self.assertTrue(detector.is_compressible(self._file("a.tar", b"log line\n" * 20_000)))
+        self.assertFalse(detector.is_compressible(self._file("blob", os.urandom(100_000))))
+        self.assertTrue(detector.is_compressible(self._file("tiny", os.urandom(100))))
+
+    def test_sample_spans_the_file(self):
+        # incompressible start, compressible rest: the middle and end blocks count
+        data = os.urandom(16 * 1024) + b"\0" * 1_000_000
+        self.assertTrue(CompressibilityDetector().is_compressible(self._file("x.img", data)))
+
+    def test_decision_cached_per_extension(self):
+        detector = CompressibilityDetector()
+        for n in range(5):
+            detector.is_compressible(self._file(f"{n}.webp", os.urandom(10_000)))
+        self.assertEqual(detector.sampled, 3)
+        text = self._file("text.webp", b"a" * 10_000)
+        self.assertFalse(detector.is_compressible(text))
+
+    def test_mixed_extension_keeps_sampling(self):
+        detector = CompressibilityDetector()
+        for n in range(6):
+            data = os.urandom(10_000) if n % 2 else b"a" * 10_000
+            self.assertEqual(
+                detector.is_compressible(self._file(f"{n}.bin", data)), n % 2 == 0
+            )
+        self.assertEqual(detector.sampled, 6)
+
+    def test_unchanged_file_keeps_previous_decision(self):
+        source = self.base / "source"
+        source.mkdir()
+        (source / "data.bin").write_bytes(os.urandom(50_000))
+        manager = BackupManager(self.base / "storage")
+        manager.create_backup(scan_files(source), source, "Ent")
+        previous = manager.load_latest_manifest("Ent")
+        self.assertFalse(previous["files"]["data.bin"]["compressed"])
+        with patch("compressibility.read_sample") as sample:
+            result = manager.create_backup(
+                scan_files(source, previous_manifest=previous), source, "Ent"
+            )
+        sample.assert_not_called()
+        self.assertEqual(result.skipped, 1)
+
+    def test_decision_not_reused_after_compression_was_off(self):
+        source = self.base / "source"
+        source.mkdir()
+        (source / "notes.txt").write_bytes(b"compressible text line\n" * 5000)
+        manager = BackupManager(self.base / "storage")
+        manager.create_backup(scan_files(source), source, "Off", compress=False)
+        previous = manager.load_latest_manifest("Off")
+        self.assertFalse(previous["files"]["notes.txt"]["compressed"])
+        manager.create_backup(
+            scan_files(source, previous_manifest=previous), source, "Off"
+        )
+        entry = manager.load_latest_manifest("Off")["files"]["notes.txt"]
+        self.assertTrue(entry["compressed"])
+
+
+# ---------------------------------------------------------------------------
+# manifests.py — format 2 manifests
+# ---------------------------------------------------------------------------
+
+
+def load_as_v1(ver: Path) -> dict:
+    """The manifest of ver as a plain format 1 dict."""
+    manifest = manifests.open_manifest(ver)
+    return {"info": dict(manifest["info"]), "files": dict(manifest["files"].items())}
+
+
+def save_as_v1(ver: Path, manifest: dict) -> None:
+    """Replaces the manifest of ver with a format 1 manifest.json."""
+    (ver / manifests.MANIFEST_V2).unlink(missing_ok=True)
+    (ver / manifests.MANIFEST_V1).write_text(json.dumps(manifest))
+
+
+class TestManifests(unittest.TestCase):
+    def setUp(self):
+        self.base = Path(__file__).parent.parent / "test_sandbox_manifests"
+        self.base.mkdir(exist_ok=True)
+        self.entries = {
+            f"dir{n % 7}/file{n}.txt": {"hash": f"{n:064x}", "object": f"o{n}"}
+            for n in range(500)
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.base, ignore_errors=True)
+
+    def _write(self, run_entries=manifests.RUN_ENTRIES):
+        writer = manifests.ManifestWriter(self.base / manifests.MANIFEST_V2, run_entries)
+        for rel, entry in reversed(self.entries.items()):
+            writer.add(rel, entry)
+        writer.close({"timestamp": "t", "total_files": len(self.entries)})
+        return manifests.open_manifest(self.base)
+
+    def test_round_trip_sorted(self):
+        with patch("manifests.BLOCK_ENTRIES", 16):
+            manifest = self._write()
+        self.assertEqual(manifest["info"]["total_files"], 500)
+        self.assertEqual(len(manifest["files"]), 500)
+        self.assertEqual(list(manifest["files"]), sorted(self.entries))
+        self.assertEqual(dict(manifest["files"].items()), self.entries)
+
+    def test_lookup_by_path(self):
+        with patch("manifests.BLOCK_ENTRIES", 16):
+            files = self._write()["files"]
+        for rel, entry in self.entries.items():
+            self.assertEqual(files[rel], entry)
+        self.assertIsNone(files.get("dir0/missing.txt"))
+        self.assertNotIn("0_before_everything", files)
+        self.assertNotIn("zz_after_everything", files)
+
+    def test_spilled_runs_merge_and_are_removed(self):
+        """Entries beyond run_entries are sorted in temp files, merged on close."""
+        with patch("manifests.BLOCK_ENTRIES", 16):
+            manifest = self._write(run_entries=64)
+        self.assertEqual(list(manifest["files"]), sorted(self.entries))
+        self.assertEqual(
+            [p.name for p in self.base.iterdir()], [manifests.MANIFEST_V2]
+        )
+
+    def test_empty_manifest(self):
+        self.entries = {}
+        manifest = self._write()
+        self.assertEqual(len(manifest["files"]), 0)
+        self.assertNotIn("a.txt", manifest["files"])
+
+    def test_read_info_reads_header_only(self):
+        self._write()
+        with patch("manifests.ManifestFiles") as files:
+            info = manifests.read_info(self.base)
+        files.assert_not_called()
+        self.assertEqual(info["timestamp"], "t")
+
+    def test_v1_manifest_still_read(self):
+        save_as_v1(self.base, {"info": {"timestamp": "old"}, "files": self.entries})
+        self.assertEqual(manifests.read_info(self.base)["timestamp"], "old")
+        self.assertEqual(manifests.open_manifest(self.base)["files"], self.entries)
+
+    def test_truncated_manifest_rejected(self):
+        self._write()
+        path = self.base / manifests.MANIFEST_V2
+        path.write_bytes(path.read_bytes()[:-10])
+        with self.assertRaises(ValueError):
+            manifests.open_manifest(self.base)
+
+    def test_parse_and_save_copy(self):
+        self._write()
+        data = (self.base / manifests.MANIFEST_V2).read_bytes()
+        manifest = manifests.parse_manifest(data)
+        copy_dir = self.base / "copy"
+        copy_dir.mkdir()
+        self.assertEqual(manifests.save_copy(manifest, copy_dir).read_bytes(), data)
+        legacy = manifests.parse_manifest(json.dumps({"info": {}, "files": {}}).encode())
+        self.assertEqual(manifests.save_copy(legacy, copy_dir).name, manifests.MANIFEST_V1)
+
+    def test_backup_writes_v2(self):
+        source = self.base / "source"
+        source.mkdir()
+        (source / "a.txt").write_text("a")
+        manager = BackupManager(self.base / "storage")
+        manager.create_backup(scan_files(source), source, "V2")
+        ver = manager._find_target_versions("V2")[-1]
+        self.assertTrue((ver / manifests.MANIFEST_V2).exists())
+        self.assertFalse((ver / manifests.MANIFEST_V1).exists())
+        self.assertIn("a.txt", manager.load_latest_manifest("V2")["files"])
+
+
+    def test_line_separators_in_paths(self):
+        """U+2028, U+2029 and U+0085 are written unescaped; only "\n" ends a record."""
+        source = self.base / "source"
+        source.mkdir()
+        names = ["report\u2028final.txt", "para\u2029graph.txt", "next\u0085line.txt"]
+        for name in names:
+            (source / name).write_text(name)
+        manager = BackupManager(self.base / "storage")
+        manager.create_backup(scan_files(source), source, "Sep")
+        ver = manager._find_target_versions("Sep")[-1]
+        self.assertEqual(sorted(manifests.open_manifest(ver)["files"]), sorted(names))
+        restore = self.base / "restore"
+        manager.restore_version("Sep", ver.name, restore)
+        for name in names:
+            self.assertEqual((restore / f"Sep_{ver.name}" / name).read_text(), name)
+
+
+# ---------------------------------------------------------------------------
+# catalog.py — snapshot catalog
+# ---------------------------------------------------------------------------
+
+
+class TestCatalog(unittest.TestCase):
+    def setUp(self):
+        self.base = Path(__file__).parent.parent / "test_sandbox_catalog"
+        self.source = self.base / "source"
+        self.source.mkdir(parents=True, exist_ok=True)
+        (self.source / "a.txt").write_text("a")
+        self.storage = self.base / "storage"
+
+    def tearDown(self):
+        shutil.rmtree(self.base, ignore_errors=True)
+
+    def _summary(self, project, version, comment="", encrypted=False):
+        return SnapshotSummary(project, version, 1, comment, encrypted, False)
+
+    def test_find_filters_and_pages(self):
+        catalog = SnapshotCatalog(self.base / "catalog.sqlite")
+        catalog.replace_all(
+            self._summary(
+                p, f"2025-01-0{d}_00-00-00", comment=f"{p} day {d}", encrypted=d % 2 == 0
+            )
+            for p in ("A", "B")
+            for d in range(1, 6)
+        )
+        self.assertEqual(catalog.count(), 10)
+        self.assertEqual(len(catalog.find(project="A")), 5)
+        self.assertEqual(
+            [s.project for s in catalog.find(version_contains="01-03")], ["A", "B"]
+        )
+        self.assertEqual(len(catalog.find(comment_contains="B day")), 5)
+        self.assertEqual(catalog.count(encrypted=True), 4)
+        page = catalog.find(limit=3, offset=3)
+        self.assertEqual(
+            [(s.project, s.version[:10]) for s in page],
+            [("B", "2025-01-02"), ("A", "2025-01-03"), ("B", "2025-01-03")],
+        )
+        newest = catalog.find(newest_first=True, limit=1)[0]
+        self.assertEqual(newest.version[:10], "2025-01-05")
+        catalog.close()
+
+    def test_substring_filter_is_literal(self):
+        catalog = SnapshotCatalog(self.base / "catalog.sqlite")
+        catalog.record(self._summary("A", "v1", comment="100% done"))
+        catalog.record(self._summary("A", "v2", comment="1000 done"))
+        self.assertEqual([s.version for s in catalog.find(comment_contains="0%")], ["v1"])
+        catalog.close()
+
+    def test_create_backup_records_snapshot(self):
+        manager = BackupManager(self.storage)
+        manager.create_backup(
+            scan_files(self.source), self.source, "Cat", password="pw", comment="first"
+        )
+        [summary] = manager.list_snapshots("Cat")
+        self.assertEqual(summary.version, manager._find_target_versions("Cat")[0].name)
+        self.assertEqual((summary.total_files, summary.comment), (1, "first"))
+        self.assertTrue(summary.encrypted)
+
+    def test_existing_snapshots_cataloged_on_first_use(self):
+        BackupManager(self.storage).create_backup(scan_files(self.source), self.source, "Cat")
+        (self.storage / CATALOG_FILE).unlink()
+        self.assertEqual(len(BackupManager(self.storage).list_snapshots("Cat")), 1)
+
+    def test_rebuild_drops_removed_snapshots(self):
+        manager = BackupManager(self.storage)
+        manager.create_backup(scan_files(self.source), self.source, "Cat")
+        shutil.rmtree(manager._find_target_versions("Cat")[0])
+        self.assertEqual(len(manager.list_snapshots("Cat")), 1)
+        self.assertEqual(manager.rebuild_catalog(), 0)
+        self.assertEqual(manager.list_snapshots("Cat"), [])
+
+    def test_missing_storage_lists_nothing(self):
+        manager = BackupManager(self.base / "nowhere")
+        self.assertEqual(manager.list_snapshots(), [])
+        self.assertFalse((self.base / "nowhere").exists())
+
+    def _history(self, catalog, path):
+        return [(v.version, v.hash) for v in catalog.path_history(path)]
+
+    def test_unchanged_files_extend_one_span(self):
+        catalog = SnapshotCatalog(self.base / "catalog.sqlite")
+        for version, files in [
+            ("v1", [("a.txt", "h1"), ("b.txt", "hb")]),
+            ("v2", [("a.txt", "h1"), ("b.txt", "hb")]),
+            ("v3", [("a.txt", "h2")]),
+            ("v4", [("a.txt", "h1"), ("b.txt", "hb")]),
+        ]:
+            self.assertTrue(catalog.record(self._summary("P", version), files))
+        self.assertEqual(
+            self._history(catalog, "a.txt"),
+            [("v1", "h1"), ("v2", "h1"), ("v3", "h2"), ("v4", "h1")],
+        )
+        b_versions = [version for version, _ in self._history(catalog, "b.txt")]
+        self.assertEqual(b_versions, ["v1", "v2", "v4"])
+        spans = catalog._conn.execute("SELECT COUNT(*) FROM file_spans").fetchone()[0]
+        self.assertEqual(spans, 5)  # a: v1-v2, v3, v4; b: v1-v2, v4
+        catalog.close()
+
+    def test_hash_locations_across_projects(self):
+        catalog = SnapshotCatalog(self.base / "catalog.sqlite")
+        catalog.record(self._summary("A", "v1"), [("x.bin", "h"), ("copy.bin", "h")])
+        catalog.record(self._summary("B", "v1"), [("y.bin", "h"), ("z.bin", "other")])
+        locations = catalog.hash_locations("h")
+        self.assertEqual(
+            [(v.project, v.path) for v in locations],
+            [("A", "copy.bin"), ("A", "x.bin"), ("B", "y.bin")],
+        )
+        self.assertEqual(len(catalog.hash_locations("h", project="B")), 1)
+        self.assertEqual(len(catalog.hash_locations("h", limit=2)), 2)
+        catalog.close()
+
+    def test_older_snapshot_needs_reindex(self):
+        catalog = SnapshotCatalog(self.base / "catalog.sqlite")
+        snapshots = {
+            "v1": [("a.txt", "h1")],
+            "v2": [("a.txt", "h2")],
+            "v3": [("a.txt", "h1")],
+        }
+        catalog.record(self._summary("P", "v1"), snapshots["v1"])
+        catalog.record(self._summary("P", "v3"), snapshots["v3"])
+        self.assertFalse(catalog.record(self._summary("P", "v2"), snapshots["v2"]))
+        catalog.reindex_project("P", sorted(snapshots.items()))
+        self.assertEqual(
+            self._history(catalog, "a.txt"), [("v1", "h1"), ("v2", "h2"), ("v3", "h1")]
+        )
+        catalog.close()
+
+    def test_manager_file_queries(self):
+        (self.source / "b.txt").write_text("a")  # same content as a.txt
+        manager = BackupManager(self.storage)
+        manager.create_backup(scan_files(self.source), self.source, "One")
+        manager.create_backup(scan_files(self.source), self.source, "Two")
+        history = manager.path_history("a.txt")
+        self.assertEqual([v.project for v in history], ["One", "Two"])
+        self.assertEqual(len(manager.hash_locations(history[0].hash)), 4)
+        self.assertEqual(len(manager.hash_locations(history[0].hash, "Two")), 2)
+        # a rebuild from the manifests gives the same answers
+        (self.storage / CATALOG_FILE).unlink()
+        rebuilt = BackupManager(self.storage)
+        self.assertEqual(rebuilt.path_history("a.txt"), history)
+
+
+# ---------------------------------------------------------------------------
+# crypter.py — key cache and unlock sessions
+# ---------------------------------------------------------------------------
+
+FAST_KDF = {"time_cost": 1, "memory_cost": 64, "parallelism": 1}
+
+
+class TestKeyCache(unittest.TestCase):
+    def test_derives_once_per_salt_and_password(self):
+        import crypter
+
+        cache = KeyCache()
+        salt = os.urandom(16)
+        with patch("crypter.hash_secret_raw", wraps=crypter.hash_secret_raw) as kdf:
+            first = cache.crypter("pw", salt, **FAST_KDF)
+            second = cache.crypter("pw", salt, **FAST_KDF)
+            other = cache.crypter("other", salt, **FAST_KDF)
+        self.assertEqual(kdf.call_count, 2)
+        self.assertEqual(first.decrypt(second.encrypt(b"data")), b"data")
+        self.assertNotEqual(bytes(first.key), bytes(other.key))
+        self.assertEqual(bytes(first.key), bytes(FileCrypter("pw", salt, **FAST_KDF).key))
+
+    def test_expired_and_cleared_keys_are_zeroized(self):
+        cache = KeyCache(ttl=0)
+        cache.crypter("pw", os.urandom(16), **FAST_KDF)
+        (cached, _), = cache._entries.values()
+        self.assertEqual(len(cache), 0)  # expired on the next access
+        self.assertEqual(bytes(cached), bytes(32))
+
+        cache = KeyCache()
+        salt = os.urandom(16)
+        crypter = cache.crypter("pw", salt, **FAST_KDF)
+        (cached, _), = cache._entries.values()
+        token = crypter.encrypt(b"still usable")
+        cache.clear()
+        self.assertEqual(bytes(cached), bytes(32))
+        self.assertEqual(crypter.decrypt(token), b"still usable")
+        # a backup computes the key check last, possibly after its entry expired
+        expected = FileCrypter("pw", salt, **FAST_KDF).key_check()
+        self.assertEqual(crypter.key_check(), expected)
+
+    def test_session_restores_with_one_derivation(self):
+        import crypter
+
+        base = Path(__file__).parent.parent / "test_sandbox_session"
+        shutil.rmtree(base, ignore_errors=True)
+        (base / "source").mkdir(parents=True)
+        (base / "source" / "a.txt").write_bytes(b"secret data")
+        try:
+            manager = BackupManager(base / "storage")
+            with patch("crypter.hash_secret_raw", wraps=crypter.hash_secret_raw) as kdf:
+                with UnlockSession("pw") as session:
+                    manager.create_backup(
+                        scan_files(base / "source"), base / "source", "S", session=session
+                    )
+                    ver = manager._find_target_versions("S")[-1].name
+                    self.assertTrue(manager.verify_password("S", ver, session=session))
+                    manager.restore_version("S", ver, base / "out", session=session)
+            self.assertEqual(kdf.call_count, 1)
+            self.assertEqual((base / "out" / f"S_{ver}" / "a.txt").read_bytes(), b"secret data")
+            with self.assertRaises(ValueError):
+                session.crypter(os.urandom(16))
+        finally:
+            shutil.rmtree(base, ignore_errors=True)
+
+
 # ---------------------------------------------------------------------------
 # cloud_manager.py — full coverage via mocks
 # ---------------------------------------------------------------------------
@@ -423,24 +2126,32 @@ class TestCloudManager(unittest.TestCase):
 
     @patch("cloud_manager.boto3.client")
     def test_get_last_manifest_success(self, mock_boto):
+        import tempfile
+
         cm, mock_s3 = self._make_manager(mock_boto)
         manifest_data = json.dumps({"info": {}, "files": {}}).encode()
         mock_s3.get_paginator.return_value.paginate.return_value = [
             {"Contents": [{"Key": "backups/proj/ver/manifest.json"}]}
         ]
         mock_s3.get_object.return_value = {"Body": io.BytesIO(manifest_data)}
-        result = cm.get_last_manifest("proj")
-        self.assertIsNotNone(result)
+        with tempfile.TemporaryDirectory() as tmp:
+            result = cm.get_last_manifest("proj", Path(tmp))
+            self.assertIsNotNone(result)
+            # streamed to the version directory, kept as the local copy
+            local_copy = Path(tmp) / "proj" / "ver" / "manifest.json"
+            self.assertEqual(local_copy.read_bytes(), manifest_data)
+        self.assertEqual(result[1], "backups/proj/ver/manifest.json")
 
     @patch("cloud_manager.boto3.client")
     def test_get_last_manifest_no_manifests(self, mock_boto):
         cm, mock_s3 = self._make_manager(mock_boto)
         mock_s3.get_paginator.return_value.paginate.return_value = [{"Contents": []}]
-        result = cm.get_last_manifest("proj")
+        result = cm.get_last_manifest("proj", Path("unused"))
         self.assertIsNone(result)
 
     @patch("cloud_manager.boto3.client")
     def test_get_last_manifest_download_error(self, mock_boto):
+        import tempfile
         from botocore.exceptions import ClientError
 
         cm, mock_s3 = self._make_manager(mock_boto)
@@ -450,8 +2161,24 @@ class TestCloudManager(unittest.TestCase):
         mock_s3.get_object.side_effect = ClientError(
             {"Error": {"Code": "500", "Message": "err"}}, "GetObject"
         )
-        result = cm.get_last_manifest("proj")
-        self.assertIsNone(result)
+        with tempfile.TemporaryDirectory() as tmp:
+            result = cm.get_last_manifest("proj", Path(tmp))
+        self.assertIsNone(result)
+
+    @patch("cloud_manager.boto3.client")
+    def test_object_size_from_head(self, mock_boto):
+        from botocore.exceptions import ClientError
+
+        cm, mock_s3 = self._make_manager(mock_boto)
+        mock_s3.head_object.return_value = {"ContentLength": 1234}
+        self.assertEqual(cm.object_size(Path("objects/aa/bb")), 1234)
+        mock_s3.head_object.assert_called_with(
+            Bucket="bucket", Key="backups/objects/aa/bb"
+        )
+        mock_s3.head_object.side_effect = ClientError(
+            {"Error": {"Code": "404", "Message": "Not Found"}}, "HeadObject"
+        )
+        self.assertIsNone(cm.object_size(Path("objects/aa/cc")))
 
     @patch("cloud_manager.boto3.client")
     def test_upload_data_skips_existing(self, mock_boto):
@@ -473,6 +2200,27 @@ class TestCloudManager(unittest.TestCase):
             cm.upload_data(Path("objects/aa/bb"), b"data")
         mock_s3.upload_fileobj.assert_called_once()
 
+    @patch("cloud_manager.boto3.client")
+    def test_upload_data_from_path_streams_file(self, mock_boto):
+        """A Path is uploaded from disk instead of from memory."""
+        import tempfile
+        from botocore.exceptions import ClientError
+
+        cm, mock_s3 = self._make_manager(mock_boto)
+        mock_s3.head_object.side_effect = ClientError(
+            {"Error": {"Code": "404", "Message": "Not Found"}}, "HeadObject"
+        )
+        with tempfile.TemporaryDirectory() as tmp:
+            obj = Path(tmp) / "obj"
+            obj.write_bytes(b"streamed")
+            uploaded = []
+            mock_s3.upload_fileobj.side_effect = lambda f, *a, **kw: uploaded.append(
+                f.read()
+            )
+            with patch("builtins.print"):
+                cm.upload_data(Path("objects/aa/bb"), obj)
+        self.assertEqual(uploaded, [b"streamed"])
+
     @patch("cloud_manager.boto3.client")
     def test_upload_data_json_content_type(self, mock_boto):
         from botocore.exceptions import ClientError
@@ -488,6 +2236,44 @@ class TestCloudManager(unittest.TestCase):
             kwargs.get("ExtraArgs", {}).get("ContentType"), "application/json"
         )
 
+    @patch("cloud_manager.boto3.client")
+    def test_upload_data_indexed_key_skips_head(self, mock_boto):
+        """Uploaded objects are recorded; the next upload needs no HEAD request."""
+        import tempfile
+        from botocore.exceptions import ClientError
+        from cloud_manager import CloudManager
+
+        mock_s3 = MagicMock()
+        mock_boto.return_value = mock_s3
+        mock_s3.head_object.side_effect = ClientError(
+            {"Error": {"Code": "404", "Message": "Not Found"}}, "HeadObject"
+        )
+        with tempfile.TemporaryDirectory() as tmp:
+            cm = CloudManager("http://e", "k", "s", "bucket", index_path=Path(tmp) / "i.db")
+            with patch("builtins.print"):
+                cm.upload_data(Path("objects/aa/bb"), b"data")
+                cm.upload_data(Path("objects/aa/bb"), b"data")
+            cm.index.close()
+        mock_s3.head_object.assert_called_once()
+        mock_s3.upload_fileobj.assert_called_once()
+
+    @patch("cloud_manager.boto3.client")
+    def test_rebuild_index_from_listing(self, mock_boto):
+        import tempfile
+        from cloud_manager import CloudManager
+
+        mock_s3 = MagicMock()
+        mock_boto.return_value = mock_s3
+        mock_s3.get_paginator.return_value.paginate.side_effect = [
+            [{"Contents": [{"Key": "backups/objects/aa/bb"}]}],
+            [{"Contents": [{"Key": "backups/packs/p.pack"}, {"Key": "backups/packs/p.idx"}]}],
+        ]
+        with tempfile.TemporaryDirectory() as tmp:
+            cm = CloudManager("http://e", "k", "s", "bucket", index_path=Path(tmp) / "i.db")
+            self.assertEqual(cm.rebuild_index(), 3)
+            self.assertIn("backups/objects/aa/bb", cm.index)
+            cm.index.close()
+
     @patch("cloud_manager.boto3.client")
     def test_show_upload_progress(self, mock_boto):
         cm, _ = self._make_manager(mock_boto)
@@ -510,6 +2296,597 @@ class TestCloudManager(unittest.TestCase):
         result = cm.download_objects(Path("objects/aa/bb"))
         self.assertEqual(result, b"blob")
 
+    @patch("cloud_manager.boto3.client")
+    def test_download_objects_range(self, mock_boto):
+        """Packed objects are fetched with a ranged GET."""
+        cm, mock_s3 = self._make_manager(mock_boto)
+        mock_s3.get_object.return_value = {"Body": io.BytesIO(b"lob")}
+        result = cm.download_objects(Path("packs/p.pack"), (4, 3))
+        self.assertEqual(result, b"lob")
+        mock_s3.get_object.assert_called_once_with(
+            Bucket="bucket", Key="backups/packs/p.pack", Range="bytes=4-6"
+        )
+
+    def _ranged_bucket(self, mock_s3, data):
+        """get_object serving data with Range support, recording the ranges."""
+        from botocore.response import StreamingBody
+
+        ranges = []
+
+        def get_object(Bucket, Key, Range=None):
+            if Range is None:
+                return {"Body": StreamingBody(io.BytesIO(data), len(data))}
+            ranges.append(Range)
+            start, end = (int(n) for n in Range[len("bytes=") :].split("-"))
+            part = data[start : end + 1]
+            return {
+                "Body": StreamingBody(io.BytesIO(part), len(part)),
+                "ContentRange": f"bytes {start}-{start + len(part) - 1}/{len(data)}",
+            }
+
+        mock_s3.get_object.side_effect = get_object
+        return ranges
+
+    @patch("cloud_manager.boto3.client")
+    def test_large_object_downloaded_in_parts(self, mock_boto):
+        from cloud_manager import CloudManager
+
+        data = os.urandom(10_000)
+        cm = CloudManager("http://e", "k", "s", "bucket", part_size=1024)
+        ranges = self._ranged_bucket(mock_boto.return_value, data)
+        with cm.download_objects(Path("objects/aa/bb")) as f:
+            self.assertEqual(f.read(), data)
+        self.assertEqual(len(ranges), 10)
+        self.assertIn("bytes=9216-9999", ranges)
+
+    @patch("cloud_manager.boto3.client")
+    def test_small_object_downloaded_as_bytes(self, mock_boto):
+        from cloud_manager import CloudManager
+
+        cm = CloudManager("http://e", "k", "s", "bucket", part_size=1024)
+        ranges = self._ranged_bucket(mock_boto.return_value, b"small")
+        self.assertEqual(cm.download_objects(Path("objects/aa/bb")), b"small")
+        self.assertEqual(ranges, ["bytes=0-1023"])
+
+    @patch("cloud_manager.boto3.client")
+    def test_download_file_writes_to_disk(self, mock_boto):
+        import tempfile
+        from cloud_manager import CloudManager
+
+        data = os.urandom(5000)
+        cm = CloudManager(
+            "http://e", "k", "s", "bucket", part_size=1024, transfer_concurrency=1
+        )
+        self._ranged_bucket(mock_boto.return_value, data)
+        with tempfile.TemporaryDirectory() as tmp:
+            dest = Path(tmp) / "manifest.sbm"
+            self.assertEqual(cm.download_file("backups/p/v/manifest.sbm", dest), 5000)
+            self.assertEqual(dest.read_bytes(), data)
+            self.assertEqual(os.listdir(tmp), ["manifest.sbm"])
+
+    @patch("cloud_manager.boto3.client")
+    def test_download_empty_object(self, mock_boto):
+        from botocore.exceptions import ClientError
+        from cloud_manager import CloudManager
+
+        mock_boto.return_value.get_object.side_effect = ClientError(
+            {"Error": {"Code": "InvalidRange", "Message": "Empty"}}, "GetObject"
+        )
+        cm = CloudManager("http://e", "k", "s", "bucket")
+        self.assertEqual(cm.download_objects(Path("objects/aa/bb")), b"")
+
+    def _multipart_bucket(self, mock_boto, tmp, **kwargs):
+        from botocore.exceptions import ClientError
+        from cloud_manager import CloudManager
+
+        mock_s3 = mock_boto.return_value
+        mock_s3.head_object.side_effect = ClientError(
+            {"Error": {"Code": "404", "Message": "Not Found"}}, "HeadObject"
+        )
+        mock_s3.create_multipart_upload.return_value = {"UploadId": "new-id"}
+        mock_s3.upload_part.side_effect = lambda **kw: {
+            "ETag": f'"{hashlib.md5(kw["Body"]).hexdigest()}"'
+        }
+        cm = CloudManager(
+            "http://e",
+            "k",
+            "s",
+            "bucket",
+            part_size=1024,
+            journal_path=Path(tmp) / "journal.db",
+            **kwargs,
+        )
+        return cm, mock_s3
+
+    @patch("cloud_manager.boto3.client")
+    def test_large_upload_is_multipart(self, mock_boto):
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as tmp:
+            cm, mock_s3 = self._multipart_bucket(mock_boto, tmp)
+            big = Path(tmp) / "pack"
+            big.write_bytes(os.urandom(4000))
+            cm.upload_data(Path("packs/p.pack"), big, quiet=True)
+            self.assertEqual(cm.journal.pending(), [])
+            cm.journal.close()
+        mock_s3.upload_fileobj.assert_not_called()
+        mock_s3.create_multipart_upload.assert_called_once_with(
+            Bucket="bucket", Key="backups/packs/p.pack"
+        )
+        calls = mock_s3.upload_part.call_args_list
+        self.assertEqual({c.kwargs["UploadId"] for c in calls}, {"new-id"})
+        sent = sorted(c.kwargs["PartNumber"] for c in calls)
+        self.assertEqual(sent, [1, 2, 3, 4])
+        parts = mock_s3.complete_multipart_upload.call_args.kwargs["MultipartUpload"]
+        self.assertEqual([p["PartNumber"] for p in parts["Parts"]], [1, 2, 3, 4])
+
+    @patch("cloud_manager.boto3.client")
+    def test_interrupted_upload_is_continued(self, mock_boto):
+        import tempfile
+        from upload_journal import PendingUpload
+
+        data = os.urandom(3000)
+        with tempfile.TemporaryDirectory() as tmp:
+            cm, mock_s3 = self._multipart_bucket(mock_boto, tmp, transfer_concurrency=1)
+            key = "backups/objects/aa/bb"
+            cm.journal.start(PendingUpload(key, "old-id", 1024, 3000))
+            # part 1 arrived intact, part 2 holds other bytes
+            intact = f'"{hashlib.md5(data[:1024]).hexdigest()}"'
+            mock_s3.get_paginator.return_value.paginate.return_value = [
+                {
+                    "Parts": [
+                        {"PartNumber": 1, "ETag": intact},
+                        {"PartNumber": 2, "ETag": '"0000"'},
+                    ]
+                }
+            ]
+            cm.upload_data(Path("objects/aa/bb"), data, quiet=True)
+            self.assertIsNone(cm.journal.get(key))
+            cm.journal.close()
+        mock_s3.create_multipart_upload.assert_not_called()
+        calls = mock_s3.upload_part.call_args_list
+        self.assertEqual([c.kwargs["PartNumber"] for c in calls], [2, 3])
+        self.assertEqual({c.kwargs["UploadId"] for c in calls}, {"old-id"})
+
+    @patch("cloud_manager.boto3.client")
+    def test_interrupted_upload_resumes_from_kept_bytes(self, mock_boto):
+        import tempfile
+
+        first = os.urandom(3000)
+        with tempfile.TemporaryDirectory() as tmp:
+            cm, mock_s3 = self._multipart_bucket(mock_boto, tmp, transfer_concurrency=1)
+            sent, failures = {}, [OSError("connection reset")]
+
+            def flaky(**kw):
+                if kw["PartNumber"] == 2 and failures:
+                    raise failures.pop()
+                sent[kw["PartNumber"]] = kw["Body"]
+                return {"ETag": f'"{hashlib.md5(kw["Body"]).hexdigest()}"'}
+
+            mock_s3.upload_part.side_effect = flaky
+            temp = Path(tmp) / ".stage-1"
+            temp.write_bytes(first)
+            with self.assertRaises(OSError):
+                cm.upload_data(Path("objects/aa/bb"), temp, quiet=True, discard=True)
+            kept = Path(cm.journal.get("backups/objects/aa/bb").source)
+            self.assertEqual(kept.read_bytes(), first)
+            self.assertFalse(temp.exists())
+            intact = f'"{hashlib.md5(first[:1024]).hexdigest()}"'
+            mock_s3.get_paginator.return_value.paginate.return_value = [
+                {"Parts": [{"PartNumber": 1, "ETag": intact}]}
+            ]
+            # the next run encodes the object anew: other bytes, same key
+            retry = Path(tmp) / ".stage-2"
+            retry.write_bytes(os.urandom(3000))
+            cm.upload_data(Path("objects/aa/bb"), retry, quiet=True, discard=True)
+            self.assertIsNone(cm.journal.get("backups/objects/aa/bb"))
+            self.assertFalse(kept.exists())
+            cm.journal.close()
+        self.assertEqual(b"".join(sent[n] for n in sorted(sent)), first)
+        mock_s3.create_multipart_upload.assert_called_once()
+        numbers = [c.kwargs["PartNumber"] for c in mock_s3.upload_part.call_args_list]
+        self.assertEqual(numbers, [1, 2, 2, 3])
+
+    @patch("cloud_manager.boto3.client")
+    def test_failed_upload_stays_journaled(self, mock_boto):
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as tmp:
+            cm, mock_s3 = self._multipart_bucket(mock_boto, tmp)
+            mock_s3.upload_part.side_effect = OSError("connection reset")
+            with self.assertRaises(OSError):
+                cm.upload_data(Path("objects/aa/bb"), b"x" * 3000, quiet=True)
+            self.assertEqual(cm.journal.get("backups/objects/aa/bb").upload_id, "new-id")
+            self.assertEqual(cm.abort_pending_uploads(), 1)
+            self.assertEqual(cm.journal.pending(), [])
+            self.assertEqual(list(cm.resume_dir.iterdir()), [])
+            cm.journal.close()
+        mock_s3.abort_multipart_upload.assert_called_once_with(
+            Bucket="bucket", Key="backups/objects/aa/bb", UploadId="new-id"
+        )
+
+    @patch("cloud_manager.boto3.client")
+    def test_client_retries_with_backoff(self, mock_boto):
+        from cloud_manager import CloudManager, RETRY_ATTEMPTS
+
+        CloudManager("http://e", "k", "s", "bucket")
+        config = mock_boto.call_args.kwargs["config"]
+        self.assertEqual(
+            config.retries, {"max_attempts": RETRY_ATTEMPTS, "mode": "adaptive"}
+        )
+
+    @patch("cloud_manager.time.sleep")
+    @patch("cloud_manager.boto3.client")
+    def test_dropped_download_part_is_retried(self, mock_boto, mock_sleep):
+        from cloud_manager import CloudManager
+
+        data = os.urandom(3000)
+        cm = CloudManager(
+            "http://e", "k", "s", "bucket", part_size=1024, transfer_concurrency=1
+        )
+        self._ranged_bucket(mock_boto.return_value, data)
+        serve = mock_boto.return_value.get_object.side_effect
+        dropped = []
+
+        def get_object(**kwargs):
+            response = serve(**kwargs)
+            if kwargs.get("Range") == "bytes=1024-2047" and not dropped:
+                dropped.append(True)
+                response["Body"]._raw_stream = io.BytesIO(data[1024:1500])
+            return response
+
+        mock_boto.return_value.get_object.side_effect = get_object
+        with self.assertLogs("cloud_manager", "WARNING"):
+            with cm.download_objects(Path("objects/aa/bb")) as f:
+                self.assertEqual(f.read(), data)
+        mock_sleep.assert_called_once()
+
+    @patch("cloud_manager.boto3.client")
+    def test_object_listing_replaces_head_requests(self, mock_boto):
+        from botocore.exceptions import ClientError
+        from cloud_manager import CloudManager, OBJECT_PREFIXES
+
+        stored = "ab" * 32
+        mock_s3 = mock_boto.return_value
+
+        def paginate(Bucket, Prefix):
+            if Prefix == "backups/objects/ab/":
+                return [{"Contents": [{"Key": f"{Prefix}{stored}"}]}]
+            return [{}]
+
+        mock_s3.get_paginator.return_value.paginate.side_effect = paginate
+        mock_s3.head_object.side_effect = ClientError(
+            {"Error": {"Code": "404", "Message": "Not Found"}}, "HeadObject"
+        )
+        cm = CloudManager("http://e", "k", "s", "bucket")
+        self.assertEqual(cm.load_object_listing(workers=4), 1)
+        self.assertEqual(
+            mock_s3.get_paginator.return_value.paginate.call_count,
+            len(OBJECT_PREFIXES),
+        )
+        self.assertTrue(cm.has_object(Path(f"objects/ab/{stored}")))
+        self.assertFalse(cm.upload_data(Path(f"objects/ab/{stored}"), b"x", quiet=True))
+        missing = Path(f"objects/cd/{'cd' * 32}")
+        self.assertFalse(cm.has_object(missing))
+        self.assertTrue(cm.upload_data(missing, b"x", quiet=True))
+        self.assertTrue(cm.has_object(missing))
+        mock_s3.head_object.assert_not_called()
+
+    @patch("cloud_manager.boto3.client")
+    def test_listing_overrides_stale_index(self, mock_boto):
+        import tempfile
+        from cloud_manager import CloudManager
+
+        mock_s3 = mock_boto.return_value
+        mock_s3.get_paginator.return_value.paginate.return_value = [{}]
+        gone = Path(f"objects/ab/{'ab' * 32}")  # deleted from the bucket
+        with tempfile.TemporaryDirectory() as tmp:
+            cm = CloudManager("http://e", "k", "s", "bucket", index_path=Path(tmp) / "i.db")
+            cm.index.add_many([f"backups/{gone.as_posix()}", "backups/packs/p.pack"])
+            self.assertEqual(cm.load_object_listing(), 0)
+            self.assertNotIn(f"backups/{gone.as_posix()}", cm.index)
+            self.assertIn("backups/packs/p.pack", cm.index)  # not covered by the listing
+            self.assertFalse(cm.has_object(gone))
+            self.assertTrue(cm.upload_data(gone, b"x", quiet=True))
+            cm.index.close()
+        mock_s3.upload_fileobj.assert_called_once()
+        mock_s3.head_object.assert_not_called()
+
+    @patch("cloud_manager.boto3.client")
+    def test_keys_outside_listing_still_checked(self, mock_boto):
+        from cloud_manager import CloudManager
+
+        mock_s3 = mock_boto.return_value
+        mock_s3.get_paginator.return_value.paginate.return_value = [{}]
+        cm = CloudManager("http://e", "k", "s", "bucket")
+        cm.load_object_listing()
+        self.assertFalse(cm.upload_data(Path("Proj/v1/manifest.sbm"), b"m", quiet=True))
+        mock_s3.head_object.assert_called_once()
+
+    @patch("cloud_manager.boto3.client")
+    def test_list_pack_indexes(self, mock_boto):
+        cm, mock_s3 = self._make_manager(mock_boto)
+        page = {
+            "Contents": [
+                {"Key": "backups/packs/b.idx"},
+                {"Key": "backups/packs/b.pack"},
+                {"Key": "backups/packs/a.idx"},
+            ]
+        }
+        mock_s3.get_paginator.return_value.paginate.return_value = [page]
+        self.assertEqual(
+            cm.list_pack_indexes(), ["backups/packs/a.idx", "backups/packs/b.idx"]
+        )
+
+
+class _FakeCloud:
+    """Records uploads; upload_data waits for gate when one is set."""
+
+    def __init__(self, fail=()):
+        self.lock = threading.Lock()
+        self.order = []
+        self.running = 0
+        self.max_running = 0
+        self.gate = None
+        self.fail = set(fail)
+
+    def upload_data(self, rel_path, data, quiet=False, discard=False):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        try:
+            if self.gate is not None:
+                self.gate.wait(5)
+            if str(rel_path) in self.fail:
+                raise OSError("connection reset")
+            with self.lock:
+                self.order.append(str(rel_path))
+            return True
+        finally:
+            with self.lock:
+                self.running -= 1
+
+
+class TestUploadQueue(unittest.TestCase):
+    def test_uploads_run_concurrently(self):
+        from cloud_manager import UploadQueue
+
+        cloud = _FakeCloud()
+        cloud.gate = threading.Event()
+        uploads = UploadQueue(cloud, workers=4)
+        for n in range(4):
+            uploads(Path(f"objects/aa/{n}"), b"x")
+        while cloud.running < 4:
+            time.sleep(0.01)
+        cloud.gate.set()
+        with uploads:
+            pass
+        self.assertEqual(cloud.max_running, 4)
+        self.assertEqual((uploads.uploaded, uploads.bytes_uploaded), (4, 4))
+
+    def test_submit_blocks_when_queue_is_full(self):
+        from cloud_manager import QUEUE_DEPTH_PER_WORKER, UploadQueue
+
+        cloud = _FakeCloud()
+        cloud.gate = threading.Event()
+        uploads = UploadQueue(cloud, workers=1)
+        for n in range(QUEUE_DEPTH_PER_WORKER):
+            uploads(Path(f"objects/aa/{n}"), b"x")
+        blocked = threading.Thread(target=uploads, args=(Path("objects/aa/last"), b"x"))
+        blocked.start()
+        blocked.join(0.2)
+        self.assertTrue(blocked.is_alive())
+        cloud.gate.set()
+        blocked.join(5)
+        with uploads:
+            pass
+        self.assertEqual(len(cloud.order), QUEUE_DEPTH_PER_WORKER + 1)
+
+    def test_pack_index_after_pack_and_manifest_last(self):
+        from cloud_manager import UploadQueue
+
+        cloud = _FakeCloud()
+        with UploadQueue(cloud, workers=4) as uploads:
+            uploads(Path("packs/p1.pack"), b"pack")
+            uploads(Path("packs/p1.idx"), b"idx")
+            uploads(Path("objects/aa/bb"), b"obj")
+            uploads(Path("Proj/v1/manifest.sbm"), b"manifest")
+        order = cloud.order
+        self.assertLess(order.index("packs/p1.pack"), order.index("packs/p1.idx"))
+        self.assertEqual(cloud.order[-1], "Proj/v1/manifest.sbm")
+
+    def test_failed_upload_keeps_manifest_back(self):
+        from cloud_manager import UploadError, UploadQueue
+
+        cloud = _FakeCloud(fail={"packs/p1.pack"})
+        with self.assertLogs("cloud_manager", "ERROR"):
+            with self.assertRaises(UploadError):
+                with UploadQueue(cloud, workers=2) as uploads:
+                    uploads(Path("packs/p1.pack"), b"pack")
+                    uploads(Path("packs/p1.idx"), b"idx")
+                    uploads(Path("Proj/v1/manifest.sbm"), b"manifest")
+        self.assertEqual(cloud.order, [])
+
+    @patch("cloud_manager.boto3.client")
+    def test_connection_pool_sized_for_workers(self, mock_boto):
+        from cloud_manager import CloudManager
+
+        CloudManager("http://e", "k", "s", "bucket", max_connections=32)
+        config = mock_boto.call_args.kwargs["config"]
+        self.assertEqual(config.max_pool_connections, 32)
+
+    @patch("cloud_manager.boto3.client")
+    def test_quiet_upload_uses_one_connection(self, mock_boto):
+        from botocore.exceptions import ClientError
+        from cloud_manager import CloudManager, _ONE_CONNECTION
+
+        mock_s3 = mock_boto.return_value
+        mock_s3.head_object.side_effect = ClientError(
+            {"Error": {"Code": "404", "Message": "Not Found"}}, "HeadObject"
+        )
+        cm = CloudManager("http://e", "k", "s", "bucket")
+        with patch("builtins.print") as mock_print:
+            self.assertTrue(cm.upload_data(Path("objects/aa/bb"), b"data", quiet=True))
+        mock_print.assert_not_called()
+        self.assertIs(mock_s3.upload_fileobj.call_args.kwargs["Config"], _ONE_CONNECTION)
+
+
+class _BucketStore:
+    """In-memory bucket for direct backups: a remote and an upload target."""
+
+    def __init__(self):
+        self.objects = {}
+        self.uploads = []
+
+    def has_object(self, rel_path):
+        return str(rel_path) in self.objects
+
+    def upload_data(self, rel_path, data, quiet=False, discard=False):
+        if str(rel_path) in self.objects:
+            return False
+        self.objects[str(rel_path)] = (
+            data.read_bytes() if isinstance(data, Path) else data
+        )
+        self.uploads.append(str(rel_path))
+        return True
+
+    def download_objects(self, rel_path, byte_range=None):
+        data = self.objects[str(rel_path)]
+        if byte_range is None:
+            return data
+        offset, length = byte_range
+        return data[offset : offset + length]
+
+
+class TestDirectBackup(unittest.TestCase):
+    def setUp(self):
+        self.base = Path(__file__).parent.parent / "test_sandbox_direct"
+        self.source = self.base / "source"
+        self.storage = self.base / "storage"
+        self.restore = self.base / "restore"
+        for p in [self.source, self.storage, self.restore]:
+            shutil.rmtree(p, ignore_errors=True)
+            p.mkdir(parents=True)
+        (self.source / "small.txt").write_bytes(b"small file " * 10)
+        (self.source / "copy.txt").write_bytes(b"small file " * 10)
+        (self.source / "big.bin").write_bytes(os.urandom(64 * 1024))
+        self.bucket = _BucketStore()
+
+    def tearDown(self):
+        shutil.rmtree(self.base, ignore_errors=True)
+
+    def _backup(self, **kwargs):
+        from cloud_manager import UploadQueue
+
+        manager = BackupManager(self.storage, remote=self.bucket)
+        with UploadQueue(self.bucket, workers=2) as uploads:
+            res = manager.create_backup(
+                scan_files(self.source),
+                self.source,
+                "Direct",
+                password="pw",
+                after_obj_created=uploads,
+                **kwargs,
+            )
+        return manager, res
+
+    def _stored_objects(self):
+        return [
+            p
+            for sub in ("objects", "packs")
+            for p in (self.storage / sub).rglob("*")
+            if p.is_file() and p.suffix != ".idx" and not p.name.startswith(".")
+        ]
+
+    def test_objects_only_uploaded(self):
+        manager, res = self._backup()
+        self.assertEqual(res.copied, 2)
+        self.assertEqual(self._stored_objects(), [])
+        self.assertEqual(len(self.bucket.uploads), 3)  # two objects, the manifest
+        self.assertTrue(self.bucket.uploads[-1].endswith(manifests.MANIFEST_V2))
+        ver = manager._find_target_versions("Direct")[-1]
+        manager.restore_version(
+            "Direct",
+            ver.name,
+            self.restore,
+            password="pw",
+            fetch_proxy=self.bucket.download_objects,
+        )
+        restored = self.restore / f"Direct_{ver.name}"
+        for name in ("small.txt", "copy.txt", "big.bin"):
+            self.assertEqual(
+                (restored / name).read_bytes(), (self.source / name).read_bytes()
+            )
+
+    def test_restore_from_downloaded_files(self):
+        """fetch_proxy may return a file, as for objects downloaded in parts."""
+        import tempfile
+
+        manager, _ = self._backup()
+
+        def download_to_file(rel_path, byte_range=None):
+            f = tempfile.TemporaryFile()
+            f.write(self.bucket.download_objects(rel_path, byte_range))
+            f.seek(0)
+            return f
+
+        ver = manager._find_target_versions("Direct")[-1]
+        manager.restore_version(
+            "Direct",
+            ver.name,
+            self.restore,
+            password="pw",
+            fetch_proxy=download_to_file,
+            fetch_workers=2,
+        )
+        restored = self.restore / f"Direct_{ver.name}" / "big.bin"
+        self.assertEqual(restored.read_bytes(), (self.source / "big.bin").read_bytes())
+
+    def test_spilled_object_and_pack_files_removed(self):
+        with patch("manager.STAGE_IN_MEMORY_LIMIT", 1024):
+            self._backup(pack_objects=True)
+        self.assertEqual(self._stored_objects(), [])
+        self.assertEqual(list(self.storage.rglob(".stage-*")), [])
+        self.assertTrue(any(k.endswith(".pack") for k in self.bucket.uploads))
+
+    def test_second_backup_checks_the_remote(self):
+        manager, _ = self._backup()
+        salt = manifests.read_info(manager._find_target_versions("Direct")[-1])["salt"]
+        self.bucket.uploads.clear()
+        # a fresh temp directory: nothing is known locally
+        shutil.rmtree(self.storage)
+        _, res = self._backup(forced_salt=salt)
+        self.assertEqual(res.copied, 0)
+        self.assertFalse([k for k in self.bucket.uploads if k.startswith("objects")])
+
+    def test_requires_upload_hook(self):
+        manager = BackupManager(self.storage, remote=self.bucket)
+        with self.assertRaises(ValueError):
+            manager.create_backup(scan_files(self.source), self.source, "Direct")
+
+    def test_upload_queue_deletes_temporary_files(self):
+        from cloud_manager import UploadQueue
+
+        temp = self.base / "spill"
+        temp.write_bytes(b"spilled")
+        with UploadQueue(self.bucket, workers=1) as uploads:
+            uploads(Path("objects/aa/bb"), temp, discard=True)
+        self.assertFalse(temp.exists())
+        self.assertEqual(self.bucket.objects["objects/aa/bb"], b"spilled")
+
+    @patch("cloud_manager.boto3.client")
+    def test_has_object_uses_index(self, mock_boto):
+        from cloud_manager import CloudManager
+
+        cm = CloudManager(
+            "http://e", "k", "s", "bucket", index_path=self.base / "index.db"
+        )
+        cm.index.add("backups/objects/aa/bb")
+        self.assertTrue(cm.has_object(Path("objects/aa/bb")))
+        self.assertFalse(cm.has_object(Path("objects/aa/cc")))
+        mock_boto.return_value.head_object.assert_not_called()
+        cm.index.close()
+
 
 # ---------------------------------------------------------------------------
 # main.py — full coverage via mocks
@@ -605,6 +2982,19 @@ class TestMain(unittest.TestCase):
                         result = main._setup_storage(is_cloud=True)
         self.assertIsNotNone(result)
 
+    def test_setup_storage_cloud_spool_dir(self):
+        import tempfile
+        import main
+
+        with tempfile.TemporaryDirectory() as tmp:
+            with patch.dict(os.environ, {"SMART_BACKUP_SPOOL_DIR": tmp}):
+                options = main.parse_options([])
+            self.assertEqual(options.spool_dir, tmp)
+            with patch("main.load_dotenv"), patch("main.CloudManager"):
+                _, backup_base = main._setup_storage(is_cloud=True, options=options)
+            self.assertEqual(backup_base, Path(tmp) / "smart_backup_cloud_temp")
+            self.assertTrue(backup_base.is_dir())
+
     def test_setup_storage_minio_replaced_without_docker_mode(self):
         import main
 
@@ -677,6 +3067,7 @@ class TestMain(unittest.TestCase):
             manager, cloud, self.storage, "Proj", is_cloud=True
         )
         self.assertEqual(result, fake_manifest)
+        cloud.get_last_manifest.assert_called_once_with("Proj", self.storage)
 
     def test_load_last_manifest_cloud_not_found(self):
         import main
@@ -712,7 +3103,7 @@ class TestMain(unittest.TestCase):
             with patch("builtins.input", side_effect=inputs):
                 with patch("main.getpass.getpass", return_value=""):
                     with patch("builtins.print"):
-                        result = main.handle_backup(
+                        main.handle_backup(
                             manager, None, self.storage, is_cloud=False
                         )
 
@@ -725,7 +3116,7 @@ class TestMain(unittest.TestCase):
             with patch("builtins.input", side_effect=inputs):
                 with patch("main.getpass.getpass", return_value="secret"):
                     with patch("builtins.print"):
-                        result = main.handle_backup(
+                        main.handle_backup(
                             manager, None, self.storage, is_cloud=False
                         )
 
@@ -742,7 +3133,7 @@ class TestMain(unittest.TestCase):
             with patch("builtins.input", side_effect=inputs):
                 with patch("main.getpass.getpass", return_value=""):
                     with patch("builtins.print"):
-                        result = main.handle_backup(
+                        main.handle_backup(
                             manager, None, self.storage, is_cloud=False
                         )
 
@@ -759,7 +3150,7 @@ class TestMain(unittest.TestCase):
             with patch("builtins.input", side_effect=inputs):
                 with patch("main.getpass.getpass", return_value=""):
                     with patch("builtins.print"):
-                        result = main.handle_backup(
+                        main.handle_backup(
                             manager, None, self.storage, is_cloud=False
                         )
 
@@ -778,7 +3169,7 @@ class TestMain(unittest.TestCase):
             with patch("builtins.input", side_effect=inputs):
                 with patch("main.getpass.getpass", return_value="old"):
                     with patch("builtins.print"):
-                        result = main.handle_backup(
+                        main.handle_backup(
                             manager, None, self.storage, is_cloud=False
                         )
 
@@ -796,7 +3187,7 @@ class TestMain(unittest.TestCase):
                 with patch("main.getpass.getpass", return_value=""):
                     with patch("main.shutil.rmtree"):
                         with patch("builtins.print"):
-                            result = main.handle_backup(
+                            main.handle_backup(
                                 manager, cloud, cloud_temp, is_cloud=True
                             )
 
@@ -808,10 +3199,23 @@ class TestMain(unittest.TestCase):
         inputs = iter(["", ""])
         with patch("builtins.input", side_effect=inputs):
             with patch("builtins.print"):
-                result = main.handle_restore(
+                main.handle_restore(
                     manager, None, self.storage, is_cloud=False
                 )
 
+    def test_handle_restore_version_removed_from_disk(self):
+        """A catalog row whose snapshot is gone points to the rebuild."""
+        import main
+
+        manager = BackupManager(self.storage)
+        manager.create_backup(scan_files(self.source), self.source, "Proj", compress=False)
+        shutil.rmtree(manager._find_target_versions("Proj")[0])
+        inputs = iter(["Proj", ""])
+        with patch("builtins.input", side_effect=inputs):
+            with patch("builtins.print") as mock_print:
+                main.handle_restore(manager, None, self.storage, is_cloud=False)
+        self.assertIn("rebuild the indexes", str(mock_print.call_args_list))
+
     def test_handle_restore_unencrypted(self):
         import main
 
@@ -823,7 +3227,7 @@ class TestMain(unittest.TestCase):
         with patch("builtins.input", side_effect=inputs):
             with patch("main.get_safe_path", return_value=self.restore):
                 with patch("builtins.print"):
-                    result = main.handle_restore(
+                    main.handle_restore(
                         manager, None, self.storage, is_cloud=False
                     )
 
@@ -841,10 +3245,27 @@ class TestMain(unittest.TestCase):
             with patch("main.getpass.getpass", return_value="wrong"):
                 with patch("main.get_safe_path", return_value=self.restore):
                     with patch("builtins.print"):
-                        result = main.handle_restore(
+                        main.handle_restore(
                             manager, None, self.storage, is_cloud=False
                         )
 
+    def test_handle_restore_verify_only(self):
+        import main
+
+        manager = BackupManager(self.storage)
+        manager.create_backup(scan_files(self.source), self.source, "Proj")
+        options = main.parse_options(["--verify-only"])
+        inputs = iter(["Proj", "", ""])
+        with patch("builtins.input", side_effect=inputs):
+            with patch("main.get_safe_path") as safe_path:
+                with patch("builtins.print") as mock_print:
+                    main.handle_restore(
+                        manager, None, self.storage, is_cloud=False, options=options
+                    )
+        safe_path.assert_not_called()
+        self.assertEqual(list(self.restore.iterdir()), [])
+        self.assertIn("Intact: 1 / 1", str(mock_print.call_args_list))
+
     def test_handle_restore_technical_mode(self):
         import main
 
@@ -856,7 +3277,7 @@ class TestMain(unittest.TestCase):
         with patch("builtins.input", side_effect=inputs):
             with patch("main.get_safe_path", return_value=self.restore):
                 with patch("builtins.print"):
-                    result = main.handle_restore(
+                    main.handle_restore(
                         manager, None, self.storage, is_cloud=False
                     )
 
@@ -868,14 +3289,16 @@ class TestMain(unittest.TestCase):
         manager.create_backup(scan_res, self.source, "Proj", compress=False)
 
         ver = manager._find_target_versions("Proj")[0]
-        manifest_key = f"backups/Proj/{ver.name}/manifest.json"
+        manifest_key = f"backups/Proj/{ver.name}/manifest.sbm"
         manifest_data = (
-            self.storage / "Proj" / ver.name / "manifest.json"
+            self.storage / "Proj" / ver.name / "manifest.sbm"
         ).read_bytes()
 
         cloud = MagicMock()
         cloud.list_manifests.return_value = [manifest_key]
-        cloud.download_data.return_value = manifest_data
+        cloud.download_file.side_effect = lambda key, dest: dest.write_bytes(
+            manifest_data
+        )
         cloud.download_objects.side_effect = lambda rel_path: (
             self.storage / rel_path
         ).read_bytes()
@@ -886,6 +3309,25 @@ class TestMain(unittest.TestCase):
                 with patch("builtins.print"):
                     main.handle_restore(manager, cloud, self.storage, is_cloud=True)
 
+    def test_handle_restore_cloud_sync_skips_known_snapshots(self):
+        import main
+
+        manager = BackupManager(self.storage)
+        manager.create_backup(scan_files(self.source), self.source, "Proj")
+        ver = manager._find_target_versions("Proj")[0]
+
+        cloud = MagicMock()
+        cloud.list_manifests.return_value = [f"backups/Proj/{ver.name}/manifest.sbm"]
+        cloud.list_pack_indexes.return_value = []
+        inputs = iter(["Proj", "", "1", ""])
+        with patch.object(manager, "record_snapshot") as record:
+            with patch("builtins.input", side_effect=inputs):
+                with patch("main.get_safe_path", return_value=self.restore):
+                    with patch("builtins.print"):
+                        main.handle_restore(manager, cloud, self.storage, is_cloud=True)
+        cloud.download_file.assert_not_called()
+        record.assert_not_called()
+
     def test_handle_restore_encrypted_correct_password(self):
         """Correct password — verify_password passes, restore proceeds."""
         import main
@@ -900,7 +3342,7 @@ class TestMain(unittest.TestCase):
             with patch("main.getpass.getpass", return_value="correct"):
                 with patch("main.get_safe_path", return_value=self.restore):
                     with patch("builtins.print"):
-                        result = main.handle_restore(
+                        main.handle_restore(
                             manager, None, self.storage, is_cloud=False
                         )
 
@@ -923,6 +3365,54 @@ class TestMain(unittest.TestCase):
                 with patch("builtins.print"):
                     main.handle_restore(manager, None, self.storage, is_cloud=False)
 
+    # --- parse_options ---
+    def test_parse_options_flag_and_env(self):
+        import main
+
+        with patch.dict(os.environ, {"SMART_BACKUP_SCAN_WORKERS": "6"}):
+            self.assertEqual(main.parse_options([]).scan_workers, 6)
+            opts = main.parse_options(["--scan-workers", "3", "--unknown"])
+        self.assertEqual(opts.scan_workers, 3)
+
+    def test_parse_options_codec(self):
+        import main
+
+        with patch.dict(os.environ, {"SMART_BACKUP_CODEC": "zlib:1"}):
+            self.assertEqual(main.parse_options([]).codec, "zlib:1")
+            self.assertEqual(main.parse_options(["--codec", "none"]).codec, "none")
+        with self.assertRaises(SystemExit):
+            with patch("sys.stderr", io.StringIO()):
+                main.parse_options(["--codec", "brotli"])
+
+    def test_parse_options_upload_workers(self):
+        import main
+
+        with patch.dict(os.environ, {"SMART_BACKUP_UPLOAD_WORKERS": "6"}):
+            self.assertEqual(main.parse_options([]).upload_workers, 6)
+            self.assertEqual(
+                main.parse_options(["--upload-workers", "3"]).upload_workers, 3
+            )
+
+    def test_parse_options_transfer_settings(self):
+        import main
+
+        options = main.parse_options(["--part-size", "64", "--transfer-concurrency", "4"])
+        self.assertEqual((options.part_size_mb, options.transfer_concurrency), (64, 4))
+        with patch.dict(os.environ, {"SMART_BACKUP_PART_SIZE_MB": "32"}):
+            self.assertEqual(main.parse_options([]).part_size_mb, 32)
+
+    def test_handle_rebuild_index_local(self):
+        import main
+
+        manager = BackupManager(self.storage)
+        manager.create_backup(scan_files(self.source), self.source, "Idx")
+        (self.storage / "objects" / ".index.sqlite").unlink()
+        manager = BackupManager(self.storage)
+        with patch("builtins.input", return_value=""):
+            with patch("builtins.print") as mock_print:
+                main.handle_rebuild_index(manager, None, is_cloud=False)
+        self.assertIn("Objects indexed: 1", str(mock_print.call_args_list))
+
     # --- main() loop ---
     def test_main_exit(self):
         import main
@@ -1044,7 +3534,7 @@ class TestBackupSystem(unittest.TestCase):
 
     def test_non_compressible_files_skipped(self):
         manager = BackupManager(self.storage)
-        jpg_content = b"\xff\xd8\xff" + b"fake_jpeg_data" * 100
+        jpg_content = b"\xff\xd8\xff" + os.urandom(20_000)  # JPEG data is incompressible
         txt_content = b"This is a plain text file that should be compressed"
         (self.source / "photo.jpg").write_bytes(jpg_content)
         (self.source / "notes.txt").write_bytes(txt_content)
@@ -1054,9 +3544,7 @@ class TestBackupSystem(unittest.TestCase):
         )
         versions = manager._find_target_versions("MixedProject")
         ver_dir = versions[0]
-        manifest_path = self.storage / "MixedProject" / ver_dir.name / "manifest.json"
-        with open(manifest_path) as f:
-            manifest = json.load(f)
+        manifest = manifests.open_manifest(ver_dir)
         files = manifest["files"]
         jpg_entry = next((v for k, v in files.items() if k.endswith("photo.jpg")), None)
         txt_entry = next((v for k, v in files.items() if k.endswith("notes.txt")), None)
@@ -1118,9 +3606,7 @@ class TestBackupSystem(unittest.TestCase):
         )
         versions = manager._find_target_versions("IgnoreProject")
         ver_dir = versions[0]
-        manifest_path = self.storage / "IgnoreProject" / ver_dir.name / "manifest.json"
-        with open(manifest_path) as f:
-            manifest = json.load(f)
+        manifest = manifests.open_manifest(ver_dir)
         backed_up = set(manifest["files"].keys())
         for ignored in ["temp.tmp", "app.log", "old.bak", "editor.swp"]:
             self.assertFalse(any(ignored in k for k in backed_up))
@@ -1167,6 +3653,37 @@ class TestApiValidators(unittest.TestCase):
                 }
             )
 
+    def test_scan_workers_out_of_range(self):
+        with self.assertRaises(ValidationError):
+            BackupRequest.model_validate(
+                {
+                    "source_path": "/data/test",
+                    "project_name": "proj",
+                    "scan_workers": 0,
+                }
+            )
+
+    def test_backup_workers_out_of_range(self):
+        with self.assertRaises(ValidationError) as ctx:
+            BackupRequest.model_validate(
+                {
+                    "source_path": "/data/test",
+                    "project_name": "proj",
+                    "backup_workers": MAX_WORKERS + 1,
+                }
+            )
+        self.assertIn("backup_workers", str(ctx.exception))
+
+    def test_codec_validated(self):
+        req = BackupRequest.model_validate(
+            {"source_path": "/data/test", "project_name": "proj", "codec": "Zlib:9"}
+        )
+        self.assertEqual(req.codec, "zlib:9")
+        with self.assertRaises(ValidationError):
+            BackupRequest.model_validate(
+                {"source_path": "/data/test", "project_name": "proj", "codec": "brotli"}
+            )
+
     def test_comment_too_long(self):
         with self.assertRaises(ValidationError):
             BackupRequest.model_validate(
@@ -1202,6 +3719,41 @@ class TestApiEndpoints(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.json(), [])
 
+    def test_backups_paged_from_catalog(self):
+        storage = Path(__file__).parent.parent / "test_sandbox_api_catalog"
+        self.addCleanup(shutil.rmtree, storage, ignore_errors=True)
+        catalog = BackupManager(storage).catalog
+        for n in range(5):
+            catalog.record(SnapshotSummary("proj", f"v{n}", n, "", n % 2 == 1, True))
+        with patch("api.BACKUP_BASE", storage):
+            response = self.client.get(
+                "/backups?project=proj&encrypted=true&limit=1&offset=1",
+                headers=self.headers,
+            )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers["X-Total-Count"], "2")
+        self.assertEqual([b["version"] for b in response.json()], ["v3"])
+
+    def test_file_history_and_hash_locations(self):
+        storage = Path(__file__).parent.parent / "test_sandbox_api_files"
+        self.addCleanup(shutil.rmtree, storage, ignore_errors=True)
+        file_hash = "ab" * 32
+        catalog = BackupManager(storage).catalog
+        for version in ("v1", "v2"):
+            summary = SnapshotSummary("proj", version, 1, "", False, True)
+            catalog.record(summary, [("r/q3.xlsx", file_hash)])
+        with patch("api.BACKUP_BASE", storage):
+            history = self.client.get(
+                "/files/history", params={"path": "r/q3.xlsx"}, headers=self.headers
+            )
+            by_hash = self.client.get(
+                f"/files/by-hash/{file_hash}?limit=1", headers=self.headers
+            )
+            bad = self.client.get("/files/by-hash/not-a-hash", headers=self.headers)
+        self.assertEqual([v["version"] for v in history.json()], ["v1", "v2"])
+        self.assertEqual(by_hash.json(), [history.json()[0]])
+        self.assertEqual(bad.status_code, 400)
+
     def test_backup_source_not_found(self):
         response = self.client.post(
             "/backups",  # было /backup
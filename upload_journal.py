@@ -0,0 +1,85 @@
+"""Journal of multipart uploads in progress.
+
+A large object is uploaded in parts under one multipart upload id. The id is
+recorded here before the first part is sent and removed once the upload is
+completed, so a cloud backup interrupted half way through an object can
+continue that upload in the next run: only the parts the bucket does not
+already hold with the same content are sent again. Encrypted and padded
+objects come out different each time they are encoded, so the entry also
+records the file holding the exact bytes the upload started with; the next
+run sends the missing parts from that file. Uploads left behind by a run that
+never came back to them are aborted to free their parts.
+
+Completed uploads are recorded by the cloud object index (object_index.py).
+"""
+
+import sqlite3
+import threading
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+
+
+@dataclass(frozen=True)
+class PendingUpload:
+    key: str
+    upload_id: str
+    part_size: int
+    size: int
+    # file holding the bytes being uploaded, None if they were not kept
+    source: Optional[str] = None
+
+
+class UploadJournal:
+    def __init__(self, db_path: Path):
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS multipart_uploads ("
+            "key TEXT PRIMARY KEY, upload_id TEXT NOT NULL, "
+            "part_size INTEGER NOT NULL, size INTEGER NOT NULL, source TEXT) "
+            "WITHOUT ROWID"
+        )
+        self._conn.commit()
+
+    def get(self, key: str) -> Optional[PendingUpload]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT key, upload_id, part_size, size, source FROM multipart_uploads "
+                "WHERE key = ?",
+                (key,),
+            ).fetchone()
+        return PendingUpload(*row) if row else None
+
+    def pending(self) -> list[PendingUpload]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT key, upload_id, part_size, size, source FROM multipart_uploads "
+                "ORDER BY key"
+            ).fetchall()
+        return [PendingUpload(*row) for row in rows]
+
+    def start(self, upload: PendingUpload) -> None:
+        # committed at once: the id must survive the crash it is kept for
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO multipart_uploads "
+                "(key, upload_id, part_size, size, source) VALUES (?, ?, ?, ?, ?)",
+                (
+                    upload.key,
+                    upload.upload_id,
+                    upload.part_size,
+                    upload.size,
+                    upload.source,
+                ),
+            )
+
+    def finish(self, key: str) -> None:
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM multipart_uploads WHERE key = ?", (key,))
+
+    def close(self) -> None:
+        self._conn.close()
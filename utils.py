@@ -1,6 +1,16 @@
+import logging
+import os
 import sys
+import compressors
 from classes import ProgressEvent
 
+logger = logging.getLogger(__name__)
+
+MAX_WORKERS = 64
+# S3 multipart limits: 5 MB minimum part, 5 GB maximum
+MIN_PART_SIZE_MB = 5
+MAX_PART_SIZE_MB = 5 * 1024
+
 
 def show_progress(event: ProgressEvent):
     if event.total is None:
@@ -18,3 +28,58 @@ def show_progress(event: ProgressEvent):
     if event.total and event.processed >= event.total:
         sys.stdout.write("\n")
         sys.stdout.flush()
+
+
+def _env_int(value: int | None, env_var: str, default: int) -> int:
+    if value is not None:
+        return int(value)
+    raw = os.getenv(env_var)
+    try:
+        return int(raw) if raw else default
+    except ValueError:
+        logger.warning(f"Ignoring invalid {env_var}={raw!r}")
+        return default
+
+
+def resolve_workers(value: int | None, env_var: str, default: int = 1) -> int:
+    """Returns the worker count: explicit value, then env_var, then default.
+    The result is clamped to 1..MAX_WORKERS."""
+    return max(1, min(_env_int(value, env_var, default), MAX_WORKERS))
+
+
+def resolve_part_size(value: int | None, env_var: str, default: int = 16) -> int:
+    """Returns the multipart part size in MB: explicit value, then env_var,
+    then default. The result is clamped to MIN_PART_SIZE_MB..MAX_PART_SIZE_MB."""
+    return max(
+        MIN_PART_SIZE_MB, min(_env_int(value, env_var, default), MAX_PART_SIZE_MB)
+    )
+
+
+def resolve_flag(value: bool | None, env_var: str, default: bool = False) -> bool:
+    """Returns the switch: explicit value, then env_var ("1", "true", "yes", "on"), then default."""
+    if value is not None:
+        return bool(value)
+    raw = os.getenv(env_var)
+    if not raw:
+        return default
+    return raw.strip().lower() in ("1", "true", "yes", "on")
+
+
+def resolve_codec(
+    value: str | None, env_var: str, default: str = compressors.DEFAULT_CODEC
+) -> str:
+    """Returns the codec spec ("name" or "name:level"): explicit value, then
+    env_var, then default. An invalid or unavailable env_var codec is ignored
+    with a warning; an invalid explicit value raises."""
+    if value is not None:
+        compressors.parse_codec(value)
+        return value.strip().lower()
+    raw = os.getenv(env_var)
+    if not raw:
+        return default
+    try:
+        compressors.parse_codec(raw)
+    except (ValueError, compressors.CodecUnavailableError) as e:
+        logger.warning(f"Ignoring {env_var}={raw!r}: {e}")
+        return default
+    return raw.strip().lower()